@@ -1,31 +1,57 @@
-import sys
-from itertools import product
 from pathlib import Path
 from string import Template
 
-import matplotlib.pyplot as plt
-import pandas
-from PIL import Image
-from PIL import ImageDraw
-from PIL import ImageFont
+import numpy
 
-import utils
+import grid_algorithm
+import lot_summary
 
 
-def plot_input_and_output(input_grid, output_grid, output_dir, input_file_name):
+def plot_input_and_output(input_grid, output_grid, output_dir, input_file_name, renderer='table'):
+    """
+    :param input_grid: ChipsGrid of the input wafer.
+    :param output_grid: ChipsGrid after the algorithm.
+    :param renderer: 'table' for matplotlib table or 'raster' for direct pixels image.
+    :return: the summary row of the wafer.
+    """
+    short_summary, summary_row = make_summary(input_grid.states, output_grid.states, input_file_name)
+    make_report(input_grid.states, output_grid.states, output_dir, input_file_name, renderer, short_summary)
+    return summary_row
+
+
+def make_report(input_states, output_states, output_dir, input_file_name, renderer='table', short_summary=None):
+    """
+    Draw the wafer images before and after the algorithm and the html page that shows them.
+    :param short_summary: the short summary from make_summary, computed when it is not given.
+    :return: the path of the html page.
+    """
+    if short_summary is None:
+        short_summary, _ = make_summary(input_states, output_states, input_file_name)
     images_paths = [output_dir / f'image_{idx}.jpg' for idx in range(2)]
-    make_wafer_images_in_parallel(input_grid, output_grid, images_paths)
-    short_summary = make_summary(input_grid, output_grid, output_dir, input_file_name)
+    make_wafer_images_in_parallel(input_states, output_states, images_paths, renderer)
     result_file_path = output_dir / f'result_of_{input_file_name}.html'
     make_final_page(images_paths, result_file_path, short_summary)
+    return result_file_path
+
+
+def make_report_from_result(output_states, output_dir, input_file_name, renderer='table'):
+    """
+    Make the report of saved result wafer, the input wafer is the result with the chips failed by prediction
+    passed again.
+    """
+    input_states = output_states.copy()
+    input_states[input_states == grid_algorithm.FAIL_BY_PREDICTION] = grid_algorithm.PASS
+    return make_report(input_states, output_states, output_dir, input_file_name, renderer)
 
 
-def make_wafer_images_in_parallel(input_grid, output_grid, images_paths):
-    make_and_save_table(images_paths[0], input_grid)
-    make_and_save_table(images_paths[1], output_grid)
+def make_wafer_images_in_parallel(input_states, output_states, images_paths, renderer='table'):
+    make_and_save_image = renderers_dict[renderer]
+    make_and_save_image(images_paths[0], input_states)
+    make_and_save_image(images_paths[1], output_states)
 
 
 def make_text_figure(text, image_path):
+    from PIL import Image, ImageDraw, ImageFont
     img = Image.new('RGB', (500, 500), color=(255, 255, 255))
     draw = ImageDraw.Draw(img)
     font = ImageFont.truetype("arial.ttf", 25)
@@ -33,51 +59,73 @@ def make_text_figure(text, image_path):
     img.save(image_path)
 
 
-def find_difference_coordinates(input_grid, output_grid):
-    grid_of_chars_input = make_grid_of_chars(input_grid)
-    grid_of_chars_output = make_grid_of_chars(output_grid)
-    number_of_rows = len(grid_of_chars_input)
-    number_of_columns = len(grid_of_chars_input[0])
-    coordinates_of_difference_list = list()
-    for x_coordinate, y_coordinate in product(range(number_of_rows), range(number_of_columns)):
-        input_cell = grid_of_chars_input[x_coordinate][y_coordinate]
-        output_cell = grid_of_chars_output[x_coordinate][y_coordinate]
-        if input_cell != output_cell:
-            coordinates_of_difference_list.append(f'({x_coordinate},{y_coordinate})')
-    return coordinates_of_difference_list
+def find_difference_coordinates(difference_coordinates):
+    rows, columns = difference_coordinates
+    return [f'({row},{column})' for row, column in zip(rows.tolist(), columns.tolist())]
 
 
-def make_summary(input_grid, output_grid, output_dir, input_file_name):
-    number_of_fail_chips = input_grid.count('X')
-    number_of_pass_chips = input_grid.count('1')
+def make_summary(input_states, output_states, input_file_name):
+    """
+    :param input_states: states array of the input wafer.
+    :param output_states: states array after the algorithm.
+    :return: short summary for the html page and the summary row of the wafer.
+    """
+    input_counts, output_counts, difference_coordinates = grid_algorithm.summarize_states(input_states,
+                                                                                          output_states)
+    number_of_fail_chips = int(input_counts[grid_algorithm.FAIL])
+    number_of_pass_chips = int(input_counts[grid_algorithm.PASS])
     number_of_chips = number_of_fail_chips + number_of_pass_chips
-    failed_by_prediction = output_grid.count('Y')
-    pass_at_the_end = output_grid.count('1')
-    fail_at_the_end = output_grid.count('X') + output_grid.count('Y')
-    difference_coordinates = find_difference_coordinates(input_grid, output_grid)
-    difference_coordinates_str = ":".join(difference_coordinates)
+    failed_by_prediction = int(output_counts[grid_algorithm.FAIL_BY_PREDICTION])
+    pass_at_the_end = int(output_counts[grid_algorithm.PASS])
+    fail_at_the_end = int(output_counts[grid_algorithm.FAIL]) + failed_by_prediction
+    difference_coordinates_str = ":".join(find_difference_coordinates(difference_coordinates))
     short_summary = f'Original: {number_of_chips} chips.<br>' \
                     f'Pass/ fail: {number_of_pass_chips} / {number_of_fail_chips}.<br>' \
                     f'After Process:<br>' \
                     f'Pass/ fail: {pass_at_the_end} / {fail_at_the_end} ({failed_by_prediction} new fails).<br>'
-
-    fieldnames = ['File_name', 'Total_chips', 'Initially_failed', 'Initially_passed', 'Failed_by_prediction',
-                  'Total_failed',
-                  'Total_passed', 'Difference_coordinates']
     row_values = [input_file_name, number_of_chips, number_of_fail_chips, number_of_pass_chips,
                   failed_by_prediction, fail_at_the_end, pass_at_the_end, difference_coordinates_str]
-    data_frame_dict = {field_name: [row_value] for field_name, row_value in zip(fieldnames, row_values)}
-    data_frame = pandas.DataFrame.from_dict(data_frame_dict)
-    utils.drop_un_named_columns(data_frame)
-    summary_file_path = output_dir / f'line_summary.xlsx'
-    with pandas.ExcelWriter(summary_file_path) as writer:
-        data_frame.to_excel(writer, sheet_name='line_summary', index=False)
-    return short_summary
-
-
-def make_grid_of_chars(grid_text):
-    rows_text = grid_text.split('\n')
-    return [[char for char in row] for row in rows_text]
+    summary_row = dict(zip(lot_summary.fieldnames, row_values))
+    return short_summary, summary_row
+
+
+def update_summary_row(summary_row, rows, columns, previous_states, new_states):
+    """
+    Update the summary row of make_summary in place after few chips changed their states in the result,
+    without counting the whole wafer again.
+    :param rows: rows of the changed chips.
+    :param columns: columns of the changed chips.
+    :param previous_states: states of the changed chips in the result before the change.
+    :param new_states: states of the changed chips in the result after the change.
+    """
+    input_state_of = numpy.array([grid_algorithm.NOT_EXISTS, grid_algorithm.PASS, grid_algorithm.FAIL,
+                                  grid_algorithm.PASS])
+
+    def count_changes(states_before, states_after):
+        return numpy.bincount(states_after, minlength=4) - numpy.bincount(states_before, minlength=4)
+
+    input_changes = count_changes(input_state_of[previous_states], input_state_of[new_states])
+    output_changes = count_changes(previous_states, new_states)
+    summary_row['Initially_failed'] += int(input_changes[grid_algorithm.FAIL])
+    summary_row['Initially_passed'] += int(input_changes[grid_algorithm.PASS])
+    summary_row['Total_chips'] = summary_row['Initially_failed'] + summary_row['Initially_passed']
+    summary_row['Failed_by_prediction'] += int(output_changes[grid_algorithm.FAIL_BY_PREDICTION])
+    summary_row['Total_passed'] += int(output_changes[grid_algorithm.PASS])
+    summary_row['Total_failed'] += int(output_changes[grid_algorithm.FAIL] +
+                                       output_changes[grid_algorithm.FAIL_BY_PREDICTION])
+    coordinates = {tuple(map(int, coordinate.strip('()').split(',')))
+                   for coordinate in summary_row['Difference_coordinates'].split(':') if coordinate}
+    for row, column, previous_state, new_state in zip(rows.tolist(), columns.tolist(), previous_states.tolist(),
+                                                      new_states.tolist()):
+        if previous_state == grid_algorithm.FAIL_BY_PREDICTION:
+            coordinates.discard((row, column))
+        if new_state == grid_algorithm.FAIL_BY_PREDICTION:
+            coordinates.add((row, column))
+    summary_row['Difference_coordinates'] = ':'.join(f'({row},{column})' for row, column in sorted(coordinates))
+
+
+def make_grid_of_chars_from_states(states):
+    return [[grid_algorithm.STATES_CHARACTERS[state] for state in row] for row in states.tolist()]
 
 
 def add_demo_axis(table):
@@ -88,21 +136,32 @@ def add_demo_axis(table):
     return table_with_demo_axis
 
 
-def make_and_save_table(figure_path, grid_text):
-    cells_text = make_grid_of_chars(grid_text)
+def make_and_save_table_of_cells(figure_path, cells_text):
+    # Figure without pyplot keeps no global state, so tables can be saved from writer threads
+    from matplotlib.figure import Figure
     cells_text_with_demo_axis = add_demo_axis(cells_text)
     colors = [[get_color(char) for char in row] for row in cells_text_with_demo_axis]
-    figure, ax = plt.subplots()
+    figure = Figure()
+    ax = figure.subplots()
     ax.axis("off")
     ax.table(cellText=cells_text_with_demo_axis, cellColours=colors, loc='center')
-    plt.savefig(figure_path, bbox_inches="tight")
-    # To save time
-    plt.cla()
-    plt.clf()
+    figure.savefig(figure_path, bbox_inches="tight")
+
+
+def make_and_save_table_of_states(figure_path, states):
+    make_and_save_table_of_cells(figure_path, make_grid_of_chars_from_states(states))
+
+
+def make_and_save_raster_of_states(figure_path, states):
+    import wafer_raster
+    wafer_raster.save_wafer_image(figure_path, states)
+
+
+renderers_dict = {'table': make_and_save_table_of_states, 'raster': make_and_save_raster_of_states}
 
 
 def make_final_page(images_paths, path_for_result, short_summary):
-    with open(Path(sys.argv[0]).parent / 'figures_union_template.html', 'r') as skeleton:
+    with open(Path(__file__).parent / 'figures_union_template.html', 'r') as skeleton:
         skeleton_page = skeleton.read()
     page_template = Template(skeleton_page)
     relative_images_path = [Path('.') / Path(image_path).name for image_path in images_paths]
@@ -0,0 +1,157 @@
+"""
+Benchmarks of the stages of handling a wafer on synthetic wafers.
+Every stage is timed separately and the results are printed (or saved) as JSON.
+
+Running example:
+    python benchmark.py --diameters 40 120 360 --fail_density 0.05 --clustering 0.5 --repeats 5 --output bench.json
+"""
+import argparse
+import json
+import platform
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+import numpy
+
+import HtmlViewer
+import grid_algorithm
+import handle_stdf_files
+import lot_summary
+import main
+
+default_neighbors_table = {0: 1, 1: 1, 2: 1, 3: 2, 4: 3, 5: 3, 6: 4, 7: 5, 8: 6}
+
+
+def make_synthetic_states(diameter, fail_density, clustering, random_generator):
+    """
+    Make round wafer with random failed chips.
+    :param diameter: wafer diameter in dies.
+    :param fail_density: expected fraction of failed dies.
+    :param clustering: fraction of the fails that are in clusters (0 - uniform noise only, 1 - clusters only).
+    :param random_generator: numpy random Generator.
+    :return: states array of shape (diameter, diameter).
+    """
+    center = (diameter - 1) / 2
+    rows, columns = numpy.indices((diameter, diameter))
+    distances_from_center = numpy.hypot(rows - center, columns - center)
+    exists = distances_from_center <= diameter / 2
+    fail_probability = numpy.full(exists.shape, fail_density * (1 - clustering))
+    clusters_number = max(1, diameter // 20)
+    cluster_radius = max(1.0, diameter / 40)
+    clusters_centers = random_generator.uniform(0, diameter, size=(clusters_number, 2))
+    clusters_density = numpy.zeros(exists.shape)
+    for cluster_row, cluster_column in clusters_centers:
+        distances_from_cluster = numpy.hypot(rows - cluster_row, columns - cluster_column)
+        clusters_density += numpy.exp(-(distances_from_cluster / cluster_radius) ** 2)
+    if clustering > 0 and clusters_density[exists].mean() > 0:
+        fail_probability += fail_density * clustering * clusters_density / clusters_density[exists].mean()
+    is_failed = random_generator.random(exists.shape) < numpy.minimum(fail_probability, 1)
+    states = numpy.full(exists.shape, grid_algorithm.NOT_EXISTS, dtype=numpy.uint8)
+    states[exists] = grid_algorithm.PASS
+    states[exists & is_failed] = grid_algorithm.FAIL
+    return states
+
+
+def write_text_wafer(states, path):
+    header = 'VAYYAR\nBENCHMARK\nBENCHMARK-01\n'
+    path.write_text(header + grid_algorithm.states_to_text(states) + '\n')
+
+
+def write_stdf_wafer(states, path, retests_fraction=0.02, random_generator=None):
+    rows, columns = numpy.nonzero(states != grid_algorithm.NOT_EXISTS)
+    are_failed = states[rows, columns] == grid_algorithm.FAIL
+    parts = list(zip(rows.tolist(), columns.tolist(), are_failed.tolist()))
+    if random_generator is not None and retests_fraction > 0:
+        retests_indexes = random_generator.choice(len(parts), int(len(parts) * retests_fraction), replace=False)
+        parts.extend(parts[index] for index in retests_indexes.tolist())
+    path.write_bytes(handle_stdf_files.make_stdf_content(parts))
+
+
+def time_stage(stage_function, repeats):
+    durations = list()
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        stage_function()
+        durations.append(time.perf_counter() - start_time)
+    return {'repeats': repeats, 'min_seconds': min(durations), 'median_seconds': statistics.median(durations),
+            'mean_seconds': statistics.mean(durations)}
+
+
+def benchmark_wafer(states, working_directory, neighbors_path, renderers, summary_wafers_number, repeats,
+                    random_generator):
+    text_path, stdf_path = working_directory / 'wafer.txt', working_directory / 'wafer.stdf'
+    write_text_wafer(states, text_path)
+    write_stdf_wafer(states, stdf_path, random_generator=random_generator)
+    input_grid = main.ChipsGrid.make_chips_grid_from_states(states)
+    output_grid = main.apply_algorithm_on_grid(input_grid, neighbors_path)
+    stages = {
+        'parse_text_file': lambda: main.parse_text_file(text_path),
+        'parse_stdf_file': lambda: main.parse_stdf_file(stdf_path),
+        'apply_algorithm_on_grid': lambda: main.apply_algorithm_on_grid(input_grid, neighbors_path),
+    }
+    for renderer in renderers:
+        stages[f'plot_input_and_output[{renderer}]'] = \
+            lambda renderer=renderer: HtmlViewer.plot_input_and_output(input_grid, output_grid, working_directory,
+                                                                       'wafer', renderer)
+
+    def summarize_lot():
+        summary_accumulator = lot_summary.SummaryAccumulator()
+        for wafer_index in range(summary_wafers_number):
+            _, summary_row = HtmlViewer.make_summary(input_grid.states, output_grid.states, f'wafer_{wafer_index}')
+            summary_accumulator.add_row(summary_row)
+        summary_accumulator.write(working_directory / 'summary', 'xlsx')
+
+    stages[f'summary_and_merge[{summary_wafers_number} wafers]'] = summarize_lot
+    results = list()
+    for stage_name, stage_function in stages.items():
+        stage_result = {'stage': stage_name, 'dies': int(numpy.count_nonzero(states)),
+                        'input_bytes': text_path.stat().st_size if 'text' in stage_name else
+                        stdf_path.stat().st_size if 'stdf' in stage_name else None}
+        stage_result.update(time_stage(stage_function, repeats))
+        results.append(stage_result)
+    return results
+
+
+def run_benchmarks(arguments):
+    random_generator = numpy.random.default_rng(arguments.seed)
+    report = {'platform': platform.platform(), 'python': platform.python_version(), 'numpy': numpy.__version__,
+              'parameters': {key: str(value) for key, value in vars(arguments).items()}, 'results': list()}
+    with tempfile.TemporaryDirectory() as temporary_directory:
+        working_directory = Path(temporary_directory)
+        neighbors_path = working_directory / 'neighbors_table.json'
+        neighbors_path.write_text(json.dumps(default_neighbors_table))
+        for diameter in arguments.diameters:
+            states = make_synthetic_states(diameter, arguments.fail_density, arguments.clustering, random_generator)
+            for stage_result in benchmark_wafer(states, working_directory, neighbors_path, arguments.renderers,
+                                                arguments.summary_wafers, arguments.repeats, random_generator):
+                stage_result.update({'diameter': diameter, 'fail_density': arguments.fail_density,
+                                     'clustering': arguments.clustering})
+                report['results'].append(stage_result)
+    return report
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description='Benchmark the stages of Die Cluster on synthetic wafers.')
+    parser.add_argument('--diameters', type=int, nargs='+', default=[40, 120, 360],
+                        help='wafers diameters in dies (360 is about 100k dies).')
+    parser.add_argument('--fail_density', type=float, default=0.05, help='expected fraction of failed dies.')
+    parser.add_argument('--clustering', type=float, default=0.5, help='fraction of the fails that are clustered.')
+    parser.add_argument('--renderers', nargs='*', choices=list(HtmlViewer.renderers_dict), default=['raster'],
+                        help='renderers to benchmark (table is very slow on big wafers).')
+    parser.add_argument('--summary_wafers', type=int, default=25, help='number of wafers in the summary stage.')
+    parser.add_argument('--repeats', type=int, default=3, help='number of times to run each stage.')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic wafers.')
+    parser.add_argument('--output', type=Path, default=None, help='path of JSON file for the results.')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    arguments = get_arguments()
+    benchmark_report = run_benchmarks(arguments)
+    report_text = json.dumps(benchmark_report, indent=2)
+    if arguments.output is None:
+        print(report_text)
+    else:
+        arguments.output.write_text(report_text)
@@ -0,0 +1,149 @@
+"""
+Local HTTP service that keeps the classification engine resident between requests.
+Endpoints:
+  GET  /health                       -> {"status": "ok", "version": ..., "neighbors_file": ...}
+  POST /classify?name=W&type=txt     -> body is the wafer file content (type txt or stdf),
+                                        returns the result of the wafer (see below).
+  POST /batch                        -> body is JSON {"wafers": [{"name": .., "type": "txt", "content": ..}, ...]},
+                                        content is the text of .txt files and base64 of .stdf files,
+                                        returns {"results": [result, ...]} in the same order.
+Result of wafer is {"name", "result_text", "wafer", "summary"} or {"name", "error"}.
+Requests need Content-Length header, bodies above the maximal body size are refused with 413.
+"""
+import base64
+import binascii
+import json
+import logging
+import threading
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+logger = logging.getLogger('ChipProductionLogger')
+
+supported_types = {'txt': '.txt', 'stdf': '.stdf'}
+MAX_BODY_BYTES = 256 * 2 ** 20
+
+
+class BadRequestException(Exception):
+    def __init__(self, message, status=HTTPStatus.BAD_REQUEST):
+        super().__init__(message)
+        self.status = status
+
+
+def decode_batch_wafer(wafer):
+    """
+    :param wafer: dict of one wafer of batch request.
+    :return: (name, content as bytes, type of file).
+    """
+    try:
+        name, type_name, content = wafer.get('name', 'wafer'), wafer.get('type', 'txt'), wafer['content']
+    except (AttributeError, KeyError):
+        raise BadRequestException('Every wafer must be object with "content".')
+    if type_name not in supported_types:
+        raise BadRequestException(f'The type {type_name} is not supported, only {", ".join(supported_types)}.')
+    try:
+        content = base64.b64decode(content, validate=True) if type_name == 'stdf' else content.encode()
+    except (binascii.Error, AttributeError, TypeError):
+        raise BadRequestException(f'The content of {name} is not {"base64" if type_name == "stdf" else "text"}.')
+    return name, content, supported_types[type_name]
+
+
+class ClassificationRequestHandler(BaseHTTPRequestHandler):
+    server_version = 'ChipProductionService'
+
+    def log_message(self, format_string, *arguments):
+        logger.debug(f'{self.address_string()} {format_string % arguments}')
+
+    def send_json(self, status, body):
+        encoded_body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(encoded_body)))
+        self.end_headers()
+        self.wfile.write(encoded_body)
+
+    def read_body(self):
+        content_length = self.headers.get('Content-Length', '')
+        if not content_length.isascii() or not content_length.isdigit():
+            raise BadRequestException('The request needs numeric Content-Length header.')
+        if int(content_length) > self.server.max_body_bytes:
+            self.close_connection = True  # the body is not read
+            raise BadRequestException(f'The body is above {self.server.max_body_bytes} bytes.',
+                                      HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+        return self.rfile.read(int(content_length))
+
+    def do_GET(self):
+        if urlparse(self.path).path != '/health':
+            self.send_json(HTTPStatus.NOT_FOUND, {'error': f'No such endpoint {self.path}.'})
+            return
+        self.send_json(HTTPStatus.OK, {'status': 'ok', 'version': self.server.version,
+                                       'neighbors_file': str(self.server.neighbors_path)})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        try:
+            if url.path == '/classify':
+                query = parse_qs(url.query)
+                type_name = query.get('type', ['txt'])[0]
+                if type_name not in supported_types:
+                    raise BadRequestException(f'The type {type_name} is not supported.')
+                wafers = [(query.get('name', ['wafer'])[0], self.read_body(), supported_types[type_name])]
+            elif url.path == '/batch':
+                try:
+                    wafers = json.loads(self.read_body())['wafers']
+                except (ValueError, KeyError, TypeError):
+                    raise BadRequestException('The body must be JSON object with "wafers" list.')
+                wafers = [decode_batch_wafer(wafer) for wafer in wafers]
+            else:
+                self.send_json(HTTPStatus.NOT_FOUND, {'error': f'No such endpoint {self.path}.'})
+                return
+        except BadRequestException as error:
+            self.send_json(error.status, {'error': str(error)})
+            return
+        try:
+            results = self.server.classify_wafers_function(wafers, self.server.neighbors_path)
+        except Exception as error:
+            logger.exception('Failed classifying wafers of request.')
+            self.send_json(HTTPStatus.INTERNAL_SERVER_ERROR, {'error': repr(error)})
+            return
+        if url.path == '/classify':
+            status = HTTPStatus.OK if 'error' not in results[0] else HTTPStatus.UNPROCESSABLE_ENTITY
+            self.send_json(status, results[0])
+        else:
+            self.send_json(HTTPStatus.OK, {'results': results})
+
+
+def make_server(host, port, classify_wafers_function, neighbors_path, version, max_body_bytes=MAX_BODY_BYTES):
+    """
+    :param port: port to listen on, 0 for any free port (see server.server_address).
+    :param classify_wafers_function: function of (list of (name, content, type of file), neighbors path)
+     that returns list of results.
+    :param max_body_bytes: requests with larger bodies are refused.
+    :return: ThreadingHTTPServer, call serve_forever() to start it.
+    """
+    server = ThreadingHTTPServer((host, port), ClassificationRequestHandler)
+    server.classify_wafers_function = classify_wafers_function
+    server.neighbors_path = neighbors_path
+    server.version = version
+    server.max_body_bytes = max_body_bytes
+    return server
+
+
+def serve(host, port, classify_wafers_function, neighbors_path, version, stop_event=None):
+    """
+    Serve until stop_event is set (or KeyboardInterrupt).
+    """
+    server = make_server(host, port, classify_wafers_function, neighbors_path, version)
+    logger.info(f'Serving classification on http://{server.server_address[0]}:{server.server_address[1]}.')
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+    stop_event = stop_event if stop_event is not None else threading.Event()
+    try:
+        while not stop_event.wait(1):
+            pass
+    except KeyboardInterrupt:
+        logger.info('Service was stopped.')
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,84 @@
+"""
+In memory cache of wafer geometries for the neighbors threshold tables.
+The number of existing neighbors of every chip, and so its threshold, depends only on the map of the existing
+chips, which is the same for all the wafers of a product. The cache keeps the neighbors counts and the thresholds
+map of every geometry that was seen, so the next wafers of the same geometry count only their failed neighbors.
+Geometries are keyed by hash of the existence mask, or by a key of the caller (like product ID) that is checked
+against the mask of the wafer.
+"""
+import hashlib
+import threading
+from collections import OrderedDict, namedtuple
+
+import numpy
+
+import grid_algorithm
+
+Geometry = namedtuple('Geometry', ['is_existing', 'neighbors_counts', 'thresholds'])
+
+
+def hash_geometry(is_existing):
+    hash_object = hashlib.blake2b(digest_size=16)
+    hash_object.update(numpy.array(is_existing.shape, dtype=numpy.int64).tobytes())
+    hash_object.update(numpy.packbits(is_existing).tobytes())
+    return hash_object.digest()
+
+
+class GeometryCache:
+    def __init__(self, thresholds_lookup, max_geometries=64):
+        """
+        :param thresholds_lookup: array from grid_algorithm.make_thresholds_lookup.
+        :param max_geometries: least recently used geometries are removed above this number.
+        """
+        self.thresholds_lookup = thresholds_lookup
+        self.max_geometries = max_geometries
+        self.geometries = OrderedDict()
+        self.lock = threading.Lock()  # the classification service classifies from many threads
+        self.hits = 0
+        self.misses = 0
+
+    def get_geometry(self, is_existing, key=None):
+        """
+        :param is_existing: 2D boolean array of the existing chips.
+        :param key: key of the geometry (like product ID), the hash of is_existing when not given or when the
+         geometry of this key has other existing chips.
+        :return: Geometry.
+        """
+        geometry_key = hash_geometry(is_existing) if key is None else key
+        with self.lock:
+            geometry = self.geometries.get(geometry_key)
+            if geometry is not None and key is not None and not numpy.array_equal(geometry.is_existing, is_existing):
+                geometry_key = hash_geometry(is_existing)
+                geometry = self.geometries.get(geometry_key)
+            if geometry is not None:
+                self.geometries.move_to_end(geometry_key)
+                self.hits += 1
+                return geometry
+            self.misses += 1
+        neighbors_counts = grid_algorithm.count_neighbors(is_existing)
+        geometry = Geometry(is_existing.copy(), neighbors_counts, self.thresholds_lookup[neighbors_counts])
+        with self.lock:
+            self.geometries[geometry_key] = geometry
+            while len(self.geometries) > self.max_geometries:
+                self.geometries.popitem(last=False)
+        return geometry
+
+    def classify(self, states, key=None):
+        """
+        Same as grid_algorithm.classify_states with the thresholds of the cached geometries.
+        :param states: states array (or stack of states arrays, every wafer has its own geometry).
+        :param key: key of the geometry of 2D states array (like product ID).
+        :return: new states array with FAIL_BY_PREDICTION marks.
+        """
+        is_existing = states != grid_algorithm.NOT_EXISTS
+        if states.ndim == 2:
+            thresholds = self.get_geometry(is_existing, key).thresholds
+        else:
+            wafers_masks = is_existing.reshape(-1, *states.shape[-2:])
+            thresholds = numpy.stack([self.get_geometry(wafer_mask).thresholds for wafer_mask in wafers_masks])
+            thresholds = thresholds.reshape(states.shape)
+        fail_neighbors_counts = grid_algorithm.count_neighbors(states == grid_algorithm.FAIL)
+        is_predicted_fail = (states == grid_algorithm.PASS) & (fail_neighbors_counts >= thresholds)
+        result_states = states.copy()
+        result_states[is_predicted_fail] = grid_algorithm.FAIL_BY_PREDICTION
+        return result_states
@@ -0,0 +1,286 @@
+import numpy
+
+NOT_EXISTS = 0
+PASS = 1
+FAIL = 2
+FAIL_BY_PREDICTION = 3
+
+STATES_CHARACTERS = '.1XY'
+UNKNOWN_STATE = 255
+MAX_NEIGHBORS_NUMBER = 8
+
+characters_to_states_lookup = numpy.full(256, UNKNOWN_STATE, dtype=numpy.uint8)
+for state_code, state_character in enumerate(STATES_CHARACTERS):
+    characters_to_states_lookup[ord(state_character)] = state_code
+states_to_characters_lookup = numpy.frombuffer(STATES_CHARACTERS.encode('ascii'), dtype=numpy.uint8)
+
+
+def states_from_rows(rows):
+    """
+    Turn rows of wafer text into states array.
+    :param rows: list of strings with the same length, composed from . 1 X Y only.
+    :return: uint8 array of shape (rows, columns) with the state code of each chip.
+    """
+    if len({len(row) for row in rows}) > 1:
+        raise ValueError('The wafer rows are not in the same length.')
+    columns_number = len(rows[0]) if rows else 0
+    rows_bytes = ''.join(rows).encode('ascii', errors='replace')
+    characters = numpy.frombuffer(rows_bytes, dtype=numpy.uint8).reshape(len(rows), columns_number)
+    states = characters_to_states_lookup[characters]
+    if numpy.any(states == UNKNOWN_STATE):
+        raise ValueError('The wafer contains characters that are not chip states.')
+    return states
+
+
+def states_to_text(states):
+    """
+    Turn states array into wafer text, rows are separated by new lines.
+    :param states: 2D states array.
+    :return: the wafer as text.
+    """
+    characters = states_to_characters_lookup[states]
+    new_lines_column = numpy.full((states.shape[0], 1), ord('\n'), dtype=numpy.uint8)
+    text_bytes = numpy.concatenate([characters, new_lines_column], axis=1).tobytes()
+    return text_bytes.decode('ascii')[:-1]
+
+
+def count_neighbors(mask):
+    """
+    Count for every cell how many of its 8 neighbors are marked in mask.
+    This is the 3x3 sliding window sum without the cell itself, computed
+    as a vertical 3 window followed by a horizontal 3 window.
+    Works on the two last axes, so stack of wafers is supported as well.
+    :param mask: boolean array, the last two axes are rows and columns.
+    :return: uint8 array with the same shape as mask.
+    """
+    mask_as_numbers = mask.astype(numpy.uint8)
+    padding = [(0, 0)] * (mask.ndim - 2) + [(1, 1), (1, 1)]
+    padded = numpy.pad(mask_as_numbers, padding)
+    vertical_sum = padded[..., :-2, :] + padded[..., 1:-1, :] + padded[..., 2:, :]
+    window_sum = vertical_sum[..., :-2] + vertical_sum[..., 1:-1] + vertical_sum[..., 2:]
+    return window_sum - mask_as_numbers
+
+
+def make_thresholds_lookup(neighbors_table):
+    """
+    Turn the neighbors threshold dict into array indexed by number of neighbors.
+    :param neighbors_table: dict of number of neighbors to threshold.
+    :return: array such that lookup[number_of_neighbors] is the threshold.
+    """
+    return numpy.array([neighbors_table[neighbors_number] for neighbors_number in range(MAX_NEIGHBORS_NUMBER + 1)])
+
+
+def classify_states(states, thresholds_lookup):
+    """
+    Mark as failed by prediction every passed chip that the number of its failed
+    neighbors is bigger than or equals to the threshold of its number of neighbors.
+    :param states: states array (or stack of states arrays).
+    :param thresholds_lookup: array from make_thresholds_lookup.
+    :return: new states array with FAIL_BY_PREDICTION marks.
+    """
+    neighbors_counts = count_neighbors(states != NOT_EXISTS)
+    fail_neighbors_counts = count_neighbors(states == FAIL)
+    is_predicted_fail = (states == PASS) & (fail_neighbors_counts >= thresholds_lookup[neighbors_counts])
+    result_states = states.copy()
+    result_states[is_predicted_fail] = FAIL_BY_PREDICTION
+    return result_states
+
+
+def propagate_fails(states, thresholds_lookup, max_rounds=0):
+    """
+    Classify in rounds until no chip changes, where the chips failed by prediction count as failed neighbors.
+    The first round is the same as classify_states, every later round checks only the passed neighbors
+    of the chips that were failed in the round before it (the frontier), and adds the new fails into the
+    failed neighbors counts of their neighbors instead of counting again.
+    :param states: states array (or stack of states arrays).
+    :param thresholds_lookup: array from make_thresholds_lookup.
+    :param max_rounds: stop after this number of rounds, 0 for no limit.
+    :return: new states array with FAIL_BY_PREDICTION marks and list of the number of new fails in each round.
+    """
+    # with not existing border, the flat neighbors of every chip are inside its own wafer
+    padding = [(0, 0)] * (states.ndim - 2) + [(1, 1), (1, 1)]
+    padded_states = numpy.pad(states, padding)
+    flat_states = padded_states.reshape(-1)
+    thresholds = thresholds_lookup[count_neighbors(padded_states != NOT_EXISTS)].reshape(-1)
+    fail_neighbors_counts = count_neighbors(padded_states == FAIL).reshape(-1)
+    columns_number = padded_states.shape[-1]
+    neighbors_offsets = numpy.array([delta_rows * columns_number + delta_columns for delta_rows in (-1, 0, 1)
+                                     for delta_columns in (-1, 0, 1) if (delta_rows, delta_columns) != (0, 0)])
+    candidates = numpy.flatnonzero(flat_states == PASS)
+    flips_per_round = list()
+    while candidates.size > 0 and (max_rounds == 0 or len(flips_per_round) < max_rounds):
+        flipped = candidates[fail_neighbors_counts[candidates] >= thresholds[candidates]]
+        if flipped.size == 0:
+            break
+        flat_states[flipped] = FAIL_BY_PREDICTION
+        flips_per_round.append(int(flipped.size))
+        flipped_neighbors = (flipped[:, numpy.newaxis] + neighbors_offsets).reshape(-1)
+        numpy.add.at(fail_neighbors_counts, flipped_neighbors, 1)
+        candidates = numpy.unique(flipped_neighbors)
+        candidates = candidates[flat_states[candidates] == PASS]
+    return padded_states[..., 1:-1, 1:-1].copy(), flips_per_round
+
+
+def reclassify_changed_chips(output_states, rows, columns, new_states, thresholds_lookup):
+    """
+    Change the input states of few chips of classified wafer and classify again only the 3x3 neighborhoods
+    of the changed chips, which are the only chips whose result can change.
+    :param output_states: states array after the algorithm, updated in place.
+    :param rows: rows of the changed chips.
+    :param columns: columns of the changed chips.
+    :param new_states: the new input state of each changed chip (NOT_EXISTS, PASS or FAIL).
+    :param thresholds_lookup: array from make_thresholds_lookup.
+    :return: rows, columns, previous states and new states of the chips that changed in output_states.
+    """
+    rows, columns, new_states = (numpy.asarray(values, dtype=numpy.intp) for values in (rows, columns, new_states))
+    rows_number, columns_number = output_states.shape
+    if numpy.any((new_states < NOT_EXISTS) | (new_states > FAIL)):
+        raise ValueError('The new states of the chips must be not exists, pass or fail.')
+    if numpy.any((rows < 0) | (rows >= rows_number) | (columns < 0) | (columns >= columns_number)):
+        raise ValueError(f'The changed chips must be inside the wafer of {rows_number}x{columns_number} chips.')
+    window_offsets = [(delta_rows, delta_columns) for delta_rows in (-1, 0, 1) for delta_columns in (-1, 0, 1)]
+    window_rows = (rows[:, numpy.newaxis] + [delta_rows for delta_rows, _ in window_offsets]).reshape(-1)
+    window_columns = (columns[:, numpy.newaxis] + [delta_columns for _, delta_columns in window_offsets]).reshape(-1)
+    is_inside = (0 <= window_rows) & (window_rows < rows_number) & (0 <= window_columns) & \
+                (window_columns < columns_number)
+    affected_rows, affected_columns = numpy.divmod(
+        numpy.unique(window_rows[is_inside] * columns_number + window_columns[is_inside]), columns_number)
+    previous_states = output_states[affected_rows, affected_columns]
+    output_states[rows, columns] = new_states
+    neighbors_counts = numpy.zeros(affected_rows.size, dtype=numpy.intp)
+    fail_neighbors_counts = numpy.zeros(affected_rows.size, dtype=numpy.intp)
+    for delta_rows, delta_columns in window_offsets:
+        if delta_rows == delta_columns == 0:
+            continue
+        neighbor_rows, neighbor_columns = affected_rows + delta_rows, affected_columns + delta_columns
+        is_inside = (0 <= neighbor_rows) & (neighbor_rows < rows_number) & (0 <= neighbor_columns) & \
+                    (neighbor_columns < columns_number)
+        neighbor_states = numpy.where(is_inside, output_states[neighbor_rows.clip(0, rows_number - 1),
+                                                               neighbor_columns.clip(0, columns_number - 1)],
+                                      NOT_EXISTS)
+        neighbors_counts += neighbor_states != NOT_EXISTS
+        fail_neighbors_counts += neighbor_states == FAIL
+    current_states = output_states[affected_rows, affected_columns]
+    is_input_pass = (current_states == PASS) | (current_states == FAIL_BY_PREDICTION)
+    is_predicted_fail = fail_neighbors_counts >= thresholds_lookup[neighbors_counts]
+    new_output_states = numpy.where(is_input_pass, numpy.where(is_predicted_fail, FAIL_BY_PREDICTION, PASS),
+                                    current_states).astype(output_states.dtype)
+    output_states[affected_rows, affected_columns] = new_output_states
+    is_changed = previous_states != new_output_states
+    return (affected_rows[is_changed], affected_columns[is_changed], previous_states[is_changed],
+            new_output_states[is_changed])
+
+
+def find_input_changes(output_states, new_input_states):
+    """
+    :param output_states: states array after the algorithm.
+    :param new_input_states: states array of new input of the same wafer (for example retest map), chips that
+     do not exist in it were not tested again and keep their states.
+    :return: rows, columns and new states of the chips whose input state changed.
+    """
+    if output_states.shape != new_input_states.shape:
+        raise ValueError(f'The new wafer is {new_input_states.shape[0]}x{new_input_states.shape[1]} chips while the '
+                         f'result is {output_states.shape[0]}x{output_states.shape[1]} chips.')
+    input_states = numpy.where(output_states == FAIL_BY_PREDICTION, PASS, output_states)
+    rows, columns = numpy.nonzero((new_input_states != NOT_EXISTS) & (input_states != new_input_states))
+    return rows, columns, new_input_states[rows, columns]
+
+
+def find_retest_changes(output_states, rows, columns, are_failed):
+    """
+    Merge parts results of retest on the result by their coordinates, the last test of a chip wins.
+    :param output_states: states array after the algorithm.
+    :param rows: rows of the tested parts (Y_COORD, as in the result).
+    :param columns: columns of the tested parts (X_COORD, as in the result).
+    :param are_failed: boolean array of the result of each test.
+    :return: rows, columns and new states of the chips whose input state changed.
+    """
+    rows, columns = numpy.asarray(rows, dtype=numpy.intp), numpy.asarray(columns, dtype=numpy.intp)
+    rows_number, columns_number = output_states.shape
+    if numpy.any((rows < 0) | (rows >= rows_number) | (columns < 0) | (columns >= columns_number)):
+        raise ValueError(f'The retest has parts outside of the result wafer of {rows_number}x{columns_number} chips.')
+    _, last_test_indexes = numpy.unique((rows * columns_number + columns)[::-1], return_index=True)
+    last_test_indexes = len(rows) - 1 - last_test_indexes
+    rows, columns = rows[last_test_indexes], columns[last_test_indexes]
+    new_states = numpy.where(numpy.asarray(are_failed)[last_test_indexes], FAIL, PASS).astype(output_states.dtype)
+    input_states = output_states[rows, columns]
+    input_states[input_states == FAIL_BY_PREDICTION] = PASS
+    is_changed = input_states != new_states
+    return rows[is_changed], columns[is_changed], new_states[is_changed]
+
+
+def stack_states(states_list):
+    """
+    Stack states arrays into one (wafers, rows, columns) array, smaller wafers are padded at the end of their
+    rows and columns with not existing chips, which do not change the neighbors of any chip.
+    :param states_list: list of states arrays.
+    :return: uint8 array of shape (wafers, max rows, max columns).
+    """
+    rows_number = max((states.shape[0] for states in states_list), default=0)
+    columns_number = max((states.shape[1] for states in states_list), default=0)
+    stacked_states = numpy.full((len(states_list), rows_number, columns_number), NOT_EXISTS, dtype=numpy.uint8)
+    for wafer_index, states in enumerate(states_list):
+        stacked_states[wafer_index, :states.shape[0], :states.shape[1]] = states
+    return stacked_states
+
+
+def count_fails_per_position(output_states):
+    """
+    :param output_states: stack of states arrays after the algorithm.
+    :return: (rows, columns) arrays of the number of wafers in which the position exists, is failed
+             and is failed by prediction.
+    """
+    existing_counts = numpy.count_nonzero(output_states != NOT_EXISTS, axis=0)
+    fail_counts = numpy.count_nonzero(output_states == FAIL, axis=0)
+    predicted_fail_counts = numpy.count_nonzero(output_states == FAIL_BY_PREDICTION, axis=0)
+    return existing_counts, fail_counts, predicted_fail_counts
+
+
+def summarize_states(input_states, output_states):
+    """
+    Count every state before and after the algorithm and find the changed chips, in one pass.
+    :param input_states: states array of the input wafer.
+    :param output_states: states array after the algorithm, same shape.
+    :return: input states counts, output states counts (both indexed by state code)
+             and the (rows, columns) arrays of the chips that changed, ordered by rows.
+    """
+    states_number = len(STATES_CHARACTERS)
+    pairs_codes = input_states.astype(numpy.intp) * states_number + output_states
+    pairs_counts = numpy.bincount(pairs_codes.ravel(), minlength=states_number ** 2)
+    pairs_counts = pairs_counts.reshape(states_number, states_number)
+    input_counts, output_counts = pairs_counts.sum(axis=1), pairs_counts.sum(axis=0)
+    difference_coordinates = numpy.nonzero(input_states != output_states)
+    return input_counts, output_counts, difference_coordinates
+
+
+def make_neighbors_histogram(states):
+    """
+    Count the passed chips by their (number of neighbors, number of failed neighbors).
+    The counts do not depend on the thresholds, so any number of tables can be applied on them.
+    :return: array of shape (9, 10) such that histogram[n, f] is the number of passed chips
+             with n neighbors and at least f failed neighbors.
+    """
+    is_pass = states == PASS
+    neighbors_counts = count_neighbors(states != NOT_EXISTS)[is_pass].astype(numpy.intp)
+    fail_neighbors_counts = count_neighbors(states == FAIL)[is_pass].astype(numpy.intp)
+    bins_number = MAX_NEIGHBORS_NUMBER + 1
+    pairs_counts = numpy.bincount(neighbors_counts * bins_number + fail_neighbors_counts,
+                                  minlength=bins_number ** 2).reshape(bins_number, bins_number)
+    at_least_counts = numpy.zeros((bins_number, bins_number + 1), dtype=numpy.int64)
+    at_least_counts[:, :-1] = numpy.cumsum(pairs_counts[:, ::-1], axis=1)[:, ::-1]
+    return at_least_counts
+
+
+def sweep_thresholds(states, thresholds_lookups):
+    """
+    Number of new fails for each thresholds table, counting the neighbors only once.
+    :param states: states array of the wafer.
+    :param thresholds_lookups: array of shape (tables, 9), one row from make_thresholds_lookup per table.
+    :return: array with the number of chips failed by prediction per table.
+    """
+    at_least_counts = make_neighbors_histogram(states)
+    # the failed neighbors counts are integers, so reaching threshold of 2.5 is having at least 3
+    integer_thresholds = numpy.ceil(thresholds_lookups).astype(numpy.intp)
+    clipped_thresholds = numpy.clip(integer_thresholds, 0, MAX_NEIGHBORS_NUMBER + 1)
+    neighbors_numbers = numpy.arange(MAX_NEIGHBORS_NUMBER + 1)
+    return at_least_counts[neighbors_numbers, clipped_thresholds].sum(axis=1)
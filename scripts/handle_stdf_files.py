@@ -0,0 +1,311 @@
+"""
+Streaming reader of the parts results from STDF V4 files.
+link for documentation : http://www.kanwoda.com/wp-content/uploads/2015/05/std-spec.pdf
+
+Every record starts with a 4 bytes header:
+REC_LEN (U2, length of the record without the header) | REC_TYP (U1) | REC_SUB (U1)
+Only the PRR (Part Results Record, page 41) is decoded, all the other records are skipped by their length.
+Files with many wafers have a section from WIR (Wafer Information Record) to WRR (Wafer Results Record) per wafer,
+the sections offsets are found from the records headers only and saved in index file next to the STDF file,
+so every wafer can be decoded alone (see read_wafer_sections).
+"""
+import json
+import logging
+import mmap
+import os
+import re
+import struct
+import uuid
+from array import array
+from collections import namedtuple
+
+import numpy
+
+import grid_algorithm
+
+FAR_RECORD_TYPE = (0, 10)
+WIR_RECORD_TYPE = (2, 10)
+WRR_RECORD_TYPE = (2, 20)
+PRR_RECORD_TYPE = (5, 20)
+RECORD_HEADER_SIZE = 4
+MISSING_COORDINATE = -32768
+# offsets inside the PRR body: HEAD_NUM U1, SITE_NUM U1, PART_FLG B1, NUM_TEST U2, HARD_BIN U2, SOFT_BIN U2,
+# X_COORD I2, Y_COORD I2
+PART_FLAG_OFFSET = 2
+COORDINATES_OFFSET = 9
+FAIL_BIT = 8
+# offset of WAFER_ID (C*n) inside the WIR body: HEAD_NUM U1, SITE_GRP U1, START_T U4
+WAFER_ID_OFFSET = 6
+INDEX_SUFFIX = '.wafers.json'
+INDEX_FORMAT_VERSION = 1
+
+logger = logging.getLogger('ChipProductionLogger')
+
+WaferSection = namedtuple('WaferSection', ['wafer_id', 'start_offset', 'end_offset'])
+
+
+def get_byte_order(stdf_content):
+    """
+    The first record is always FAR with REC_LEN = 2, so its first two bytes
+    tell whether the file was written as little endian or big endian.
+    :param stdf_content: the bytes of the file.
+    :return: struct byte order character.
+    """
+    if stdf_content[:2] == b'\x02\x00':
+        return '<'
+    if stdf_content[:2] == b'\x00\x02':
+        return '>'
+    raise ValueError('The file is not STDF file, it does not start with FAR record.')
+
+
+def iterate_records_headers(stdf_content, start_offset=0, end_offset=None):
+    """
+    Walk over the records headers without decoding the records themselves.
+    :param stdf_content: the bytes of the file (bytes, mmap or memoryview).
+    :param start_offset: offset of the first record header to read.
+    :param end_offset: offset to stop at, the end of the content by default.
+    :return: generator of (record_type, record_sub_type, body_offset, body_length).
+    :raise ValueError: when the last record is cut (half copied file).
+    """
+    header_struct = struct.Struct(f'{get_byte_order(stdf_content)}HBB')
+    end_offset = len(stdf_content) if end_offset is None else end_offset
+    offset = start_offset
+    while offset < end_offset:
+        if offset + RECORD_HEADER_SIZE > end_offset:
+            raise ValueError(f'The STDF file is truncated, the record header at offset {offset} is cut.')
+        body_length, record_type, record_sub_type = header_struct.unpack_from(stdf_content, offset)
+        body_offset = offset + RECORD_HEADER_SIZE
+        if body_offset + body_length > end_offset:
+            raise ValueError(f'The STDF file is truncated, the record at offset {offset} is cut.')
+        yield record_type, record_sub_type, body_offset, body_length
+        offset = body_offset + body_length
+
+
+def read_parts_results(stdf_content, start_offset=0, end_offset=None):
+    """
+    Collect the coordinates and the pass/fail bit of every PRR.
+    PART_FLG bit 3 is 0 when the part passed and 1 when the part failed.
+    Parts with missing coordinates are ignored.
+    :return: rows, columns and is_failed arrays, one item per tested part.
+    """
+    byte_order = get_byte_order(stdf_content)
+    coordinates_struct = struct.Struct(f'{byte_order}hh')
+    rows, columns, are_failed = array('h'), array('h'), array('B')
+    for record_type, record_sub_type, body_offset, body_length in iterate_records_headers(stdf_content,
+                                                                                          start_offset, end_offset):
+        if (record_type, record_sub_type) != PRR_RECORD_TYPE or body_length < COORDINATES_OFFSET + 4:
+            continue
+        column, row = coordinates_struct.unpack_from(stdf_content, body_offset + COORDINATES_OFFSET)
+        if row == MISSING_COORDINATE or column == MISSING_COORDINATE:
+            continue
+        rows.append(row)
+        columns.append(column)
+        are_failed.append(stdf_content[body_offset + PART_FLAG_OFFSET] & FAIL_BIT)
+    return numpy.frombuffer(rows, dtype=numpy.int16), numpy.frombuffer(columns, dtype=numpy.int16), \
+        numpy.frombuffer(are_failed, dtype=numpy.uint8) != 0
+
+
+def make_states_array(rows, columns, are_failed):
+    """
+    Put the parts results into a coordinate indexed states array.
+    A chip that was tested more than once is failed if any of its tests failed,
+    i.e the last fail wins over passing retests.
+    Places without parts are NOT_EXISTS.
+    :return: uint8 states array, row index is Y_COORD and column index is X_COORD.
+    """
+    if len(rows) == 0:
+        raise ValueError('The STDF file contains no parts results.')
+    rows = rows.astype(numpy.intp) - min(int(rows.min()), 0)
+    columns = columns.astype(numpy.intp) - min(int(columns.min()), 0)
+    states = numpy.full((rows.max() + 1, columns.max() + 1), grid_algorithm.NOT_EXISTS, dtype=numpy.uint8)
+    parts_states = numpy.where(are_failed, grid_algorithm.FAIL, grid_algorithm.PASS).astype(numpy.uint8)
+    numpy.maximum.at(states, (rows, columns), parts_states)
+    return states
+
+
+def read_stdf_states(stdf_path):
+    """
+    Read STDF file into states array in one streaming pass over its records.
+    :param stdf_path: path of .stdf file.
+    :return: uint8 states array.
+    """
+    with open(stdf_path, 'rb') as stdf_file, mmap.mmap(stdf_file.fileno(), 0, access=mmap.ACCESS_READ) as content:
+        return read_stdf_states_from_content(content)
+
+
+def read_stdf_states_from_content(content):
+    """
+    :param content: bytes like object with the STDF file content.
+    :return: uint8 states array.
+    """
+    rows, columns, are_failed = read_parts_results(content)
+    return make_states_array(rows, columns, are_failed)
+
+
+def read_wafer_id(stdf_content, body_offset, body_length):
+    if body_length <= WAFER_ID_OFFSET:
+        return ''
+    id_offset = body_offset + WAFER_ID_OFFSET + 1
+    id_end_offset = min(id_offset + stdf_content[body_offset + WAFER_ID_OFFSET], body_offset + body_length)
+    return bytes(stdf_content[id_offset: id_end_offset]).decode('ascii', errors='replace')
+
+
+def name_wafer_sections(sections):
+    """
+    Make the wafer IDs usable as unique file names, wafers without ID are named by their order in the file
+    and repeated IDs get their number of repeat.
+    """
+    named_sections, used_names = list(), set()
+    for section_number, section in enumerate(sections, start=1):
+        name = re.sub(r'[^\w.-]', '_', section.wafer_id) or f'wafer_{section_number}'
+        unique_name, repeat_number = name, 1
+        while unique_name in used_names:
+            repeat_number += 1
+            unique_name = f'{name}_{repeat_number}'
+        used_names.add(unique_name)
+        named_sections.append(section._replace(wafer_id=unique_name))
+    return named_sections
+
+
+def index_wafer_sections(stdf_content):
+    """
+    Find the wafer sections in one pass over the records headers.
+    A section starts at the header of its WIR and ends after its WRR, or at the next WIR (or the end of the file)
+    when the WRR is missing. Parts results outside of the sections belong to no wafer, they are counted and
+    reported in the log.
+    :param stdf_content: the bytes of the file.
+    :return: list of WaferSection in the order of the file, empty when the file has no WIR.
+    """
+    sections = list()
+    wafer_id, start_offset = None, None
+    outside_parts_number = 0
+    for record_type, record_sub_type, body_offset, body_length in iterate_records_headers(stdf_content):
+        if (record_type, record_sub_type) == PRR_RECORD_TYPE:
+            outside_parts_number += start_offset is None
+        elif (record_type, record_sub_type) == WIR_RECORD_TYPE:
+            if start_offset is not None:
+                sections.append(WaferSection(wafer_id, start_offset, body_offset - RECORD_HEADER_SIZE))
+            wafer_id = read_wafer_id(stdf_content, body_offset, body_length)
+            start_offset = body_offset - RECORD_HEADER_SIZE
+        elif (record_type, record_sub_type) == WRR_RECORD_TYPE and start_offset is not None:
+            sections.append(WaferSection(wafer_id, start_offset, body_offset + body_length))
+            start_offset = None
+    if start_offset is not None:
+        sections.append(WaferSection(wafer_id, start_offset, len(stdf_content)))
+    if sections and outside_parts_number:
+        logger.warning(f'{outside_parts_number} parts results are outside of the {len(sections)} wafer sections, '
+                       f'they are ignored when the wafers are read one by one.')
+    return name_wafer_sections(sections)
+
+
+def get_index_path(stdf_path):
+    return stdf_path.with_name(f'{stdf_path.name}{INDEX_SUFFIX}')
+
+
+def read_wafer_sections(stdf_path):
+    """
+    Read the wafer sections of STDF file from its index file, the index is valid only for the same file size
+    and modification time. Otherwise the file is scanned, and the index is saved for the next times when the file
+    has many wafers (files of one wafer are read whole, they do not need the index).
+    :param stdf_path: path of .stdf file.
+    :return: list of WaferSection.
+    """
+    file_status = stdf_path.stat()
+    file_signature = {'format_version': INDEX_FORMAT_VERSION, 'size': file_status.st_size,
+                      'modification_time': file_status.st_mtime_ns}
+    index_path = get_index_path(stdf_path)
+    try:
+        with open(index_path) as index_file:
+            index = json.load(index_file)
+        if all(index.get(key) == value for key, value in file_signature.items()):
+            return [WaferSection(*section) for section in index['sections']]
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    with open(stdf_path, 'rb') as stdf_file, mmap.mmap(stdf_file.fileno(), 0, access=mmap.ACCESS_READ) as content:
+        sections = index_wafer_sections(content)
+    if len(sections) <= 1:
+        return sections
+    temporary_path = index_path.with_name(f'{index_path.name}.{uuid.uuid4().hex}.tmp')
+    try:
+        with open(temporary_path, 'w') as index_file:
+            json.dump(dict(file_signature, sections=sections), index_file)
+        os.replace(temporary_path, index_path)
+    except OSError:  # read only directory, the file is scanned again the next time
+        pass
+    return sections
+
+
+def read_stdf_parts(stdf_path, wafer_id=None, content=None):
+    """
+    :param wafer_id: read only the section of this wafer (as in read_wafer_sections), None for the whole file.
+    :param content: the bytes of the file when it was already read, the file is mapped otherwise.
+    :return: rows, columns and is_failed arrays of the parts results, as in read_parts_results.
+    """
+    start_offset, end_offset = 0, None
+    if wafer_id is not None:
+        sections = {section.wafer_id: section for section in read_wafer_sections(stdf_path)}
+        if wafer_id not in sections:
+            raise ValueError(f'The STDF file has no wafer {wafer_id}, its wafers are: {", ".join(sections)}.')
+        start_offset, end_offset = sections[wafer_id].start_offset, sections[wafer_id].end_offset
+    if content is not None:
+        return read_parts_results(content, start_offset, end_offset)
+    with open(stdf_path, 'rb') as stdf_file, mmap.mmap(stdf_file.fileno(), 0, access=mmap.ACCESS_READ) as content:
+        return read_parts_results(content, start_offset, end_offset)
+
+
+def read_stdf_wafer_states(stdf_path, wafer_id, content=None):
+    """
+    Read one wafer of STDF file with many wafers, decoding only the records of its section.
+    :param wafer_id: the wafer ID of the section, as in read_wafer_sections.
+    :param content: the bytes of the file when it was already read.
+    :return: uint8 states array.
+    """
+    return make_states_array(*read_stdf_parts(stdf_path, wafer_id, content))
+
+
+def make_record(record_type, body, byte_order='<'):
+    record_type, record_sub_type = record_type
+    return struct.pack(f'{byte_order}HBB', len(body), record_type, record_sub_type) + body
+
+
+def make_stdf_content(parts, byte_order='<'):
+    """
+    Make minimal STDF content, FAR followed by one PRR per part.
+    Used for generating test wafers.
+    :param parts: iterable of (row, column, is_failed).
+    :return: the file content as bytes.
+    """
+    return make_far_record(byte_order) + make_parts_records(parts, byte_order)
+
+
+def make_multi_wafer_stdf_content(wafers, byte_order='<'):
+    """
+    Make minimal STDF content with many wafers, FAR followed by WIR, PRR per part and WRR for every wafer.
+    :param wafers: iterable of (wafer_id, parts), parts as in make_stdf_content.
+    :return: the file content as bytes.
+    """
+    records = [make_far_record(byte_order)]
+    for wafer_id, parts in wafers:
+        wafer_id_field = bytes([len(wafer_id)]) + wafer_id.encode('ascii')
+        records.append(make_record(WIR_RECORD_TYPE, struct.pack(f'{byte_order}BBI', 1, 255, 0) + wafer_id_field,
+                                   byte_order))
+        records.append(make_parts_records(parts, byte_order))
+        parts_number = len(parts)
+        wrr_body = struct.pack(f'{byte_order}BBIIIIII', 1, 255, 0, parts_number, 0, 0, 0, 0) + wafer_id_field
+        records.append(make_record(WRR_RECORD_TYPE, wrr_body, byte_order))
+    return b''.join(records)
+
+
+def make_far_record(byte_order='<'):
+    cpu_type = 2 if byte_order == '<' else 1
+    return make_record(FAR_RECORD_TYPE, struct.pack('BB', cpu_type, 4), byte_order)
+
+
+def make_parts_records(parts, byte_order='<'):
+    records = list()
+    prr_struct = struct.Struct(f'{byte_order}BBBHHHhh')
+    for row, column, is_failed in parts:
+        part_flag = FAIL_BIT if is_failed else 0
+        prr_body = prr_struct.pack(1, 1, part_flag, 0, 0 if is_failed else 1, 0 if is_failed else 1, column, row)
+        records.append(make_record(PRR_RECORD_TYPE, prr_body, byte_order))
+    return b''.join(records)
@@ -0,0 +1,73 @@
+"""
+Timing and memory records of the stages of handling wafers.
+Each record is one JSON line: wafer, stage, wall time, CPU time, peak RSS of the process so far (not of the stage)
+and traced memory peak of the stage.
+"""
+import json
+import os
+import time
+import tracemalloc
+import warnings
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+def get_process_peak_rss_kb():
+    """
+    :return: the peak resident set size of this process since it started in KB (so of all the stages before too),
+             None when it is not supported.
+    """
+    if resource is None:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in KB on Linux
+    return peak_rss // 1024 if os.uname().sysname == 'Darwin' else peak_rss
+
+
+class StagesRecorder:
+    def __init__(self, wafer_name, is_tracing_memory=False):
+        self.wafer_name = wafer_name
+        self.is_tracing_memory = is_tracing_memory
+        self.records = list()
+        if is_tracing_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if is_tracing_memory and not hasattr(tracemalloc, 'reset_peak'):
+            # the warnings filter shows it once
+            warnings.warn('tracemalloc.reset_peak needs Python 3.9, the traced peak of every stage is the peak since '
+                          'tracing started.', RuntimeWarning)
+
+    @contextmanager
+    def stage(self, stage_name):
+        if self.is_tracing_memory and hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        start_wall_time, start_cpu_time = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            record = {'timestamp': datetime.now().isoformat(timespec='milliseconds'), 'pid': os.getpid(),
+                      'wafer': self.wafer_name, 'stage': stage_name,
+                      'wall_seconds': round(time.perf_counter() - start_wall_time, 6),
+                      'cpu_seconds': round(time.process_time() - start_cpu_time, 6),
+                      'process_peak_rss_kb': get_process_peak_rss_kb()}
+            if self.is_tracing_memory:
+                record['traced_peak_bytes'] = tracemalloc.get_traced_memory()[1]
+            self.records.append(record)
+
+    def summary_columns(self):
+        """
+        :return: dict of stage name to its wall time, for adding to the summary row.
+        """
+        return {f'{record["stage"]}_seconds': record['wall_seconds'] for record in self.records}
+
+    def write(self, records_path):
+        """
+        Append the records as JSON lines, in one write so processes of the same run do not mix lines.
+        """
+        records_lines = ''.join(json.dumps(record) + '\n' for record in self.records)
+        with open(records_path, 'a') as records_file:
+            records_file.write(records_lines)
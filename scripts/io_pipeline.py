@@ -0,0 +1,101 @@
+"""
+Overlapping the file I/O of directory runs with the classification:
+input files are read ahead into memory by background threads and parsed from there (so slow network shares are
+read while the previous wafers are classified), and results are written by background threads while the next
+wafers are classified.
+Both are bounded, the writer blocks new writes while too many are pending (backpressure).
+"""
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger('ChipProductionLogger')
+
+
+def run_now(function, *arguments):
+    return function(*arguments)
+
+
+def read_file_ahead(path):
+    """
+    :return: the content of the file, None when it can not be read (the error is reported when it is handled).
+    """
+    try:
+        with open(path, 'rb') as file:
+            return file.read()
+    except OSError:
+        return None
+
+
+class FilesPrefetcher:
+    def __init__(self, paths, read_ahead, threads_number):
+        self.paths = list(paths)
+        self.read_ahead = read_ahead
+        self.executor = ThreadPoolExecutor(max_workers=threads_number, thread_name_prefix='prefetch')
+        self.next_index = 0
+        self.futures = dict()  # index of file -> future of its content
+
+    def advance(self, first_unread_index):
+        """
+        Read ahead the files from first_unread_index on, up to read_ahead files.
+        :param first_unread_index: index of the first file that nobody started reading yet.
+        """
+        self.next_index = max(self.next_index, first_unread_index)
+        while self.next_index < min(len(self.paths), first_unread_index + self.read_ahead):
+            self.futures[self.next_index] = self.executor.submit(read_file_ahead, self.paths[self.next_index])
+            self.next_index += 1
+
+    def take(self, index):
+        """
+        :return: the content of the file of index (waits for its reading), None when it was not read ahead.
+         The content is not kept after it was taken.
+        """
+        future = self.futures.pop(index, None)
+        return future.result() if future is not None else None
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.futures.clear()
+
+
+class BackgroundWriter:
+    def __init__(self, threads_number, max_pending_writes=None):
+        self.executor = ThreadPoolExecutor(max_workers=threads_number, thread_name_prefix='writer')
+        self.free_slots = threading.BoundedSemaphore(max_pending_writes or 4 * threads_number)
+        self.futures = list()
+
+    def submit(self, function, *arguments):
+        """
+        Run function(*arguments) in a writer thread, blocks while the maximum number of writes are pending.
+        """
+        self.free_slots.acquire()
+        future = self.executor.submit(function, *arguments)
+        future.add_done_callback(lambda _: self.free_slots.release())
+        self.futures.append(future)
+        return future
+
+    def take_futures(self):
+        """
+        :return: the futures of the writes that were submitted since the last call, for checking them per file.
+         They are not checked by wait anymore.
+        """
+        futures, self.futures = self.futures, list()
+        return futures
+
+    def wait(self):
+        """
+        Wait for all the pending writes.
+        :return: number of failed writes, they are logged.
+        """
+        failed_writes_number = 0
+        for future in self.futures:
+            if future.exception() is not None:
+                logger.error(f'Failed writing results: {future.exception()}')
+                failed_writes_number += 1
+        self.futures.clear()
+        return failed_writes_number
+
+    def close(self):
+        failed_writes_number = self.wait()
+        self.executor.shutdown(wait=True)
+        return failed_writes_number
@@ -0,0 +1,63 @@
+"""
+Lot level stacked wafer map: running counters per chip position of the wafers of a lot,
+updated with every result wafer as soon as it is ready, so no result file is read again.
+"""
+import numpy
+
+import grid_algorithm
+
+
+class LotMapAccumulator:
+    def __init__(self):
+        self.wafers_number = 0
+        # existing, failed and failed by prediction counts per chip position
+        self.counters = numpy.zeros((3, 0, 0), dtype=numpy.int64)
+
+    def add_wafer(self, output_states):
+        """
+        :param output_states: states array of a wafer after the algorithm, wafers may have different shapes.
+        """
+        rows_number, columns_number = output_states.shape
+        if rows_number > self.counters.shape[1] or columns_number > self.counters.shape[2]:
+            counters = numpy.zeros((3, max(rows_number, self.counters.shape[1]),
+                                    max(columns_number, self.counters.shape[2])), dtype=numpy.int64)
+            counters[:, :self.counters.shape[1], :self.counters.shape[2]] = self.counters
+            self.counters = counters
+        wafer_counts = grid_algorithm.count_fails_per_position(output_states[numpy.newaxis])
+        self.counters[:, :rows_number, :columns_number] += numpy.stack(wafer_counts)
+        self.wafers_number += 1
+
+    @property
+    def existing_counts(self):
+        return self.counters[0]
+
+    @property
+    def fail_counts(self):
+        return self.counters[1]
+
+    @property
+    def predicted_fail_counts(self):
+        return self.counters[2]
+
+    @property
+    def fail_frequency(self):
+        """
+        :return: the part of the wafers in which each chip position failed (by test or by prediction),
+                 out of the wafers in which it exists.
+        """
+        return (self.fail_counts + self.predicted_fail_counts) / numpy.maximum(self.existing_counts, 1)
+
+    def save(self, path_without_suffix):
+        """
+        Save the counters and the fail frequency as .npz arrays and the fail frequency heatmap as .png image.
+        :return: the paths of the arrays and of the image.
+        """
+        import wafer_raster
+        arrays_path = path_without_suffix.with_name(f'{path_without_suffix.name}.npz')
+        numpy.savez_compressed(arrays_path, existing_counts=self.existing_counts, fail_counts=self.fail_counts,
+                               predicted_fail_counts=self.predicted_fail_counts, fail_frequency=self.fail_frequency,
+                               wafers_number=self.wafers_number)
+        image_path = path_without_suffix.with_name(f'{path_without_suffix.name}.png')
+        cells_colors = wafer_raster.make_heatmap_colors(self.fail_frequency, self.existing_counts > 0)
+        wafer_raster.make_map_image(cells_colors).save(image_path)
+        return arrays_path, image_path
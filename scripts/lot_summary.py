@@ -0,0 +1,81 @@
+import csv
+import importlib.util
+
+fieldnames = ['File_name', 'Total_chips', 'Initially_failed', 'Initially_passed', 'Failed_by_prediction',
+              'Total_failed', 'Total_passed', 'Difference_coordinates']
+supported_formats = ['xlsx', 'csv', 'parquet']
+formats_engines = {'xlsx': ['openpyxl'], 'parquet': ['pyarrow', 'fastparquet']}  # any one of them is enough
+
+
+def check_format_packages(summary_format):
+    """
+    Check that the packages for writing summary_format are installed, before handling any wafer.
+    :raise ValueError: when they are missing.
+    """
+    if summary_format == 'csv':
+        return
+    engines = formats_engines.get(summary_format, [])
+    if importlib.util.find_spec('pandas') is None or \
+            (engines and all(importlib.util.find_spec(engine) is None for engine in engines)):
+        raise ValueError(f'The summary format {summary_format} needs pandas and {" or ".join(engines)}, '
+                         f'install them or choose other summary format.')
+
+
+class SummaryAccumulator:
+    """
+    Collect the summary row of each wafer as soon as it is produced,
+    and write all of them once at the end.
+    """
+
+    def __init__(self, rows=None, columns=None):
+        """
+        :param rows: initial summary rows.
+        :param columns: the columns of the summary, by default the standard fieldnames and any other key of the rows.
+        """
+        self.rows = list(rows) if rows is not None else list()
+        self.fixed_columns = columns
+
+    def add_row(self, summary_row):
+        self.rows.append(summary_row)
+
+    def extend(self, summary_rows):
+        self.rows.extend(summary_rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+    @property
+    def columns(self):
+        if self.fixed_columns is not None:
+            return list(self.fixed_columns)
+        extra_columns = [column for row in self.rows for column in row if column not in fieldnames]
+        return fieldnames + list(dict.fromkeys(extra_columns))
+
+    def write(self, path_without_suffix, summary_format='xlsx'):
+        """
+        :param path_without_suffix: path of the summary file, the suffix is added by the format.
+        :param summary_format: one of supported_formats.
+        :return: the path of the written file.
+        """
+        summary_path = path_without_suffix.with_name(f'{path_without_suffix.name}.{summary_format}')
+        if summary_format == 'csv':
+            self.write_csv(summary_path)
+        else:
+            self.write_with_pandas(summary_path, summary_format)
+        return summary_path
+
+    def write_csv(self, summary_path):
+        with open(summary_path, 'w', newline='') as summary_file:
+            writer = csv.DictWriter(summary_file, fieldnames=self.columns)
+            writer.writeheader()
+            writer.writerows(self.rows)
+
+    def write_with_pandas(self, summary_path, summary_format):
+        import pandas
+        data_frame = pandas.DataFrame(self.rows, columns=self.columns)
+        if summary_format == 'xlsx':
+            data_frame.to_excel(summary_path, sheet_name='summary', index=False)
+        elif summary_format == 'parquet':
+            data_frame.to_parquet(summary_path, index=False)
+        else:
+            raise ValueError(f'The summary format {summary_format} is not supported.')
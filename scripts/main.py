@@ -1,164 +1,239 @@
+import argparse
 import copy
 import enum
+import functools
+import hashlib
 import json
 import logging
+import os
+import re
+import struct
 import sys
 import warnings
-from collections import Counter
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
 from datetime import datetime
 from itertools import count
 from logging.handlers import RotatingFileHandler
 from pathlib import Path
 from string import Template
 
-import pandas
-from gooey import GooeyParser, Gooey
-from pystdf.IO import Parser
-from pystdf.V4 import prr
+import numpy
 
 import HtmlViewer
+import classification_service
+import geometry_cache
+import grid_algorithm
+import handle_stdf_files
+import instrumentation
+import io_pipeline
+import lot_map
+import lot_summary
+import neighborhood_kernels
+import result_cache
 import utils
+import wafer_map_file
+import watch_mode
 
+numbers = count()
 logger = logging.getLogger('ChipProductionLogger')
 handler = RotatingFileHandler('ChipProductionLogger.log', maxBytes=100_000, backupCount=1)
 logger.addHandler(handler)
 
 
-def parse_file(path_to_read_from):
+def parse_file(path_to_read_from, maps_cache_dir=None, wafer_id=None, content=None):
+    """
+    :param maps_cache_dir: directory of binary wafer maps, when given the wafer is read from the map of the same
+     file content, or parsed and saved as map there for the next times.
+    :param wafer_id: the wafer to read from STDF file with many wafers (see plan_wafers_of_file),
+     None for all the parts of the file.
+    :param content: the bytes of the file when it was already read (see io_pipeline.FilesPrefetcher),
+     the file is read otherwise.
+    """
     type_of_file = path_to_read_from.suffix
-    methods_dict = {'.txt': parse_text_file, '.stdf': parse_stdf_file}
-    return methods_dict[type_of_file](path_to_read_from)
-
-
-def parse_stdf_file(path_to_read_from):
-    expected_grid = None
-
-    class StdfToGrid:
-
-        def after_begin(self):
-            self.chips_set = set()
-
-        def after_send(self, data):
-            """
-            prr: Contains the result information relating to each part tested by the test program.
-            The PRR and the Part Information Record (PIR) bracket all the stored information
-            pertaining to one tested part.
-            i.e it contains the pass or fail data for each chip.
-            link for documentation : http://www.kanwoda.com/wp-content/uploads/2015/05/std-spec.pdf
-            see in the prr section page 41.
-            ----------------------------------------------------------------------------------------
-            X_COORD | are fields of prr Have legal values in the range -32767 to 32767.
-            Y_COORD |  A missing value is indicated by the value -32768.
-            ----------------------------------------------------------------------------------------
-            PART_FLG | is also a field of prr, that contains several bits the three of them
-                     | is indicating pass fail 0 = Part passed 1 = Part failed.
-            """
-            record_type, fields = data
-
-            if record_type == prr:
-                x_coordinate = fields[prr.X_COORD]
-                y_coordinate = fields[prr.Y_COORD]
-                is_fail = StdfToGrid.is_fail_prr(fields)
-                state = 'X' if is_fail else '1'
-                current_chip = Chip(y_coordinate, x_coordinate, state)
-                if current_chip in self.chips_set and current_chip.state == ChipState.FAIL:
-                    self.chips_set.remove(current_chip)
-                self.chips_set.add(current_chip)
-
-        @staticmethod
-        def is_fail_prr(fields):
-            return (fields[prr.PART_FLG] & 8) >> 3
-
-        def after_complete(self):
-            self.grid = StdfToGrid.partition_into_rows(self.chips_set)
-            StdfToGrid.sort_each_chips_row(self.grid)
-            self.grid = StdfToGrid.make_square_from_table(self.grid)
-            self.grid = ChipsGrid.make_chips_grid_from_grid(self.grid)
-            nonlocal expected_grid
-            expected_grid = self.grid
-
-        @staticmethod
-        def partition_into_rows(chips_set):
-            rows_dict = dict()
-            for chip in chips_set:
-                if chip.row not in rows_dict:
-                    rows_dict[chip.row] = list()
-                rows_dict[chip.row].append(chip)
-            # turn the dict into list
-            number_of_rows = max(rows_dict.keys()) + 1
-            grid = [rows_dict[index] for index in range(number_of_rows)]
-            return grid
-
-        @staticmethod
-        def sort_each_chips_row(grid):
-            for chips_row in grid:
-                chips_row.sort(key=lambda chip: chip.column)
-
-        @staticmethod
-        def make_square_from_table(chips_table):
-            max_row_length = max(len(chips_row) for chips_row in chips_table)
-            square_grid = list()
-            for chips_row in chips_table:
-                filled_row = StdfToGrid.fill_row_edges(chips_row, max_row_length)
-                square_grid.append(filled_row)
-            return square_grid
-
-        @staticmethod
-        def fill_row_edges(chips_row, final_length):
-            first_filled_column = chips_row[0].column
-            last_filled_column = chips_row[-1].column
-            row_number = chips_row[0].row
-            row_start = [Chip(row_number, column, '.') for column in range(first_filled_column)]
-            row_end = [Chip(row_number, column, '.') for column in range(last_filled_column + 1, final_length)]
-            return row_start + chips_row + row_end
-
-    with open(path_to_read_from, 'rb') as stdf_file:
-        parser_object = Parser(inp=stdf_file)
-        parser_object.addSink(StdfToGrid)
-        parser_object.parse()
-
-    return expected_grid, Template("$wafer")
-
-
-def parse_text_file(path_to_read_from):
+    methods_dict = {'.txt': functools.partial(parse_text_file, content=content),
+                    '.stdf': functools.partial(parse_stdf_file, wafer_id=wafer_id, content=content)}
+    if maps_cache_dir is None:
+        return methods_dict[type_of_file](path_to_read_from)
+    return parse_file_with_maps_cache(path_to_read_from, maps_cache_dir, methods_dict[type_of_file], wafer_id,
+                                      content)
+
+
+def parse_file_with_maps_cache(path_to_read_from, maps_cache_dir, parse_method, wafer_id=None, content=None):
+    source_hash = wafer_map_file.hash_source(path_to_read_from, content)
+    map_name = source_hash.hex() if wafer_id is None else f'{source_hash.hex()}_{wafer_id}'
+    map_path = maps_cache_dir / f'{map_name}{wafer_map_file.SUFFIX}'
+    try:
+        wafer_map = wafer_map_file.read_wafer_map(map_path)
+        if wafer_map.source_hash == source_hash:
+            logger.info(f'Read the input wafer from the wafer map {map_path}.')
+            return ChipsGrid.make_chips_grid_from_states(wafer_map.states), Template(wafer_map.template_text)
+    except FileNotFoundError:
+        pass
+    except ValueError as error:
+        logger.warning(f'{error} It is parsed again.')
+    chips_grid, rest_of_text_as_template = parse_method(path_to_read_from)
+    wafer_map_file.write_wafer_map(map_path, chips_grid.states, source_hash, path_to_read_from.parent.name,
+                                   path_to_read_from.stem if wafer_id is None else wafer_id,
+                                   rest_of_text_as_template.template)
+    return chips_grid, rest_of_text_as_template
+
+
+def parse_stdf_file(path_to_read_from, wafer_id=None, content=None):
+    """
+    Read the parts results (PRR records) of .stdf file straight into the wafer states.
+    The other records are skipped without decoding them.
+    see handle_stdf_files for the details.
+    :param wafer_id: read only the section of this wafer, None for all the parts of the file.
+    :param content: the bytes of the file when it was already read.
+    """
+    logger.info('Read the input wafer stdf file.')
+    try:
+        if wafer_id is not None:
+            states = handle_stdf_files.read_stdf_wafer_states(path_to_read_from, wafer_id, content)
+        elif content is not None:
+            states = handle_stdf_files.read_stdf_states_from_content(content)
+        else:
+            states = handle_stdf_files.read_stdf_states(path_to_read_from)
+    except ValueError as error:
+        logger.error(str(error))
+        raise BadWaferFileException(str(error))
+    return ChipsGrid.make_chips_grid_from_states(states), Template("$wafer")
+
+
+def parse_text_file(path_to_read_from, content=None):
     logger.info('Read the input wafer text file.')
+    if content is not None:
+        return parse_text_content(content.decode())
     with open(path_to_read_from, 'r') as input_file:
         file_content = input_file.read()
+    return parse_text_content(file_content)
+
+
+def parse_text_content(file_content):
     chips_map_as_string, rest_of_text_as_template = separate_un_relevant_text_lines(file_content)
     chips_map_as_grid = ChipsGrid(chips_map_as_string)
     return chips_map_as_grid, rest_of_text_as_template
 
 
+def parse_wafer_content(content, type_of_file):
+    """
+    Parse wafer file content that is not on disk.
+    :param content: the file content as bytes.
+    :param type_of_file: '.txt' or '.stdf'.
+    :return: ChipsGrid and the rest of the text as template, like parse_file.
+    """
+    if type_of_file == '.txt':
+        return parse_text_content(content.decode())
+    if type_of_file == '.stdf':
+        try:
+            wafers_sections = handle_stdf_files.index_wafer_sections(content)
+            if len(wafers_sections) > 1:  # merging them would mix the chips of all the wafers
+                raise ValueError(f'The STDF content has {len(wafers_sections)} wafers ('
+                                 f'{", ".join(section.wafer_id for section in wafers_sections)}), '
+                                 f'send every wafer alone.')
+            states = handle_stdf_files.read_stdf_states_from_content(content)
+        except (ValueError, struct.error) as error:
+            raise BadWaferFileException(str(error))
+        return ChipsGrid.make_chips_grid_from_states(states), Template("$wafer")
+    raise BadWaferFileException(f'The type {type_of_file} is not supported, only .txt and .stdf.')
+
+
+def classify_wafers_contents(wafers, neighbors_path):
+    """
+    Classify wafers that are given as contents, all the wafers that were parsed are classified together.
+    :param wafers: list of (name, content as bytes, type of file).
+    :return: list of dict per wafer, with the name and either result_text (the result file content),
+             wafer (the result wafer map) and summary (its summary row), or error.
+    """
+    results, parsed_indices, chips_grids, rests_of_files = list(), list(), list(), list()
+    for name, content, type_of_file in wafers:
+        results.append({'name': name})
+        try:
+            chips_grid, rest_of_file = parse_wafer_content(content, type_of_file)
+        except (BadWaferFileException, UnicodeDecodeError) as error:
+            results[-1]['error'] = str(error)
+            continue
+        parsed_indices.append(len(results) - 1)
+        chips_grids.append(chips_grid)
+        rests_of_files.append((rest_of_file, type_of_file))
+    if not chips_grids:
+        return results
+    names = [results[result_index]['name'] for result_index in parsed_indices]
+    result_grids, summary_rows, _ = apply_algorithm_on_grids(chips_grids, neighbors_path, names)
+    for result_index, result_grid, summary_row, (rest_of_file, type_of_file) in zip(
+            parsed_indices, result_grids, summary_rows, rests_of_files):
+        results[result_index].update({'result_text': combine_result_with_rest(result_grid, rest_of_file, type_of_file),
+                                      'wafer': str(result_grid), 'summary': summary_row})
+    return results
+
+
+wafer_line_pattern = re.compile(r'^[^\S\n]*([X.1Y]+)[^\S\n]*$', re.MULTILINE)
+
+
 def separate_un_relevant_text_lines(chips_map_as_str):
     """
     Get content of text file and separate it into the wafer
     part and the rest of the text.
-    separate the text file into wafer and all the other stuff.
+    The wafer is the continuous block of the most common length lines
+    composed from . X 1 Y only (ignoring the white spaces around them),
+    all of them are found in one scan over the text.
     :param chips_map_as_str: content of a wafer file as .txt
     :return: The wafer grid text that contains . X 1 only and template of all the other stuff.
     """
     logger.debug('In parse input wafer file: Starting extract wafer from text.')
-    chips_map_striped = chips_map_as_str.strip()
-    file_lines_list = chips_map_striped.split('\n')
-    file_lines_striped_list = [line.strip() for line in file_lines_list]
-    most_common_relevant_line_length = find_most_common_relevant_line_length(file_lines_striped_list)
-    relevant_indexes_set = {index for index, line in enumerate(file_lines_striped_list)
-                            if is_relevant_wafer_line(line, most_common_relevant_line_length)}
-    handle_two_wafers_case(relevant_indexes_set)
-    wafer_start_index, wafer_end_index = min(relevant_indexes_set), max(relevant_indexes_set)
-    chips_map_part_list = file_lines_striped_list[wafer_start_index: wafer_end_index + 1]
-    chips_map_part_string = '\n'.join(chips_map_part_list)
-    rest_of_the_text = chips_map_as_str.replace(chips_map_part_string, '$wafer')
-    rest_of_text_as_template = Template(rest_of_the_text)
+    wafer_block = find_wafer_block(chips_map_as_str)
+    wafer_start_offset, wafer_end_offset = wafer_block.start_offset, wafer_block.end_offset
+    chips_map_part_string = chips_map_as_str[wafer_start_offset: wafer_end_offset]
+    if len(chips_map_part_string) != wafer_block.lines_number * (wafer_block.line_length + 1) - 1:
+        chips_map_part_string = '\n'.join(line.strip() for line in chips_map_part_string.split('\n'))
+    text_before_wafer = chips_map_as_str[:wafer_start_offset].replace('$', '$$')
+    text_after_wafer = chips_map_as_str[wafer_end_offset:].replace('$', '$$')
+    rest_of_text_as_template = Template(f'{text_before_wafer}$wafer{text_after_wafer}')
     logger.debug('In parse input wafer file: Finish of separate wafer from text.')
     return chips_map_part_string, rest_of_text_as_template
 
 
-def handle_two_wafers_case(relevant_indexes_set):
-    if is_not_continuous_set(relevant_indexes_set):
+class WaferBlock:
+    """
+    The lines of one length that could be part of wafer.
+    offsets are of the first chip in the first line and after the last chip in the last line.
+    """
+
+    def __init__(self, line_length, match):
+        self.line_length = line_length
+        self.lines_number = 1
+        self.start_offset = match.start(1)
+        self.end_offset = match.end(1)
+        self.last_line_end_offset = match.end()
+        self.is_continuous = True
+
+    def add_line(self, match):
+        is_next_line = match.start() == self.last_line_end_offset + 1
+        self.is_continuous = self.is_continuous and is_next_line
+        self.lines_number += 1
+        self.end_offset = match.end(1)
+        self.last_line_end_offset = match.end()
+
+
+def find_wafer_block(chips_map_as_str):
+    wafer_blocks = dict()
+    for match in wafer_line_pattern.finditer(chips_map_as_str):
+        line_length = match.end(1) - match.start(1)
+        if line_length in wafer_blocks:
+            wafer_blocks[line_length].add_line(match)
+        else:
+            wafer_blocks[line_length] = WaferBlock(line_length, match)
+    if len(wafer_blocks) == 0:
+        raise BadWaferFileException("The file contains no wafers!!!")
+    # on equality the first length that appears in the file wins
+    wafer_block = max(wafer_blocks.values(), key=lambda block: block.lines_number)
+    if not wafer_block.is_continuous:
         error_message = 'There are 2 wafers in the same file with same length.'
         logger.error(error_message)
         raise BadWaferFileException(error_message)
+    return wafer_block
 
 
 class BadWaferFileException(Exception):
@@ -169,104 +244,82 @@ class BadWaferFileException(Exception):
         return f'BadWaferFileException!!!  {self.message}'
 
 
-def is_not_continuous_set(int_set):
-    is_continuous = max(int_set) - min(int_set) + 1 != len(int_set)
-    return is_continuous
-
-
-def find_most_common_relevant_line_length(file_lines_list):
-    lengths_list = [len(line) for line in file_lines_list if
-                    is_contains_only_relevant_characters(line) and len(line) != 0]
-    if len(lengths_list) == 0:
-        raise BadWaferFileException("The file contains no wafers!!!")
-    counters = Counter(lengths_list)
-    return counters.most_common()[0][0]
-
-
-def is_contains_only_relevant_characters(line):
-    """
-    Checks if it possible that line is part of wafer.
-    assume line are striped
-    :param line: a text line
-    :return: True iff all characters are of chips map
-            i.e the line composed from 1 X . only.
-    """
-    relevant_characters_set = {'X', '.', '1', 'Y'}
-    is_all_relevant_characters = all([char in relevant_characters_set for char in line])
-    is_not_garbage_line = is_all_relevant_characters
-    return is_not_garbage_line
-
-
-def is_relevant_wafer_line(line, most_common_not_garbage_line_length):
-    """
-    Make sure that line is indeed part of THE wafer in this file.
-    more severe check from 'is_not_garbage_characters' method
-    :param line: line of text
-    :param most_common_not_garbage_line_length: the expected len from not garbage line.
-    :return: True iff line is part of the wafer grid.
-    """
-    return all([is_contains_only_relevant_characters(line), len(line) == most_common_not_garbage_line_length,
-                len(line) > 0])
-
-
 class ChipsGrid:
     def __init__(self, map_as_string):
-        self.__map_as_grid = ChipsGrid.make_chips_grid(map_as_string)
+        self.__states = ChipsGrid.make_states_array(map_as_string)
 
     @staticmethod
-    def make_chips_grid(map_as_string):
+    def make_states_array(map_as_string):
         logger.info('Starting save wafer into memory.')
         logger.debug('Starting save wafer text into memory.')
         map_as_list = map_as_string.split('\n')
-        chips_grid_obj = list()
-        for row_index, chips_row in enumerate(map_as_list):
-            chips_grid_obj.append([])
-            for column_index, chip_state in enumerate(chips_row):
-                current_chip = Chip(row_index, column_index, chip_state)
-                chips_grid_obj[-1].append(current_chip)
+        try:
+            states = grid_algorithm.states_from_rows(map_as_list)
+        except ValueError as error:
+            logger.error(str(error))
+            raise BadWaferFileException(str(error))
         logger.debug('Finish of save wafer text into memory.')
         logger.info('Wafer was saved into memory.')
-        return chips_grid_obj
+        return states
+
+    @staticmethod
+    def make_chips_grid_from_states(states):
+        grid = ChipsGrid('')
+        grid.__states = numpy.ascontiguousarray(states, dtype=numpy.uint8)
+        return grid
 
     def __deepcopy__(self, memodict={}):
         logger.info('Create wafer copy.')
-        return ChipsGrid(str(self))
+        return ChipsGrid.make_chips_grid_from_states(self.states.copy())
 
     @staticmethod
     def make_chips_grid_from_grid(chips_table):
-        grid = ChipsGrid('')
-        grid.__map_as_grid = chips_table
-        return grid
+        map_as_string = '\n'.join(''.join(str(chip) for chip in chips_row) for chips_row in chips_table)
+        return ChipsGrid(map_as_string)
+
+    @property
+    def states(self):
+        """
+        :return: uint8 array of shape (rows, columns) with the ChipState value of each chip.
+        """
+        return self.__states
+
+    @property
+    def flat_states(self):
+        """
+        :return: writable memoryview of the states ordered by rows, the storage of the Chip views.
+        """
+        return memoryview(self.states.reshape(-1))
 
     @property
     def map_as_grid(self):
-        return self.__map_as_grid
+        return [[self.chip_at(row, column) for column in range(self.columns_number)]
+                for row in range(self.rows_number)]
 
     @property
     def rows_number(self):
-        return len(self.map_as_grid)
+        return self.states.shape[0]
 
     @property
     def columns_number(self):
-        if self.rows_number == 0:
-            return 0
-        return len(self.map_as_grid[0])
+        return self.states.shape[1]
+
+    def chip_at(self, row, column):
+        return Chip.make_view(self.flat_states, row, column, self.columns_number)
 
     def __repr__(self):
         logger.info('Turn wafer into text representation.')
-        representation_grid = [[str(chip) for chip in grid_row] for grid_row in self.map_as_grid]
-        representation_lines_list = [''.join(representation_row) for representation_row in representation_grid]
-        representation = '\n'.join(representation_lines_list)
-        return representation
+        return grid_algorithm.states_to_text(self.states)
 
     def __iter__(self):
         """
         Iterate over all Chips in this grid.
-        :return: Chips instances ordered by rows.
+        :return: Chips views on the grid states, ordered by rows.
         """
-        for chips_row in self.map_as_grid:
-            for chip in chips_row:
-                yield chip
+        flat_states, columns_number = self.flat_states, self.columns_number
+        for row in range(self.rows_number):
+            for column in range(columns_number):
+                yield Chip.make_view(flat_states, row, column, columns_number)
 
     def neighbors_iterator(self, chip):
         for delta_rows in {-1, 0, 1}:
@@ -276,8 +329,7 @@ class ChipsGrid:
                 elif self.exist_place(chip, delta_rows, delta_columns):
                     result_row = chip.row + delta_rows
                     result_column = chip.column + delta_columns
-                    current_neighbor = self.map_as_grid[result_row][result_column]
-                    yield current_neighbor
+                    yield self.chip_at(result_row, result_column)
 
     def exist_place(self, chip, delta_rows, delta_columns):
         result_row = chip.row + delta_rows
@@ -285,24 +337,41 @@ class ChipsGrid:
         is_existing_place = 0 <= result_row < self.rows_number and 0 <= result_column < self.columns_number
         return is_existing_place
 
+    def neighborhood_states(self, chip):
+        """
+        :return: the states of the 3x3 window around chip, clipped at the grid edges.
+        """
+        return self.states[max(chip.row - 1, 0): chip.row + 2, max(chip.column - 1, 0): chip.column + 2]
+
     def number_of_neighbors(self, chip):
-        neighbors_number = sum(1 for neighbor in self.neighbors_iterator(chip)
-                               if neighbor.state != ChipState.NOT_EXISTS)
-        return neighbors_number
+        chip_exists = self.states[chip.row, chip.column] != ChipState.NOT_EXISTS.value
+        existing_in_window = numpy.count_nonzero(self.neighborhood_states(chip) != ChipState.NOT_EXISTS.value)
+        return int(existing_in_window - chip_exists)
 
     def number_of_x_neighbors(self, chip):
-        number_of_x_neighbors = sum(1 for neighbor in self.neighbors_iterator(chip) if neighbor.state == ChipState.FAIL)
-        return number_of_x_neighbors
+        chip_is_fail = self.states[chip.row, chip.column] == ChipState.FAIL.value
+        fails_in_window = numpy.count_nonzero(self.neighborhood_states(chip) == ChipState.FAIL.value)
+        return int(fails_in_window - chip_is_fail)
 
 
 class ChipState(enum.Enum):
-    PASS = 1
-    FAIL = 2
-    FAIL_BY_PREDICTION = 3
-    NOT_EXISTS = 4
+    PASS = grid_algorithm.PASS
+    FAIL = grid_algorithm.FAIL
+    FAIL_BY_PREDICTION = grid_algorithm.FAIL_BY_PREDICTION
+    NOT_EXISTS = grid_algorithm.NOT_EXISTS
+
+
+chip_states = tuple(sorted(ChipState, key=lambda chip_state: chip_state.value))  # ChipState by its value
 
 
 class Chip:
+    """
+    Chip of the wafer at (row, column).
+    Chips of a ChipsGrid are views on the grid states array (flyweight), reading or setting their state
+    reads or writes the grid itself. A standalone Chip keeps its state in a buffer of its own.
+    """
+    __slots__ = ('row', 'column', 'storage', 'offset')
+
     state_string_to_enum_translation_dict = {'X': ChipState.FAIL, '1': ChipState.PASS,
                                              '.': ChipState.NOT_EXISTS, 'Y': ChipState.FAIL_BY_PREDICTION}
 
@@ -310,9 +379,23 @@ class Chip:
                                              ChipState.NOT_EXISTS: '.', ChipState.FAIL_BY_PREDICTION: 'Y'}
 
     def __init__(self, row, column, state):
-        self.__row = row
-        self.__column = column
-        self.__state = Chip.translate_state_from_string_to_enum(state)
+        self.row = row
+        self.column = column
+        self.storage = bytearray([Chip.translate_state_from_string_to_enum(state).value])
+        self.offset = 0
+
+    @staticmethod
+    def make_view(flat_states, row, column, columns_number):
+        """
+        :param flat_states: writable flat buffer of the grid states, ordered by rows.
+        :return: Chip whose state is flat_states at (row, column).
+        """
+        chip = Chip.__new__(Chip)
+        chip.row = row
+        chip.column = column
+        chip.storage = flat_states
+        chip.offset = row * columns_number + column
+        return chip
 
     @staticmethod
     def translate_state_from_string_to_enum(state_as_str):
@@ -320,50 +403,101 @@ class Chip:
         return chip_state
 
     def __repr__(self):
-        return Chip.translate_state_from_enum_to_string(self.state)
+        return grid_algorithm.STATES_CHARACTERS[self.storage[self.offset]]
 
     def __eq__(self, other):
-        return all([self.row == other.row, self.column == other.column])
+        return (self.row, self.column) == (other.row, other.column)
 
     def __hash__(self):
-        return hash(self.column) + 1024 * hash(self.row)
+        # coordinates are far below 2 ** 31 (STDF coordinates are 16 bits), so different chips never collide
+        return (self.row << 32) + self.column
 
     @staticmethod
     def translate_state_from_enum_to_string(chip_state_enum):
         state = Chip.state_enum_to_string_translation_dict[chip_state_enum]
         return state
 
-    @property
-    def row(self):
-        return self.__row
-
-    @property
-    def column(self):
-        return self.__column
-
     @property
     def state(self):
-        return self.__state
+        return chip_states[self.storage[self.offset]]
 
     @state.setter
     def state(self, new_state):
-        self.__state = new_state
+        self.storage[self.offset] = new_state.value
 
 
 def apply_algorithm_on_grid(wafer_grid, neighbors_path):
     logger.debug('Starting apply the algorithm for predict who chips are failed.')
-    wafer_grid_copy = copy.deepcopy(wafer_grid)
-    neighbors_table = make_dict_of_neighbors_threshold(neighbors_path)
-    for grid_cell in wafer_grid_copy:
-        if grid_cell.state != ChipState.PASS:
-            continue
-        total_number_of_cell_neighbors = wafer_grid_copy.number_of_neighbors(grid_cell)
-        total_number_of_x_neighbors = wafer_grid_copy.number_of_x_neighbors(grid_cell)
-        threshold = neighbors_table[total_number_of_cell_neighbors]
-        new_state = ChipState.FAIL_BY_PREDICTION if total_number_of_x_neighbors >= threshold else ChipState.PASS
-        grid_cell.state = new_state
+    classify_states = get_states_classifier(neighbors_path)
+    result_states = classify_states(wafer_grid.states)
     logger.debug('Finish apply the algorithm for predict who chips are failed.')
-    return wafer_grid_copy
+    return ChipsGrid.make_chips_grid_from_states(result_states)
+
+
+def apply_algorithm_on_grids(wafer_grids, neighbors_path, wafers_names):
+    """
+    Apply the algorithm on many wafers (usually the wafers of one lot) in one vectorized pass over
+    their stacked states, wafers with different shapes are padded with not existing chips.
+    :param wafer_grids: list of ChipsGrid.
+    :param wafers_names: name of each wafer for its summary row.
+    :return: list of result ChipsGrid (in the order and shapes of wafer_grids), list of summary rows and
+             array of the fail frequency (failed or failed by prediction) of each chip position over the wafers
+             in which it exists.
+    """
+    logger.debug(f'Starting apply the algorithm on {len(wafer_grids)} wafers together.')
+    classify_states = get_states_classifier(neighbors_path)
+    input_states = grid_algorithm.stack_states([wafer_grid.states for wafer_grid in wafer_grids])
+    output_states = classify_states(input_states)
+    result_grids, summary_rows = list(), list()
+    for wafer_index, (wafer_grid, wafer_name) in enumerate(zip(wafer_grids, wafers_names)):
+        rows_number, columns_number = wafer_grid.states.shape
+        result_states = output_states[wafer_index, :rows_number, :columns_number]
+        result_grids.append(ChipsGrid.make_chips_grid_from_states(result_states))
+        summary_rows.append(HtmlViewer.make_summary(wafer_grid.states, result_states, wafer_name)[1])
+    existing_counts, fail_counts, predicted_fail_counts = grid_algorithm.count_fails_per_position(output_states)
+    fail_frequency = (fail_counts + predicted_fail_counts) / numpy.maximum(existing_counts, 1)
+    logger.debug('Finish apply the algorithm on the wafers.')
+    return result_grids, summary_rows, fail_frequency
+
+
+def apply_propagation_on_grid(wafer_grid, neighbors_path, max_rounds=0):
+    """
+    Apply the algorithm again and again, counting the chips failed by prediction as failed, until no chip changes
+    (see grid_algorithm.propagate_fails). Supports neighbors threshold tables only.
+    :param max_rounds: stop after this number of rounds, 0 for no limit.
+    :return: the result ChipsGrid and list of the number of new fails in each round.
+    """
+    logger.debug('Starting propagate the fails until the wafer is stable.')
+    result_states, flips_per_round = grid_algorithm.propagate_fails(wafer_grid.states,
+                                                                    get_thresholds_lookup(neighbors_path), max_rounds)
+    logger.debug(f'Finish propagate the fails after {len(flips_per_round)} rounds.')
+    return ChipsGrid.make_chips_grid_from_states(result_states), flips_per_round
+
+
+def make_propagation_columns(flips_per_round):
+    return {'Propagation_rounds': len(flips_per_round),
+            'Fails_per_round': ':'.join(str(flips_number) for flips_number in flips_per_round)}
+
+
+def apply_changes_on_result(result_grid, changes, neighbors_path, summary_row=None):
+    """
+    Change the input states of few chips of saved result and classify again only around them
+    (see grid_algorithm.reclassify_changed_chips). Supports neighbors threshold tables only.
+    :param result_grid: ChipsGrid of the result, updated in place.
+    :param changes: rows, columns and new input states of the changed chips.
+    :param summary_row: summary row of the result from HtmlViewer.make_summary, updated in place when given.
+    :return: rows, columns, previous states and new states of the chips that changed in the result.
+    """
+    rows, columns, new_states = changes
+    try:
+        result_changes = grid_algorithm.reclassify_changed_chips(result_grid.states, rows, columns, new_states,
+                                                                 get_thresholds_lookup(neighbors_path))
+    except ValueError as error:
+        raise WrongArgumentsException(str(error))
+    if summary_row is not None:
+        HtmlViewer.update_summary_row(summary_row, *result_changes)
+    logger.debug(f'{len(rows)} chips were changed and {len(result_changes[0])} chips of the result changed.')
+    return result_changes
 
 
 def make_dict_of_neighbors_threshold(neighbors_path):
@@ -375,6 +509,153 @@ def make_dict_of_neighbors_threshold(neighbors_path):
     return neighbors_dict
 
 
+def get_states_classifier(neighbors_path):
+    """
+    Make the classification function of the neighbors file once per process, and again only when it was changed.
+    The file is either neighbors threshold table (number of neighbors to threshold), classified with the thresholds
+    map of each wafer geometry cached (see geometry_cache), or kernel configuration (see neighborhood_kernels).
+    :return: function from states array (or stack of states arrays) to the result states array.
+    """
+    modification_time = Path(neighbors_path).stat().st_mtime_ns
+    return make_states_classifier_once(str(neighbors_path), modification_time)
+
+
+@functools.lru_cache(maxsize=16)
+def make_states_classifier_once(neighbors_path, modification_time):
+    with open(neighbors_path) as neighbors_json_file:
+        neighbors_config = json.load(neighbors_json_file)
+    if 'kernel' not in neighbors_config:
+        thresholds_lookup = get_thresholds_lookup(neighbors_path)
+        return geometry_cache.GeometryCache(thresholds_lookup).classify
+    logger.debug(f'Using the neighborhood kernel of {neighbors_path}.')
+    try:
+        return neighborhood_kernels.KernelClassifier.from_config(neighbors_config).classify
+    except (KeyError, ValueError) as error:
+        raise WrongArgumentsException(f'Bad neighborhood kernel configuration {neighbors_path}: {error!r}')
+
+
+def get_thresholds_lookup(neighbors_path):
+    """
+    :return: thresholds array of the neighbors threshold table file (see grid_algorithm.make_thresholds_lookup),
+             read once per process and again only when the file was changed.
+    """
+    modification_time = Path(neighbors_path).stat().st_mtime_ns
+    return make_thresholds_lookup_once(str(neighbors_path), modification_time)
+
+
+@functools.lru_cache(maxsize=16)
+def make_thresholds_lookup_once(neighbors_path, modification_time):
+    try:
+        return grid_algorithm.make_thresholds_lookup(make_dict_of_neighbors_threshold(neighbors_path))
+    except ValueError:
+        raise WrongArgumentsException(f'{neighbors_path} is not neighbors threshold table (number of neighbors '
+                                      f'to threshold).')
+
+
+def find_tables_paths(paths):
+    """
+    :param paths: neighbors threshold .json files or directories of them.
+    :return: sorted list of .json files.
+    """
+    tables_paths = list()
+    for path in paths:
+        tables_paths.extend(sorted(path.rglob('*.json')) if path.is_dir() else [path])
+    return tables_paths
+
+
+def read_thresholds_tables(tables_paths):
+    """
+    Read the neighbors threshold tables, the files that are not tables (like kernel configurations or other
+    JSON files in the tables directories) are skipped.
+    :return: list of the paths of the tables and array of their thresholds lookups, one row per table.
+    """
+    valid_tables_paths, thresholds_lookups = list(), list()
+    for table_path in tables_paths:
+        try:
+            thresholds_lookup = grid_algorithm.make_thresholds_lookup(make_dict_of_neighbors_threshold(table_path))
+            if not numpy.issubdtype(thresholds_lookup.dtype, numpy.number):
+                raise ValueError('The thresholds are not numbers.')
+        except (OSError, ValueError, KeyError, TypeError, AttributeError) as error:
+            logger.warning(f'{table_path} is skipped, it is not neighbors threshold table ({error!r}).')
+            continue
+        valid_tables_paths.append(table_path)
+        thresholds_lookups.append(thresholds_lookup)
+    if not valid_tables_paths:
+        raise WrongArgumentsException('There are no neighbors threshold tables to sweep.')
+    return valid_tables_paths, numpy.array(thresholds_lookups)
+
+
+def find_sweep_wafers_paths(input_directory, output_directory):
+    """
+    :return: sorted list of the wafer files in input_directory (recursively), without the results of earlier
+             runs and without the files in output_directory when it is inside input_directory.
+    """
+    input_directory, output_directory = input_directory.resolve(), output_directory.resolve()
+    is_output_inside_input = output_directory != input_directory and is_inside_directory(output_directory,
+                                                                                         input_directory)
+    return sorted(path for path in input_directory.rglob('*') if path.suffix in {'.txt', '.stdf'} and
+                  not path.name.startswith('result_of_') and
+                  not (is_output_inside_input and is_inside_directory(path, output_directory)))
+
+
+def sweep_wafer_file(wafer_path, thresholds_lookups, maps_cache_dir=None, wafer_id=None):
+    chips_grid, _ = parse_file(wafer_path, maps_cache_dir, wafer_id)
+    new_fails_counts = grid_algorithm.sweep_thresholds(chips_grid.states, thresholds_lookups)
+    return [int(new_fails_count) for new_fails_count in new_fails_counts]
+
+
+def sweep_wafer_safely(wafer_arguments, thresholds_lookups):
+    """
+    Sweep one wafer such that its failure does not stop the sweep of the other wafers.
+    :return: list of the new fails number per table, or the error text when the wafer failed.
+    """
+    try:
+        return sweep_wafer_file(wafer_arguments.input_wafer_path, thresholds_lookups, wafer_arguments.maps_cache_dir,
+                                wafer_arguments.wafer_id)
+    except Exception as error:
+        logger.exception(f'Failed sweeping wafer {get_wafer_path(wafer_arguments)}.')
+        return repr(error)
+
+
+def handle_sweep(args):
+    """
+    Apply many neighbors threshold tables on every wafer, parsing and counting the neighbors of each
+    wafer once, and save matrix of the new fails number per wafer (rows) per table (columns).
+    STDF files with many wafers get row per wafer, and wafers that failed get their error in the Error column.
+    """
+    logger.debug(f'Starting sweep of {args.input_wafer_path}.')
+    tables_paths, thresholds_lookups = read_thresholds_tables(find_tables_paths(args.sweep_tables))
+    if args.input_wafer_path.is_dir():
+        wafers_paths = find_sweep_wafers_paths(args.input_wafer_path, args.output_dir_path)
+    else:
+        wafers_paths = [args.input_wafer_path]
+    wafers_arguments = list()
+    for wafer_path in wafers_paths:
+        wafer_arguments = copy.deepcopy(args)
+        wafer_arguments.input_wafer_path = wafer_path
+        wafers_arguments.append(wafer_arguments)
+    wafers_arguments = plan_wafers_of_files(wafers_arguments, args.workers)
+    sweep_wafer = functools.partial(sweep_wafer_safely, thresholds_lookups=thresholds_lookups)
+    if args.workers > 1:
+        with ProcessPoolExecutor(max_workers=args.workers) as executor:
+            new_fails_matrix = list(executor.map(sweep_wafer, wafers_arguments))
+    else:
+        new_fails_matrix = [sweep_wafer(wafer_arguments) for wafer_arguments in wafers_arguments]
+    tables_names = [path.stem for path in tables_paths]
+    sweep_rows = list()
+    for wafer_arguments, new_fails_row in zip(wafers_arguments, new_fails_matrix):
+        wafer_name = get_wafer_path(wafer_arguments).stem
+        if isinstance(new_fails_row, str):
+            sweep_rows.append({'File_name': wafer_name, 'Error': new_fails_row})
+        else:
+            sweep_rows.append(dict(zip(['File_name'] + tables_names, [wafer_name] + new_fails_row)))
+    columns = ['File_name'] + tables_names + (['Error'] if any('Error' in row for row in sweep_rows) else [])
+    sweep_matrix = lot_summary.SummaryAccumulator(sweep_rows, columns=columns)
+    sweep_matrix_path = sweep_matrix.write(args.output_dir_path / f'sweep_matrix_{args.run_date}', args.summary_format)
+    logger.debug(f'Ending sweep, the matrix was saved at {sweep_matrix_path}.')
+    return sweep_matrix_path
+
+
 def save_result_as_text(result_grid, output_directory_path, input_path):
     logger.debug('Saving result wafer as text file.')
     grid_text = str(result_grid)
@@ -383,6 +664,34 @@ def save_result_as_text(result_grid, output_directory_path, input_path):
         output_file.write(grid_text)
 
 
+def get_classification_options(args):
+    """
+    :return: the options that the classification of result depends on.
+    """
+    hash_object = hashlib.sha256()
+    result_cache.hash_file(args.neighbors_file_path, hash_object)
+    return {'neighbors_file_sha256': hash_object.hexdigest(),
+            'classification': f'propagate:{args.max_rounds}' if args.propagate else 'single_pass'}
+
+
+def make_result_record(args, summary_row):
+    """
+    :return: the record that is saved next to the result text, its summary row and the options it was classified
+             with, for updating the result later (see handle_result_update).
+    """
+    return {'summary_row': dict(summary_row), 'classification': get_classification_options(args)}
+
+
+def get_result_record_path(result_path):
+    return result_path.with_suffix('.json')
+
+
+def save_result_record(result_record, output_directory_path, input_path):
+    record_path = get_result_record_path(get_output_file_path(output_directory_path, input_path))
+    with open(record_path, 'w') as record_file:
+        json.dump(result_record, record_file)
+
+
 def get_output_file_path(output_directory_path, input_path):
     output_file_name = choose_output_filename(input_path)
     output_file_path = output_directory_path / output_file_name
@@ -393,8 +702,19 @@ def choose_output_filename(input_path):
     return f'result_of_{input_path.stem}.txt'  # {input_path.suffix}'
 
 
+def summary_format_validation(summary_format):
+    try:
+        lot_summary.check_format_packages(summary_format)
+    except ValueError as error:
+        raise WrongArgumentsException(str(error))
+
+
 def arguments_validation(arguments):
     logger.debug('Starting validating input arguments.')
+    summary_format_validation(arguments.summary_format)
+    if arguments.max_rounds < 0:
+        raise WrongArgumentsException(f'The maximal propagation rounds must be 0 (no limit) or more, '
+                                      f'got {arguments.max_rounds}.')
     for attribute, attribute_argument in vars(arguments).items():
         if not isinstance(attribute_argument, Path):
             continue
@@ -474,9 +794,6 @@ def get_version():
     return current_version
 
 
-version = get_version()
-
-
 def get_input_mode():
     with open(Path(__file__).parent / 'main_config.json') as config_json_file:
         config = json.load(config_json_file)
@@ -484,17 +801,47 @@ def get_input_mode():
 
 
 def enable_long_paths(args):
+    if os.name != 'nt':
+        return
     enable_long_path = "\\\\?\\"
     for attribute, attribute_value in vars(args).items():
         if 'path' in attribute:
             setattr(args, attribute, Path(enable_long_path + str(attribute_value)))
 
 
-@Gooey(navigation='TABBED', show_success_modal=False, program_name='Die Cluster', program_description=f'Version '
-                                                                                                      f'{version}')
+class HeadlessArgumentParser(argparse.ArgumentParser):
+    """
+    ArgumentParser that accepts the Gooey keywords and ignores them,
+    so the same arguments are used without importing Gooey (and wx).
+    Gooey uses metavar as the label of flags too, argparse does not accept it there.
+    """
+
+    def add_argument(self, *args, widget=None, **kwargs):
+        if kwargs.get('action') in {'store_true', 'store_false'}:
+            kwargs.pop('metavar', None)
+        return super().add_argument(*args, **kwargs)
+
+
+def is_gui_mode():
+    return '--ignore-gooey' not in sys.argv
+
+
 def get_argument():
+    if is_gui_mode():
+        return get_argument_from_gooey()
+    sys.argv.remove('--ignore-gooey')
+    return parse_arguments(HeadlessArgumentParser())
+
+
+def get_argument_from_gooey():
+    from gooey import Gooey, GooeyParser
+    gooey_decorator = Gooey(navigation='TABBED', show_success_modal=False, program_name='Die Cluster',
+                            program_description=f'Version {get_version()}')
+    return gooey_decorator(lambda: parse_arguments(GooeyParser()))()
+
+
+def parse_arguments(parser, arguments_list=None):
     logger.debug('Starting of getting the input arguments.')
-    parser = GooeyParser()
     default_paths_dict = get_default_paths()
     parser.add_argument(f'--input_file_path', metavar=f'input file path',
                         widget=f'FileChooser',
@@ -514,7 +861,80 @@ def get_argument():
     parser.add_argument("-i_dir", "--is_directory", metavar='is input is directory',
                         help="Choose-if input is directory of wafers.",
                         action="store_true")
-    args = parser.parse_args()
+    parser.add_argument('-w', '--workers', metavar='number of workers', widget='IntegerField', type=int, default=1,
+                        help='number of processes for handling directory of wafers.')
+    parser.add_argument('--wafer_id', metavar='wafer ID', default=None,
+                        help='handle only this wafer of STDF file with many wafers (by default every wafer of the '
+                             'file is handled alone).')
+    parser.add_argument('--renderer', metavar='wafer images renderer', widget='Dropdown', choices=['table', 'raster'],
+                        default='table', help='table draws matplotlib table, raster draws the pixels directly (fast).')
+    parser.add_argument('--summary_format', metavar='summary format', widget='Dropdown',
+                        choices=lot_summary.supported_formats, default='xlsx', help='file format of the summaries.')
+    parser.add_argument('--line_summary', metavar='summary per wafer',
+                        help='save summary file for each wafer of directory too.', action='store_true')
+    parser.add_argument('--stages_log', metavar='stages log', widget='FileSaver', default=None,
+                        help='append timing and memory record of each stage to this JSON lines file.')
+    parser.add_argument('--stages_in_summary', metavar='stages times in summary',
+                        help='add the time of each stage to the summary rows.', action='store_true')
+    parser.add_argument('--trace_memory', metavar='trace memory',
+                        help='record the traced memory peak of each stage (slower).', action='store_true')
+    parser.add_argument('--propagate', metavar='propagate fails',
+                        help='count the chips failed by prediction as failed and apply the algorithm again until no '
+                             'chip changes (neighbors threshold tables only).', action='store_true')
+    parser.add_argument('--max_rounds', metavar='maximal propagation rounds', widget='IntegerField', type=int,
+                        default=0, help='stop the propagation after this number of rounds, 0 for no limit.')
+    parser.add_argument('--io_threads', metavar='I/O threads', widget='IntegerField', type=int, default=0,
+                        help='threads that read the next input files ahead and write the results in background '
+                             'while the wafers are classified (one worker only), 0 for no background I/O.')
+    parser.add_argument('--read_ahead', metavar='files to read ahead', widget='IntegerField', type=int, default=4,
+                        help='number of input files that are read ahead of the handled ones.')
+    parser.add_argument('--report_mode', metavar='report mode', widget='Dropdown',
+                        choices=['sync', 'background', 'threshold', 'deferred'], default='sync',
+                        help='when the html report and images of each wafer are made: sync while handling the wafer, '
+                             'background in separate pool of processes, threshold only for wafers with more new fails '
+                             'than the report threshold, deferred by a later run with --report_dir.')
+    parser.add_argument('--report_threshold', metavar='report threshold', widget='IntegerField', type=int, default=0,
+                        help='in threshold report mode, make reports only of wafers with more new fails than this.')
+    parser.add_argument('--report_dir', metavar='reports of results directory', widget='DirChooser', type=Path,
+                        default=None, help='only make the missing reports of the saved results in this directory.')
+    parser.add_argument('--update_result', metavar='saved result to update', widget='FileChooser', type=Path,
+                        default=None, help='only update this saved result file with --die_changes or --retest, '
+                                           'classifying again only around the changed chips.')
+    parser.add_argument('--die_changes', metavar='chips changes', widget='FileChooser', type=Path, default=None,
+                        help='text file of the changed chips, line of "row,column,state" (state of ".1X") per chip.')
+    parser.add_argument('--retest', metavar='retest wafer', widget='FileChooser', type=Path, default=None,
+                        help='new wafer file (.txt or .stdf) of the same wafer, its changes are applied on the '
+                             'saved result.')
+    parser.add_argument('--lot_map', metavar='lot map',
+                        help='save heatmap of the fail frequency of every chip position (image and .npz arrays) '
+                             'for each directory.', action='store_true')
+    parser.add_argument('--cache_dir', metavar='results cache directory', widget='DirChooser', type=Path,
+                        default=None, help='reuse the results of wafers that were already handled with the same '
+                                           'input file, neighbors file, version and renderer.')
+    parser.add_argument('--cache_max_mb', metavar='results cache size (MB)', type=float, default=1024,
+                        help='least recently used results are removed when the cache is bigger than this.')
+    parser.add_argument('--maps_cache_dir', metavar='wafer maps directory', widget='DirChooser', type=Path,
+                        default=None, help='save every parsed wafer as compact binary map here, and read the wafers '
+                                           'from their maps in the next runs.')
+    parser.add_argument('--sweep_tables', metavar='neighbors tables to sweep', widget='MultiFileChooser', nargs='+',
+                        type=Path, default=None, help='only count the new fails of each wafer for every one of '
+                                                      'these neighbors tables (.json files or directories).')
+    parser.add_argument('--serve_port', metavar='service port', widget='IntegerField', type=int, default=None,
+                        help='keep running as local HTTP classification service on this port (see '
+                             'classification_service for the endpoints).')
+    parser.add_argument('--serve_host', metavar='service host', default='127.0.0.1',
+                        help='address the classification service listens on.')
+    parser.add_argument('--watch_dirs', metavar='watch directories', widget='MultiDirChooser', nargs='+', type=Path,
+                        default=None, help='keep running and handle every new wafer file in these directories.')
+    parser.add_argument('--poll_seconds', metavar='poll interval', type=float, default=2.0,
+                        help='seconds between scans of the watched directories.')
+    parser.add_argument('--settle_seconds', metavar='settle time', type=float, default=5.0,
+                        help='a file is handled after it was not changed for this number of seconds.')
+    parser.add_argument('--process_existing', metavar='process existing files',
+                        help='handle also the files that are in the watched directories at start.',
+                        action='store_true')
+    args = parser.parse_args(arguments_list)
+    args.run_date = get_date()
     args.input_wafer_path = args.input_dir_path if args.is_directory else args.input_file_path
     delattr(args, 'input_file_path')
     delattr(args, 'input_dir_path')
@@ -537,82 +957,500 @@ def get_date():
     return datetime.today().strftime("%Y_%m_%d_%H_%M_%S")
 
 
-def arguments_modification(args):
-    input_filename = args.input_wafer_path.stem
-    args.output_dir_path /= f'results_of_{input_filename}_Date_{get_date()}'
-    Path.mkdir(args.output_dir_path)
-    utils.wait_for_path_to_exists(args.output_dir_path, maximum_time_to_wait=10)
+def get_wafer_path(args):
+    """
+    :return: the path that the outputs of the wafer are named after, the input file path, or for one wafer of
+             STDF file with many wafers the input file path with the wafer ID added to its name.
+    """
+    if args.wafer_id is None:
+        return args.input_wafer_path
+    return args.input_wafer_path.with_name(f'{args.input_wafer_path.stem}_{args.wafer_id}'
+                                           f'{args.input_wafer_path.suffix}')
 
 
-def get_excel_file(directory: Path):
-    for inode in directory.iterdir():
-        if inode.suffix == '.xlsx':
-            return inode
+def get_output_dir_path(args):
+    return args.output_dir_path / f'results_of_{get_wafer_path(args).stem}_Date_{args.run_date}'
 
 
-def find_excel_paths(args):
-    output_directory = args.output_dir_path
-    excels_paths = []
-    for inode in output_directory.iterdir():
-        if not inode.is_dir():
-            continue
-        else:
-            excels_path = get_excel_file(inode)
-            if excels_path is None:
-                continue
-            excels_paths.append(excels_path)
-    return excels_paths
+def arguments_modification(args):
+    args.output_dir_path = get_output_dir_path(args)
+    Path.mkdir(args.output_dir_path)
 
 
-def create_one_excel(excel_paths, output_directory):
-    if len(excel_paths) == 0:
+def write_lot_summary(summary_rows, output_directory, summary_format):
+    if len(summary_rows) == 0:
         return None
-    data_frame = pandas.DataFrame()
-    for file in excel_paths:
-        if str(file).endswith('.xlsx'):
-            data_frame = data_frame.append(pandas.read_excel(file), ignore_index=True)
-    data_frame.head()
-    result_file_path = output_directory / f'summary_1_sheet_merged_{next(numbers)}.xlsx'
-    utils.drop_un_named_columns(data_frame)
-    data_frame.to_excel(result_file_path, sheet_name=f'{next(numbers)}', index=False)
-    return result_file_path
+    summary_accumulator = lot_summary.SummaryAccumulator(summary_rows)
+    return summary_accumulator.write(output_directory / f'summary_1_sheet_merged_{next(numbers)}', summary_format)
 
 
-def merge_excels(args):
-    excel_paths = find_excel_paths(args)
-    create_one_excel(excel_paths, args.output_dir_path)
+def is_inside_directory(path, directory):
+    return path == directory or directory in path.parents
 
 
 def handle_directory(args):
     logger.debug(f'Starting handling directory {args.input_wafer_path}.')
+    stages_recorder = instrumentation.StagesRecorder(args.input_wafer_path.name, args.trace_memory)
+    with stages_recorder.stage('plan'):
+        summary_format_validation(args.summary_format)
+        files_arguments, directories_arguments = plan_directory(args)
+        files_arguments = plan_wafers_of_files(files_arguments, args.workers)
+    lot_maps = None
+    if args.lot_map:
+        lot_maps = {directory_arguments.output_dir_path: lot_map.LotMapAccumulator()
+                    for directory_arguments in directories_arguments}
+    reports_executor, report_futures = None, list()
+    if args.report_mode == 'background':
+        reports_executor = ProcessPoolExecutor(max_workers=args.workers)
+        for file_arguments in files_arguments:
+            file_arguments.report_mode = 'deferred'
+    with stages_recorder.stage('handle_files'):
+        summary_rows = handle_files(files_arguments, args.workers, lot_maps, reports_executor, report_futures,
+                                    args.io_threads, args.read_ahead)
+    with stages_recorder.stage('lot_summary'):
+        for directory_arguments in reversed(directories_arguments):
+            directory_output = directory_arguments.output_dir_path
+            directory_summary_rows = [summary_row for file_arguments, summary_row in
+                                      zip(files_arguments, summary_rows) if summary_row is not None and
+                                      is_inside_directory(file_arguments.output_dir_path, directory_output)]
+            write_lot_summary(directory_summary_rows, directory_output, args.summary_format)
+            if lot_maps is not None and lot_maps[directory_output].wafers_number > 0:
+                lot_maps[directory_output].save(directory_output / 'lot_map')
+    if reports_executor is not None:
+        with stages_recorder.stage('reports'):
+            wait_for_reports(report_futures)
+            reports_executor.shutdown(wait=True)
+    if args.stages_log:
+        stages_recorder.write(args.stages_log)
+    logger.debug(f'Ending handling directory {args.input_wafer_path}.')
+
+
+def plan_directory(args):
+    """
+    Walk over the input directory recursively, create the output directory of each
+    input directory and prepare the arguments of each wafer file.
+    Inodes are visited in sorted order and all output directories share the run date,
+    so the output names do not depend on the order the files are handled.
+    :param args: the arguments of the directory to plan.
+    :return: list of arguments per wafer file and list of arguments per directory (parents first).
+    """
     arguments_modification(args)
-    input_directory: Path = args.input_wafer_path
-    for file in input_directory.iterdir():
-        logger.debug(f'Now passing on {args.input_wafer_path}')
+    files_arguments, directories_arguments = list(), [args]
+    for inode in sorted(args.input_wafer_path.iterdir()):
         args_copy = copy.deepcopy(args)
-        args_copy.input_wafer_path = file
-        if file.is_dir():
-            handle_directory(args_copy)
-            continue
-        if file.suffix not in {'.stdf', '.txt'}:
-            continue
-        handle_file(args_copy)
-    merge_excels(args)
-    logger.debug(f'Ending handling directory {args.input_wafer_path}.')
+        args_copy.input_wafer_path = inode
+        if inode.is_dir():
+            inner_files_arguments, inner_directories_arguments = plan_directory(args_copy)
+            files_arguments.extend(inner_files_arguments)
+            directories_arguments.extend(inner_directories_arguments)
+        elif inode.suffix in {'.stdf', '.txt'}:
+            files_arguments.append(args_copy)
+    return files_arguments, directories_arguments
+
+
+def find_wafers_ids(stdf_path):
+    """
+    :return: the wafer IDs of STDF file with many wafers (see handle_stdf_files.read_wafer_sections),
+             empty list for file of one wafer or bad file (its error is reported when the file is handled).
+    """
+    try:
+        wafers_sections = handle_stdf_files.read_wafer_sections(stdf_path)
+    except (OSError, ValueError, struct.error):
+        return list()
+    return [wafer_section.wafer_id for wafer_section in wafers_sections] if len(wafers_sections) > 1 else list()
+
+
+def is_multi_wafer_candidate(args):
+    return args.input_wafer_path.suffix == '.stdf' and args.wafer_id is None
+
+
+def split_wafers_of_file(args, wafers_ids):
+    if not wafers_ids:
+        return [args]
+    logger.debug(f'The file {args.input_wafer_path} has {len(wafers_ids)} wafers.')
+    wafers_arguments = list()
+    for wafer_id in wafers_ids:
+        wafer_arguments = copy.deepcopy(args)
+        wafer_arguments.wafer_id = wafer_id
+        wafers_arguments.append(wafer_arguments)
+    return wafers_arguments
+
+
+def plan_wafers_of_file(args):
+    """
+    Split STDF file with many wafers into arguments per wafer, so every wafer is decoded and handled alone
+    and gets its own results.
+    :return: list of arguments per wafer, [args] for files of one wafer.
+    """
+    if not is_multi_wafer_candidate(args):
+        return [args]
+    return split_wafers_of_file(args, find_wafers_ids(args.input_wafer_path))
+
+
+def plan_wafers_of_files(files_arguments, workers_number=1):
+    """
+    Split the STDF files with many wafers of files_arguments like plan_wafers_of_file, the STDF files are scanned
+    by a pool of workers_number processes.
+    :return: list of arguments per wafer, in the order of files_arguments.
+    """
+    stdf_paths = [args.input_wafer_path for args in files_arguments if is_multi_wafer_candidate(args)]
+    if workers_number > 1 and len(stdf_paths) > 1:
+        with ProcessPoolExecutor(max_workers=workers_number) as executor:
+            wafers_ids_per_file = iter(list(executor.map(find_wafers_ids, stdf_paths)))
+    else:
+        wafers_ids_per_file = map(find_wafers_ids, stdf_paths)
+    wafers_arguments = list()
+    for args in files_arguments:
+        if is_multi_wafer_candidate(args):
+            wafers_arguments.extend(split_wafers_of_file(args, next(wafers_ids_per_file)))
+        else:
+            wafers_arguments.append(args)
+    return wafers_arguments
+
+
+def handle_files(files_arguments, workers_number, lot_maps=None, reports_executor=None, report_futures=None,
+                 io_threads=0, read_ahead=0):
+    """
+    Handle all wafer files, in this process or spread over a pool of processes.
+    :param files_arguments: list of arguments, one per wafer file.
+    :param workers_number: number of processes, 1 means handle the files in this process.
+    :param lot_maps: dict of output directory to LotMapAccumulator, every result wafer is added to the
+     accumulators of the directories that contain it as soon as its results are written.
+    :param reports_executor: executor that the report of every result wafer is submitted to as soon as its results
+     are written, the futures are appended to report_futures.
+    :param io_threads: number of threads for reading the next input files ahead (read_ahead files) and for writing
+     the results while the next files are classified, when the files are handled in this process.
+     0 means no background I/O. File whose results failed to be written is failed file.
+    :return: list of the summary rows of the files, None for files that failed.
+    """
+    is_keeping_states = lot_maps is not None or reports_executor is not None
+    prefetcher, writer = None, None
+    if io_threads > 0 and workers_number == 1:  # workers read and write their files themselves
+        prefetcher = io_pipeline.FilesPrefetcher([file_arguments.input_wafer_path for file_arguments in
+                                                  files_arguments], read_ahead, io_threads)
+        writer = io_pipeline.BackgroundWriter(io_threads)
+    handle_function = functools.partial(handle_file_safely, is_keeping_states=is_keeping_states, writer=writer)
+    # before handling, files handled in this process have their output_dir_path moved into their own directory
+    wafers_directories = [get_output_dir_path(file_arguments) for file_arguments in files_arguments]
+    summary_rows = list()
+    pending_wafers = deque()  # (file index, futures of its background writes, result states) in the files order
+
+    def finish_written_wafers(is_waiting):
+        """
+        Add the wafers whose results were written to the lot maps and the reports, the summary row of wafer whose
+        writes failed is replaced by None like any failed file.
+        """
+        while pending_wafers and (is_waiting or all(future.done() for future in pending_wafers[0][1])):
+            file_index, writes_futures, output_states = pending_wafers.popleft()
+            writes_errors = [future.exception() for future in writes_futures if future.exception() is not None]
+            if writes_errors:
+                logger.error(f'Failed writing the results of {files_arguments[file_index].input_wafer_path}: '
+                             f'{writes_errors[0]!r}')
+                summary_rows[file_index] = None
+                continue
+            if output_states is None:
+                continue
+            if reports_executor is not None:
+                report_futures.append(reports_executor.submit(
+                    HtmlViewer.make_report_from_result, output_states, wafers_directories[file_index],
+                    get_wafer_path(files_arguments[file_index]).stem, files_arguments[file_index].renderer))
+            for directory_output, directory_lot_map in (lot_maps or dict()).items():
+                if is_inside_directory(wafers_directories[file_index], directory_output):
+                    directory_lot_map.add_wafer(output_states)
+
+    with ProcessPoolExecutor(max_workers=workers_number) if workers_number > 1 else nullcontext() as executor:
+        if executor is not None:
+            results = executor.map(handle_function, files_arguments)
+        else:
+            results = (handle_function(file_arguments,
+                                       content=prefetcher.take(file_index) if prefetcher is not None else None)
+                       for file_index, file_arguments in enumerate(files_arguments))
+        for file_index, file_arguments in enumerate(files_arguments):
+            if prefetcher is not None:
+                # the files before file_index + workers_number were already taken by the workers
+                prefetcher.advance(file_index + workers_number)
+            result = next(results)
+            # the writes of failed file are dropped with it
+            writes_futures = writer.take_futures() if writer is not None else list()
+            summary_row, output_states = result if is_keeping_states and result is not None else (result, None)
+            summary_rows.append(summary_row)
+            if summary_row is not None:
+                pending_wafers.append((file_index, writes_futures, output_states))
+            finish_written_wafers(is_waiting=False)
+    finish_written_wafers(is_waiting=True)
+    if prefetcher is not None:
+        prefetcher.close()
+    if writer is not None:
+        writer.close()
+    failed_files_number = summary_rows.count(None)
+    if failed_files_number:
+        logger.error(f'Failed to handle {failed_files_number} of {len(files_arguments)} files.')
+    return summary_rows
+
+
+def handle_file_safely(args, is_keeping_states=False, writer=None, content=None):
+    """
+    Handle one wafer file such that its failure does not stop the other files.
+    :param is_keeping_states: return the states of the result wafer too.
+    :param writer: io_pipeline.BackgroundWriter for writing the results, None for writing them before returning.
+    :param content: the bytes of the file when it was already read.
+    :return: the summary row of the file (and the result states), None if the file failed.
+    """
+    try:
+        summary_row, output_states = handle_file_with_states(args, is_keeping_states, writer, content)
+        return (summary_row, output_states) if is_keeping_states else summary_row
+    except Exception:
+        logger.exception(f'Failed handling file {args.input_wafer_path}.')
+        return None
 
 
 def handle_file(args):
+    return handle_file_with_states(args, is_keeping_states=False)[0]
+
+
+def handle_input_file(args):
+    """
+    Handle the input file, STDF file with many wafers is handled wafer by wafer (in parallel by args.workers),
+    every wafer in its own results directory.
+    :return: list of the summary rows of the wafers, None for wafers that failed.
+    """
+    wafers_arguments = plan_wafers_of_file(args)
+    if len(wafers_arguments) == 1:
+        return [handle_file(args)]
+    return handle_files(wafers_arguments, args.workers, io_threads=args.io_threads, read_ahead=args.read_ahead)
+
+
+def handle_file_with_states(args, is_keeping_states=True, writer=None, content=None):
+    """
+    :param is_keeping_states: read the result states from the cache when the result is loaded from there.
+    :param writer: io_pipeline.BackgroundWriter for writing the results, None for writing them before returning.
+     The results are written before returning when they are stored in the results cache.
+    :param content: the bytes of the file when it was already read.
+    :return: the summary row of the file and the states array of the result wafer
+             (None when the result was loaded from the cache and is_keeping_states is False).
+    """
     logger.debug(f'Starting handling file {args.input_wafer_path}.')
-    arguments_validation(args)
-    arguments_modification(args)
-    chips_grid, rest_of_file = parse_file(args.input_wafer_path)
-    processed_grid = apply_algorithm_on_grid(chips_grid, args.neighbors_file_path)
-    input_file_name = args.input_wafer_path.stem
-    HtmlViewer.plot_input_and_output(str(chips_grid), str(processed_grid), args.output_dir_path, input_file_name)
-    file_type = args.input_wafer_path.suffix
-    result_text = combine_result_with_rest(processed_grid, rest_of_file, file_type)
-    save_result_as_text(result_text, args.output_dir_path, args.input_wafer_path)
+    input_file_name = get_wafer_path(args).stem
+    stages_recorder = instrumentation.StagesRecorder(input_file_name, args.trace_memory)
+    with stages_recorder.stage('prepare'):
+        arguments_validation(args)
+        arguments_modification(args)
+    summary_row, output_states, cache, cache_key = None, None, None, None
+    if args.cache_dir is not None:
+        with stages_recorder.stage('cache_load'):
+            cache = result_cache.ResultCache(args.cache_dir, int(args.cache_max_mb * 2 ** 20))
+            cache_key = result_cache.make_key(args.input_wafer_path, args.neighbors_file_path, get_version(),
+                                              get_results_options(args), content)
+            summary_row = cache.load(cache_key, args.output_dir_path, input_file_name)
+            if summary_row is not None and is_keeping_states:
+                result_path = get_output_file_path(args.output_dir_path, get_wafer_path(args))
+                output_states = parse_text_file(result_path)[0].states
+    if summary_row is None:
+        summary_row, output_states = process_file(args, stages_recorder, writer if cache is None else None, content)
+        if cache is not None:
+            with stages_recorder.stage('cache_store'):
+                result_files_names = [path.name for path in args.output_dir_path.iterdir()]
+                cache.store(cache_key, args.output_dir_path, dict(summary_row), result_files_names)
+    if args.stages_in_summary:
+        summary_row.update(stages_recorder.summary_columns())
+    if args.line_summary:
+        line_summary = lot_summary.SummaryAccumulator([summary_row])
+        line_summary.write(args.output_dir_path / 'line_summary', args.summary_format)
+    if args.stages_log:
+        stages_recorder.write(args.stages_log)
     logger.debug(f'Ending handling file {args.input_wafer_path}.')
+    return summary_row, output_states
+
+
+def process_file(args, stages_recorder, writer=None, content=None):
+    """
+    Parse, classify, render and save the results of one wafer file into args.output_dir_path.
+    :param writer: io_pipeline.BackgroundWriter that renders and saves the results, None for doing it here
+     (the render and save stages then record only the time of submitting them).
+    :param content: the bytes of the file when it was already read.
+    :return: the summary row of the wafer and the states array of the result wafer.
+    """
+    wafer_path = get_wafer_path(args)
+    with stages_recorder.stage('parse'):
+        chips_grid, rest_of_file = parse_file(args.input_wafer_path, args.maps_cache_dir, args.wafer_id, content)
+    with stages_recorder.stage('classify'):
+        if args.propagate:
+            processed_grid, flips_per_round = apply_propagation_on_grid(chips_grid, args.neighbors_file_path,
+                                                                        args.max_rounds)
+        else:
+            processed_grid = apply_algorithm_on_grid(chips_grid, args.neighbors_file_path)
+    short_summary, summary_row = HtmlViewer.make_summary(chips_grid.states, processed_grid.states,
+                                                         wafer_path.stem)
+    if args.propagate:
+        summary_row.update(make_propagation_columns(flips_per_round))
+    run = writer.submit if writer is not None else io_pipeline.run_now
+    if is_report_needed_now(args, summary_row):
+        with stages_recorder.stage('render'):
+            run(HtmlViewer.make_report, chips_grid.states, processed_grid.states, args.output_dir_path,
+                wafer_path.stem, args.renderer, short_summary)
+    with stages_recorder.stage('save'):
+        file_type = args.input_wafer_path.suffix
+        result_text = combine_result_with_rest(processed_grid, rest_of_file, file_type)
+        run(save_result_as_text, result_text, args.output_dir_path, wafer_path)
+        run(save_result_record, make_result_record(args, summary_row), args.output_dir_path, wafer_path)
+    return summary_row, processed_grid.states
+
+
+def is_report_needed_now(args, summary_row):
+    """
+    In background mode the report is made here only when no reports pool makes it (single file and watch),
+    directory runs plan their files with deferred mode and render the reports in their own pool.
+    """
+    if args.report_mode == 'threshold':
+        return summary_row['Failed_by_prediction'] > args.report_threshold
+    return args.report_mode in {'sync', 'background'}
+
+
+def get_results_options(args):
+    """
+    :return: text of the options that change the result files of wafer, for the results cache key.
+    """
+    propagation = f'propagate:{args.max_rounds}' if args.propagate else 'single_pass'
+    wafer = f':wafer:{args.wafer_id}' if args.wafer_id is not None else ''
+    return f'{args.renderer}:{args.report_mode}:{args.report_threshold}:{propagation}{wafer}'
+
+
+def find_saved_results(results_directory):
+    """
+    :return: sorted list of the saved result text files in results_directory (recursively) that have no report.
+    """
+    return sorted(result_path for result_path in results_directory.rglob('result_of_*.txt')
+                  if not result_path.with_suffix('.html').exists())
+
+
+def make_report_of_saved_result(result_path, renderer):
+    output_states = parse_text_file(result_path)[0].states
+    input_file_name = result_path.stem[len('result_of_'):]
+    return HtmlViewer.make_report_from_result(output_states, result_path.parent, input_file_name, renderer)
+
+
+def handle_reports(args):
+    """
+    Make the reports of the saved results that were handled with deferred (or threshold) report mode.
+    """
+    results_paths = find_saved_results(args.report_dir)
+    logger.info(f'Making reports of {len(results_paths)} saved results in {args.report_dir}.')
+    make_report = functools.partial(make_report_of_saved_result, renderer=args.renderer)
+    if args.workers > 1:
+        with ProcessPoolExecutor(max_workers=args.workers) as executor:
+            reports_paths = list(executor.map(make_report, results_paths))
+    else:
+        reports_paths = [make_report(result_path) for result_path in results_paths]
+    return reports_paths
+
+
+def read_die_changes_file(changes_path):
+    """
+    Read text file of chips changes, line of "row,column,state" for every chip, where the state is one of '.1X'.
+    Empty lines and lines that start with # are ignored.
+    :return: rows, columns and new states arrays.
+    """
+    changes = list()
+    input_states_characters = grid_algorithm.STATES_CHARACTERS[:grid_algorithm.FAIL_BY_PREDICTION]  # '.1X'
+    with open(changes_path) as changes_file:
+        for line_number, line in enumerate(changes_file, start=1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                row, column, state_character = (value.strip() for value in line.split(','))
+                if len(state_character) != 1 or state_character not in input_states_characters:
+                    raise ValueError(f'Not state character {state_character}.')
+                changes.append((int(row), int(column), input_states_characters.index(state_character)))
+            except ValueError:
+                raise WrongArgumentsException(f'Line {line_number} of {changes_path} is not "row,column,state" '
+                                              f'with state of ".1X": {line}')
+    if not changes:
+        return (numpy.zeros(0, dtype=numpy.intp),) * 3
+    rows, columns, new_states = (numpy.array(values, dtype=numpy.intp) for values in zip(*changes))
+    return rows, columns, new_states
+
+
+def read_result_record(result_path, args):
+    """
+    Read the record of saved result and check that updating it with args classifies it the same way.
+    :return: the record (see make_result_record).
+    """
+    record_path = get_result_record_path(result_path)
+    try:
+        with open(record_path) as record_file:
+            result_record = json.load(record_file)
+        recorded_options = result_record['classification']
+    except (OSError, ValueError, KeyError, TypeError):
+        raise WrongArgumentsException(f'The result {result_path} has no record of its summary and classification '
+                                      f'options ({record_path.name}), handle its wafer again instead.')
+    if args.propagate:
+        raise WrongArgumentsException('Results can be updated with single pass classification only.')
+    if recorded_options != get_classification_options(args):
+        raise WrongArgumentsException(f'The result {result_path} was classified with other options '
+                                      f'({recorded_options["classification"]}) or other neighbors file than '
+                                      f'{args.neighbors_file_path}, handle its wafer again instead.')
+    return result_record
+
+
+def read_retest_changes(retest_path, output_states, wafer_id=None):
+    """
+    :param retest_path: .stdf file whose parts results are merged on the result by their coordinates, or .txt map
+     of the wafer whose existing chips are merged on the result.
+    :param wafer_id: the wafer to read from STDF file with many wafers.
+    :return: rows, columns and new input states of the chips that the retest changed.
+    """
+    try:
+        if retest_path.suffix == '.stdf':
+            return grid_algorithm.find_retest_changes(output_states,
+                                                      *handle_stdf_files.read_stdf_parts(retest_path, wafer_id))
+        retest_grid, _ = parse_file(retest_path)
+        return grid_algorithm.find_input_changes(output_states, retest_grid.states)
+    except (ValueError, struct.error) as error:
+        raise WrongArgumentsException(f'The retest {retest_path} can not be merged on the result: {error}')
+
+
+def handle_result_update(args):
+    """
+    Update saved result with the chips changes file, or with the chips of retest file of the same wafer,
+    classifying again only around the changed chips. The saved summary row of the result is updated by the
+    changed chips. The updated result, its record and its summary are saved in the output directory,
+    with the same name as the saved result.
+    :return: the summary row of the updated result.
+    """
+    logger.debug(f'Starting updating the result {args.update_result}.')
+    if args.die_changes is None and args.retest is None:
+        raise WrongArgumentsException('Updating result needs --die_changes or --retest.')
+    result_record = read_result_record(args.update_result, args)
+    result_grid, rest_of_text_as_template = parse_text_file(args.update_result)
+    input_file_name = args.update_result.stem[len('result_of_'):]
+    summary_row = result_record['summary_row']
+    summary_row['File_name'] = input_file_name
+    if args.die_changes is not None:
+        changes = read_die_changes_file(args.die_changes)
+    else:
+        changes = read_retest_changes(args.retest, result_grid.states, args.wafer_id)
+    apply_changes_on_result(result_grid, changes, args.neighbors_file_path, summary_row)
+    output_result_path = args.output_dir_path / args.update_result.name
+    with open(output_result_path, 'w') as output_file:
+        output_file.write(combine_text_file_with_result_grid(result_grid, rest_of_text_as_template))
+    with open(get_result_record_path(output_result_path), 'w') as record_file:
+        json.dump(result_record, record_file)
+    lot_summary.SummaryAccumulator([summary_row]).write(args.output_dir_path / 'line_summary', args.summary_format)
+    if is_report_needed_now(args, summary_row):
+        HtmlViewer.make_report_from_result(result_grid.states, args.output_dir_path, input_file_name, args.renderer)
+    logger.debug(f'Ending updating the result, {summary_row["Failed_by_prediction"]} chips failed by prediction.')
+    return summary_row
+
+
+def wait_for_reports(report_futures):
+    failed_reports_number = 0
+    for future in report_futures:
+        if future.exception() is not None:
+            logger.error(f'Failed making report: {future.exception()}')
+            failed_reports_number += 1
+    if failed_reports_number:
+        logger.error(f'Failed to make {failed_reports_number} of {len(report_futures)} reports.')
 
 
 first_run = True
@@ -621,19 +1459,34 @@ first_run = True
 def create_relevant_directories(args):
     path_to_create = args.output_dir_path
     path_to_create.mkdir(parents=True, exist_ok=True)
-    utils.wait_for_path_to_exists(path_to_create)
+    for cache_directory in [args.cache_dir, args.maps_cache_dir]:
+        if cache_directory is not None:
+            cache_directory.mkdir(parents=True, exist_ok=True)
 
 
 if __name__ == '__main__':
-    numbers = count()
     logger = create_logger()
-    logger.info(f'Starting Die Cluster algorithm version {version}.')
+    logger.info(f'Starting Die Cluster algorithm version {get_version()}.')
     args = get_argument()
     create_relevant_directories(args)
     if args.verbose:
         change_all_log_levels_for_debug()
-    if Path.is_dir(args.input_wafer_path):
+    if args.serve_port is not None:
+        get_states_classifier(args.neighbors_file_path)  # warm up before the first request
+        classification_service.serve(args.serve_host, args.serve_port, classify_wafers_contents,
+                                     args.neighbors_file_path, get_version())
+    elif args.report_dir:
+        handle_reports(args)
+    elif args.update_result:
+        handle_result_update(args)
+    elif args.sweep_tables:
+        handle_sweep(args)
+    elif args.watch_dirs:
+        watch_mode.watch_directories(args, handle_file_safely, lot_summary.fieldnames,
+                                     plan_wafers_function=plan_wafers_of_file)
+    elif Path.is_dir(args.input_wafer_path):
         handle_directory(args)
     else:
-        handle_file(args)
+        args.line_summary = True
+        handle_input_file(args)
     logger.info('Finish of Die Cluster algorithm.')
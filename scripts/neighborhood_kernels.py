@@ -0,0 +1,195 @@
+"""
+Kernel based classification, for neighborhoods other than the 8 chips around each chip.
+The neighbors weight of a chip is the sum of the kernel weights of its existing neighbors, and its fail weight
+is the same sum over its failed neighbors. A passed chip is failed by prediction when its fail weight is bigger
+than or equals to the threshold of its neighbors weight.
+Configuration (the neighbors file in JSON), for example:
+{
+  "kernel": [[1, 1, 1, 1, 1], [1, 2, 2, 2, 1], [1, 2, 0, 2, 1], [1, 2, 2, 2, 1], [1, 1, 1, 1, 1]],
+  "threshold": {"fraction": 0.5, "minimum": 3},
+  "edge_ring": {"width": 1, "threshold": {"fraction": 0.7, "minimum": 2}}
+}
+"kernel" is a weights matrix with odd sides centered on the chip (the weight of the chip itself is ignored),
+or {"radius": r} for all the chips up to distance r.
+"threshold" is {"table": {neighbors weight: threshold, ...}} with keys from 0 to the maximal neighbors weight,
+or {"fraction": f, "minimum": m} for threshold of max(m, f * neighbors weight).
+"edge_ring" (optional) gives other threshold to the chips that are up to "width" chips from the wafer edge.
+"""
+import math
+
+import numpy
+
+import grid_algorithm
+
+
+SHIFTED_SUM_MAX_RADIUS = 4  # above it the cumulative sums are faster than adding the shifted rows and columns
+
+
+def box_sum(values, radius, pad_value=0):
+    """
+    Sum of the (2 * radius + 1) square window around every cell. Works on the two last axes.
+    Small windows add the shifted rows and then the shifted columns of the padded values, larger windows use
+    cumulative sums, so the cost stays about the same for any radius.
+    :param pad_value: value of the cells outside of the array.
+    """
+    size = 2 * radius + 1
+    rows_number, columns_number = values.shape[-2:]
+    dtype = numpy.int32 if values.dtype == bool else numpy.int64
+    if radius <= SHIFTED_SUM_MAX_RADIUS:
+        padded = numpy.full(values.shape[:-2] + (rows_number + 2 * radius, columns_number + 2 * radius), pad_value,
+                            dtype=dtype)
+        padded[..., radius: radius + rows_number, radius: radius + columns_number] = values
+        rows_sums = padded[..., :rows_number, :].copy()
+        for row in range(1, size):
+            rows_sums += padded[..., row: row + rows_number, :]
+        sums = rows_sums[..., :columns_number].copy()
+        for column in range(1, size):
+            sums += rows_sums[..., column: column + columns_number]
+        return sums
+    # the first row stays 0, so the window sum of row i is the cumulative sum at i + size minus the one at i
+    sums = numpy.full(values.shape[:-2] + (rows_number + size, columns_number + size - 1), pad_value, dtype=dtype)
+    sums[..., 0, :] = 0
+    sums[..., radius + 1: radius + 1 + rows_number, radius: radius + columns_number] = values
+    numpy.cumsum(sums, axis=-2, out=sums)
+    rows_sums = numpy.empty(values.shape[:-2] + (rows_number, columns_number + size), dtype=dtype)
+    rows_sums[..., 0] = 0
+    numpy.subtract(sums[..., size:, :], sums[..., :rows_number, :], out=rows_sums[..., 1:])
+    numpy.cumsum(rows_sums, axis=-1, out=rows_sums)
+    return rows_sums[..., size:] - rows_sums[..., :columns_number]
+
+
+def find_rings_weights(kernel):
+    """
+    :return: the weights of the square rings of the kernel (ring r is the chips at distance r in rows or columns
+             from the center) from ring 1 out, None when the kernel is not square or a ring has many weights.
+    """
+    if kernel.shape[0] != kernel.shape[1]:
+        return None
+    radius = kernel.shape[0] // 2
+    rows, columns = numpy.indices(kernel.shape) - radius
+    distances = numpy.maximum(numpy.abs(rows), numpy.abs(columns))
+    rings_weights = list()
+    for distance in range(1, radius + 1):
+        ring_weights = kernel[distances == distance]
+        if numpy.any(ring_weights != ring_weights[0]):
+            return None
+        rings_weights.append(ring_weights[0].item())  # python numbers keep the dtype of the box sums
+    return rings_weights
+
+
+def weigh_neighbors(mask, kernel):
+    """
+    Sum the kernel weights of the marked neighbors of every cell, kernel[i, j] is the weight of the neighbor
+    at (i - kernel rows // 2, j - kernel columns // 2) from the cell. Works on the two last axes.
+    Kernels with one weight per square ring (like the radius kernels and neighbors_kernel_radius_2.json) are summed
+    as nested boxes, box of radius r weighted by the weight of ring r minus the weight of ring r + 1, so their cost
+    grows with the number of rings of different weights and not with their area. Other kernels are summed by
+    shifted slices, one per nonzero weight.
+    """
+    if kernel.size == 1:
+        return numpy.zeros(mask.shape, dtype=kernel.dtype)
+    rings_weights = find_rings_weights(kernel)
+    if rings_weights is None:
+        return weigh_neighbors_by_shifts(mask, kernel)
+    weights = None
+    for radius, (ring_weight, outer_ring_weight) in enumerate(zip(rings_weights, rings_weights[1:] + [0]), start=1):
+        if ring_weight == outer_ring_weight:
+            continue
+        box_weights = box_sum(mask, radius) - mask  # the box without the cell itself
+        if ring_weight - outer_ring_weight != 1:
+            box_weights = (ring_weight - outer_ring_weight) * box_weights
+        weights = box_weights if weights is None else weights + box_weights
+    return weights if weights is not None else numpy.zeros(mask.shape, dtype=kernel.dtype)
+
+
+def weigh_neighbors_by_shifts(mask, kernel):
+    """
+    Same as weigh_neighbors for any kernel, adding one shifted slice of the mask per nonzero weight.
+    """
+    rows_radius, columns_radius = kernel.shape[0] // 2, kernel.shape[1] // 2
+    leading_axes = [(0, 0)] * (mask.ndim - 2)
+    padded = numpy.pad(mask.astype(kernel.dtype), leading_axes + [(rows_radius, rows_radius),
+                                                                  (columns_radius, columns_radius)])
+    rows_number, columns_number = mask.shape[-2:]
+    weights = numpy.zeros(mask.shape, dtype=kernel.dtype)
+    for (row, column), weight in numpy.ndenumerate(kernel):
+        if weight != 0 and (row, column) != (rows_radius, columns_radius):
+            weights += weight * padded[..., row: row + rows_number, column: column + columns_number]
+    return weights
+
+
+def make_kernel(kernel_config):
+    if isinstance(kernel_config, dict):
+        size = 2 * int(kernel_config['radius']) + 1
+        kernel = numpy.ones((size, size), dtype=numpy.int64)
+    else:
+        kernel = numpy.array(kernel_config)
+        if kernel.ndim != 2 or kernel.shape[0] % 2 == 0 or kernel.shape[1] % 2 == 0:
+            raise ValueError(f'The kernel must be matrix with odd number of rows and columns, not {kernel.shape}.')
+        if not numpy.issubdtype(kernel.dtype, numpy.number):
+            raise ValueError('The kernel weights must be numbers.')
+    kernel[kernel.shape[0] // 2, kernel.shape[1] // 2] = 0
+    return kernel
+
+
+def make_threshold_function(threshold_config, max_neighbors_weight):
+    """
+    :return: function from neighbors weights array to thresholds array.
+    """
+    if 'table' in threshold_config:
+        table = {int(key): value for key, value in threshold_config['table'].items()}
+        missing_keys = [key for key in range(math.ceil(max_neighbors_weight) + 1) if key not in table]
+        if missing_keys:
+            raise ValueError(f'The thresholds table has no thresholds of the neighbors weights {missing_keys}.')
+        thresholds_lookup = numpy.array([table[key] for key in range(max(table) + 1)])
+        return lambda neighbors_weights: thresholds_lookup[
+            numpy.clip(numpy.rint(neighbors_weights), 0, len(thresholds_lookup) - 1).astype(numpy.intp)]
+    if 'fraction' in threshold_config:
+        fraction, minimum = threshold_config['fraction'], threshold_config.get('minimum', 1)
+        return lambda neighbors_weights: numpy.maximum(minimum, fraction * neighbors_weights)
+    raise ValueError(f'The threshold must have "table" or "fraction", got {list(threshold_config)}.')
+
+
+class KernelClassifier:
+    def __init__(self, kernel, threshold_function, edge_ring_width=0, edge_threshold_function=None):
+        self.kernel = kernel
+        self.threshold_function = threshold_function
+        self.edge_ring_width = edge_ring_width
+        self.edge_threshold_function = edge_threshold_function
+
+    @staticmethod
+    def from_config(config):
+        """
+        :param config: dict of the configuration, see the module documentation.
+        """
+        kernel = make_kernel(config['kernel'])
+        max_neighbors_weight = kernel[kernel > 0].sum()
+        threshold_function = make_threshold_function(config['threshold'], max_neighbors_weight)
+        edge_ring = config.get('edge_ring')
+        if edge_ring is None:
+            return KernelClassifier(kernel, threshold_function)
+        edge_threshold_function = make_threshold_function(edge_ring['threshold'], max_neighbors_weight)
+        return KernelClassifier(kernel, threshold_function, int(edge_ring['width']), edge_threshold_function)
+
+    def find_edge_ring(self, is_existing):
+        """
+        :return: mask of the chips that are up to edge_ring_width chips from not existing chip or the grid end.
+        """
+        return is_existing & (box_sum(~is_existing, self.edge_ring_width, pad_value=1) > 0)
+
+    def classify(self, states):
+        """
+        :param states: states array (or stack of states arrays).
+        :return: new states array with FAIL_BY_PREDICTION marks.
+        """
+        is_existing = states != grid_algorithm.NOT_EXISTS
+        neighbors_weights = weigh_neighbors(is_existing, self.kernel)
+        fail_weights = weigh_neighbors(states == grid_algorithm.FAIL, self.kernel)
+        thresholds = self.threshold_function(neighbors_weights)
+        if self.edge_ring_width > 0:
+            thresholds = numpy.where(self.find_edge_ring(is_existing), self.edge_threshold_function(neighbors_weights),
+                                     thresholds)
+        is_predicted_fail = (states == grid_algorithm.PASS) & (fail_weights >= thresholds)
+        result_states = states.copy()
+        result_states[is_predicted_fail] = grid_algorithm.FAIL_BY_PREDICTION
+        return result_states
@@ -0,0 +1,143 @@
+"""
+On disk cache of wafer results, keyed by the content of everything that affects the result:
+the input file bytes, the neighbors threshold file bytes, the program version and the options
+that change the results (renderer, report mode, propagation).
+Every entry is a directory with the result files and summary_row.json,
+entries are evicted by least recent use when the cache is bigger than its maximum size.
+The result files are copied into and out of the cache (not linked), so rewriting an output file
+never changes the cached entry.
+The size of the cache is scanned once per process and then estimated by adding the stored entries, it is scanned
+again when the estimate passes the maximum size or after RESCAN_STORES stores (other processes store too).
+"""
+import hashlib
+import json
+import os
+import shutil
+import uuid
+
+SUMMARY_ROW_FILE_NAME = 'summary_row.json'
+READ_CHUNK_SIZE = 1 << 20
+RESCAN_STORES = 100
+
+estimated_sizes = dict()  # cache directory -> [estimated size in bytes, stores since the last scan]
+
+
+def hash_file(path, hash_object):
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(READ_CHUNK_SIZE), b''):
+            hash_object.update(chunk)
+
+
+def make_key(input_path, neighbors_path, version, results_options, input_content=None):
+    """
+    :param input_content: the bytes of the input file when it was already read.
+    """
+    hash_object = hashlib.sha256()
+    for path in [input_path, neighbors_path]:
+        if path is input_path and input_content is not None:
+            hash_object.update(input_content)
+        else:
+            hash_file(path, hash_object)
+        hash_object.update(b'\0')
+    hash_object.update(f'{version}\0{results_options}'.encode())
+    return hash_object.hexdigest()
+
+
+class ResultCache:
+    def __init__(self, cache_directory, max_size_bytes):
+        self.cache_directory = cache_directory
+        self.max_size_bytes = max_size_bytes
+
+    def entry_path(self, key):
+        return self.cache_directory / key[:2] / key
+
+    def load(self, key, output_directory, input_file_name):
+        """
+        Put the cached results of key into output_directory.
+        The file names and the summary row are renamed from the cached wafer name to input_file_name.
+        :return: the summary row, None on cache miss.
+        """
+        entry_path = self.entry_path(key)
+        output_paths = list()
+        try:
+            with open(entry_path / SUMMARY_ROW_FILE_NAME) as summary_row_file:
+                summary_row = json.load(summary_row_file)
+            cached_file_name = summary_row['File_name']
+            for cached_path in entry_path.iterdir():
+                if cached_path.name == SUMMARY_ROW_FILE_NAME:
+                    continue
+                output_name = cached_path.name.replace(f'result_of_{cached_file_name}.',
+                                                       f'result_of_{input_file_name}.')
+                output_paths.append(output_directory / output_name)
+                shutil.copy2(cached_path, output_paths[-1])
+            os.utime(entry_path)
+        except FileNotFoundError:  # the entry was evicted meanwhile, remove the part that was copied
+            for output_path in output_paths:
+                output_path.unlink(missing_ok=True)
+            return None
+        summary_row['File_name'] = input_file_name
+        return summary_row
+
+    def store(self, key, output_directory, summary_row, files_names):
+        """
+        Save the result files of a wafer under key, then evict old entries if needed.
+        The entry is written into a temporary directory and renamed, so it is never seen half written.
+        """
+        entry_path = self.entry_path(key)
+        if entry_path.exists():
+            return
+        temporary_path = entry_path.with_name(f'{key}.{uuid.uuid4().hex}.tmp')
+        temporary_path.mkdir(parents=True)
+        for file_name in files_names:
+            shutil.copy2(output_directory / file_name, temporary_path / file_name)
+        with open(temporary_path / SUMMARY_ROW_FILE_NAME, 'w') as summary_row_file:
+            json.dump(summary_row, summary_row_file)
+        entry_size = sum(path.stat().st_size for path in temporary_path.iterdir())
+        try:
+            os.rename(temporary_path, entry_path)
+        except OSError:  # other process stored the same key meanwhile
+            shutil.rmtree(temporary_path, ignore_errors=True)
+            return
+        self.add_to_size(entry_size)
+
+    def add_to_size(self, entry_size):
+        estimated_size = estimated_sizes.get(self.cache_directory)
+        if estimated_size is None:
+            self.evict()
+            return
+        estimated_size[0] += entry_size
+        estimated_size[1] += 1
+        if estimated_size[0] > self.max_size_bytes or estimated_size[1] >= RESCAN_STORES:
+            self.evict()
+
+    def list_entries(self):
+        """
+        :return: list of (last use time, size in bytes, path) of all entries.
+        """
+        entries = list()
+        for prefix_directory in self.cache_directory.iterdir():
+            if not prefix_directory.is_dir():
+                continue
+            for entry_path in prefix_directory.iterdir():
+                if entry_path.suffix == '.tmp':
+                    continue
+                try:
+                    entry_size = sum(path.stat().st_size for path in entry_path.iterdir())
+                    entries.append((entry_path.stat().st_mtime, entry_size, entry_path))
+                except FileNotFoundError:
+                    continue
+        return entries
+
+    def evict(self):
+        """
+        Scan the cache and remove the least recently used entries until it is not bigger than the maximum size.
+        """
+        entries = sorted(self.list_entries())
+        total_size = sum(entry_size for _, entry_size, _ in entries)
+        for _, entry_size, entry_path in entries:
+            if total_size <= self.max_size_bytes:
+                break
+            shutil.rmtree(entry_path, ignore_errors=True)
+            total_size -= entry_size
+        estimated_sizes[self.cache_directory] = [total_size, 0]
+
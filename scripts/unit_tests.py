@@ -1,11 +1,41 @@
+import base64
+import copy
+import csv
+import http.client
+import json
 import math
+import shutil
 import subprocess
+import tempfile
+import threading
+import time
 import unittest
+import unittest.mock
+import urllib.error
+import urllib.request
+from concurrent import futures
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
 from pathlib import Path
 from random import choice
 
+import numpy
+import pandas
+
+import HtmlViewer
+import benchmark
+import classification_service
+import geometry_cache
+import grid_algorithm
+import handle_stdf_files
+import io_pipeline
+import lot_summary
+import neighborhood_kernels
+import result_cache
 import utils
+import wafer_map_file
+import wafer_raster
+import watch_mode
 from scripts import main
 
 
@@ -326,6 +356,21 @@ class UnitTests(unittest.TestCase):
                           '111'
         self.assertEqual(actual_result, expected_result)
 
+    def test_separate_un_relevant_lines_template(self):
+        un_relevant_text = "Lot $1.X\n" \
+                           "X1\n" \
+                           "  1.X\n" \
+                           "  XX1  \n" \
+                           "end 1.X\n"
+        actual_result, rest_of_text_as_template = main.separate_un_relevant_text_lines(un_relevant_text)
+        self.assertEqual(actual_result, '1.X\n'
+                                        'XX1')
+        expected_text = "Lot $1.X\n" \
+                        "X1\n" \
+                        "  WAFER  \n" \
+                        "end 1.X\n"
+        self.assertEqual(rest_of_text_as_template.substitute({'wafer': 'WAFER'}), expected_text)
+
     def test_chip_grid(self):
         rows_dimension, column_dimension = 5, 5
         sample_size = 10_000
@@ -334,6 +379,723 @@ class UnitTests(unittest.TestCase):
             wafer_text_result = str(wafer_grid)
             self.assertEqual(test_wafer, wafer_text_result)
 
+    def test_vectorized_algorithm_matches_per_chip_algorithm(self):
+        neighbors_path = self.unit_tests_directory / self.neighbors_filename
+        neighbors_table = main.make_dict_of_neighbors_threshold(neighbors_path)
+        for random_wafer in self.get_random_sample_points((17, 13), 20):
+            wafer_grid = main.ChipsGrid(random_wafer)
+            expected_states = []
+            for chip in wafer_grid:
+                # count with the per chip iterator, independent of the numpy windows of number_of_neighbors
+                neighbors_states = [neighbor.state for neighbor in wafer_grid.neighbors_iterator(chip)]
+                neighbors_number = sum(state != main.ChipState.NOT_EXISTS for state in neighbors_states)
+                fail_neighbors_number = neighbors_states.count(main.ChipState.FAIL)
+                is_predicted = chip.state == main.ChipState.PASS and \
+                    fail_neighbors_number >= neighbors_table[neighbors_number]
+                expected_states.append('Y' if is_predicted else str(chip))
+            expected_rows = [''.join(expected_states[row * 17:(row + 1) * 17]) for row in range(13)]
+            actual_output_text = str(main.apply_algorithm_on_grid(wafer_grid, neighbors_path))
+            self.assertEqual(actual_output_text, '\n'.join(expected_rows))
+
+    def test_handle_directory_with_workers(self):
+        with tempfile.TemporaryDirectory() as temporary_directory:
+            input_directory = Path(temporary_directory) / 'lot'
+            (input_directory / 'inner').mkdir(parents=True)
+            shutil.copy(self.unit_tests_directory / 'unit_test_1_input.txt', input_directory / 'wafer_1.txt')
+            shutil.copy(self.unit_tests_directory / 'unit_test_1_input.txt', input_directory / 'inner/wafer_2.txt')
+            (input_directory / 'broken.txt').write_text('no wafer here')
+            output_directory = Path(temporary_directory) / 'results'
+            output_directory.mkdir()
+            args = main.parse_arguments(main.HeadlessArgumentParser(), [
+                '-i_dir', '--input_dir_path', f'{input_directory}', f'{output_directory}',
+                f'{self.unit_tests_directory / self.neighbors_filename}', '--workers', '2', '--renderer', 'raster',
+                '--summary_format', 'csv', '--stages_log', f'{temporary_directory}/stages.jsonl',
+                '--stages_in_summary'])
+            args.run_date = '2020_01_01_00_00_00'
+            main.handle_directory(args)
+            lot_output_directory = output_directory / 'results_of_lot_Date_2020_01_01_00_00_00'
+            expected_result_paths = [
+                lot_output_directory / 'results_of_wafer_1_Date_2020_01_01_00_00_00/result_of_wafer_1.txt',
+                lot_output_directory / 'results_of_inner_Date_2020_01_01_00_00_00/'
+                                       'results_of_wafer_2_Date_2020_01_01_00_00_00/result_of_wafer_2.txt']
+            for result_path in expected_result_paths:
+                self.assertTrue(result_path.exists())
+            lot_summary_paths = list(lot_output_directory.glob('summary_1_sheet_merged_*.csv'))
+            self.assertEqual(len(lot_summary_paths), 1)
+            with open(lot_summary_paths[0], newline='') as lot_summary_file:
+                summary_rows = list(csv.DictReader(lot_summary_file))
+            self.assertEqual([summary_row['File_name'] for summary_row in summary_rows], ['wafer_2', 'wafer_1'])
+            self.assertTrue(all(float(summary_row['classify_seconds']) >= 0 for summary_row in summary_rows))
+            with open(args.stages_log) as stages_log_file:
+                stages_records = [json.loads(line) for line in stages_log_file]
+            recorded_stages = {(record['wafer'], record['stage']) for record in stages_records}
+            self.assertTrue({('wafer_1', 'parse'), ('wafer_2', 'render'), ('lot', 'handle_files')} <= recorded_stages)
+            self.assertTrue(all('process_peak_rss_kb' in record for record in stages_records))
+
+    def test_parse_stdf_file_with_retests(self):
+        parts = [(0, 1, False), (1, 0, False), (1, 1, True), (1, 2, False), (2, 1, False),
+                 (1, 1, False), (2, 1, True), (0, 1, False), (2, 1, False)]
+        expected_wafer_text = ".1.\n" \
+                              "1X1\n" \
+                              ".X."
+        for byte_order in ['<', '>']:
+            with tempfile.TemporaryDirectory() as temporary_directory:
+                stdf_path = Path(temporary_directory) / 'wafer.stdf'
+                stdf_path.write_bytes(handle_stdf_files.make_stdf_content(parts, byte_order))
+                wafer_grid, _ = main.parse_stdf_file(stdf_path)
+                for cut_bytes_number in [3, 15]:  # cut PRR body and cut PRR header
+                    stdf_path.write_bytes(handle_stdf_files.make_stdf_content(parts, byte_order)[:-cut_bytes_number])
+                    with self.assertRaises(main.BadWaferFileException):
+                        main.parse_stdf_file(stdf_path)
+            self.assertEqual(str(wafer_grid), expected_wafer_text)
+
+    def test_raster_wafer_image(self):
+        wafer_grid = main.ChipsGrid(".1X\n"
+                                    "Y1.")
+        image = wafer_raster.make_wafer_image(wafer_grid.states)
+        cell_size = wafer_raster.choose_cell_size(2, 3)
+        margin = image.width - 3 * cell_size - 1
+        self.assertEqual(image.size, (margin + 3 * cell_size + 1, margin + 2 * cell_size + 1))
+        for (row, column), character in zip([(0, 0), (0, 1), (0, 2), (1, 0)], '.1XY'):
+            center = (margin + column * cell_size + cell_size // 2, margin + row * cell_size + cell_size // 2)
+            expected_color = tuple(wafer_raster.palette['.1XY'.index(character)])
+            self.assertEqual(image.getpixel(center), expected_color)
+
+    def test_summary_accumulator_formats(self):
+        summary_accumulator = lot_summary.SummaryAccumulator()
+        for wafer_index in range(3):
+            summary_row = dict(zip(lot_summary.fieldnames, [f'wafer_{wafer_index}', 10, 2, 8, 1, 3, 7, '(0,1)']))
+            summary_accumulator.add_row(summary_row)
+        with tempfile.TemporaryDirectory() as temporary_directory:
+            summary_path = summary_accumulator.write(Path(temporary_directory) / 'summary', 'xlsx')
+            self.assertEqual(summary_path.suffix, '.xlsx')
+            data_frame = pandas.read_excel(summary_path)
+        self.assertEqual(list(data_frame.columns), lot_summary.fieldnames)
+        self.assertEqual(list(data_frame['File_name']), ['wafer_0', 'wafer_1', 'wafer_2'])
+        lot_summary.check_format_packages('xlsx')
+        with unittest.mock.patch.dict(lot_summary.formats_engines, {'parquet': ['no_such_parquet_engine']}):
+            with self.assertRaises(main.WrongArgumentsException):
+                main.summary_format_validation('parquet')
+
+    def test_make_summary(self):
+        input_grid = main.ChipsGrid(".1X\n"
+                                    "11X\n"
+                                    "X1.")
+        output_grid = main.ChipsGrid(".YX\n"
+                                     "1YX\n"
+                                     "XY.")
+        _, summary_row = HtmlViewer.make_summary(input_grid.states, output_grid.states, 'wafer')
+        expected_row_values = ['wafer', 7, 3, 4, 3, 6, 1, '(0,1):(1,1):(2,1)']
+        self.assertDictEqual(summary_row, dict(zip(lot_summary.fieldnames, expected_row_values)))
+
+    def test_benchmark_synthetic_wafers_round_trip(self):
+        random_generator = numpy.random.default_rng(0)
+        states = benchmark.make_synthetic_states(30, 0.1, 0.5, random_generator)
+        self.assertTrue(numpy.any(states == main.ChipState.FAIL.value))
+        with tempfile.TemporaryDirectory() as temporary_directory:
+            text_path, stdf_path = Path(temporary_directory) / 'wafer.txt', Path(temporary_directory) / 'wafer.stdf'
+            benchmark.write_text_wafer(states, text_path)
+            benchmark.write_stdf_wafer(states, stdf_path, random_generator=random_generator)
+            for parse_method, path in [(main.parse_text_file, text_path), (main.parse_stdf_file, stdf_path)]:
+                wafer_grid, _ = parse_method(path)
+                numpy.testing.assert_array_equal(wafer_grid.states, states)
+
+    def test_headless_run_loads_only_needed_modules(self):
+        cwd = Path(__file__).parent
+        with tempfile.TemporaryDirectory() as temporary_directory:
+            check_modules_code = 'import sys\n' \
+                                 'import main\n' \
+                                 'main.get_argument()\n' \
+                                 'print(sorted(m for m in ["gooey", "pandas", "matplotlib"] if m in sys.modules))'
+            command = ['python', '-c', check_modules_code, '--ignore-gooey', '--input_file_path',
+                       f'{self.unit_tests_directory / "unit_test_1_input.txt"}', temporary_directory,
+                       f'{self.unit_tests_directory / self.neighbors_filename}', '--renderer', 'raster',
+                       '--summary_format', 'csv']
+            completed_process = subprocess.run(command, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                               encoding='ascii')
+        self.assertEqual(completed_process.stdout.strip().splitlines()[-1], '[]')
+
+    def test_watch_directories_handles_only_new_complete_files(self):
+        with tempfile.TemporaryDirectory() as temporary_directory:
+            watched_directory, output_directory = Path(temporary_directory) / 'in', Path(temporary_directory) / 'out'
+            watched_directory.mkdir()
+            output_directory.mkdir()
+            shutil.copy(self.unit_tests_directory / 'unit_test_1_input.txt', watched_directory / 'old_wafer.txt')
+            args = main.parse_arguments(main.HeadlessArgumentParser(), [
+                f'{output_directory}', f'{self.unit_tests_directory / self.neighbors_filename}',
+                '--watch_dirs', f'{watched_directory}', '--poll_seconds', '0.02', '--settle_seconds', '0.1',
+                '--renderer', 'raster', '--summary_format', 'csv'])
+            stop_event = threading.Event()
+            watch_thread = threading.Thread(target=watch_mode.watch_directories,
+                                            args=(args, main.handle_file_safely, lot_summary.fieldnames, stop_event),
+                                            kwargs={'plan_wafers_function': main.plan_wafers_of_file})
+            watch_thread.start()
+            try:
+                time.sleep(0.5)  # let the watcher register the existing files first
+                shutil.copy(self.unit_tests_directory / 'unit_test_1_input.txt', watched_directory / 'new_wafer.txt')
+                summary_path = output_directory / 'watch_summary.csv'
+                utils.wait_for_path_to_exists(summary_path, maximum_time_to_wait=10)
+                wafers = [(wafer_id, [(0, 0, False), (0, 1, True)]) for wafer_id in ['W01', 'W02']]
+                (watched_directory / 'lot.stdf').write_bytes(handle_stdf_files.make_multi_wafer_stdf_content(wafers))
+                for _ in range(100):
+                    if len(summary_path.read_text().splitlines()) >= 4:
+                        break
+                    time.sleep(0.1)
+            finally:
+                stop_event.set()
+                watch_thread.join()
+            with open(summary_path, newline='') as summary_file:
+                summary_rows = list(csv.DictReader(summary_file))
+        self.assertEqual([summary_row['File_name'] for summary_row in summary_rows],
+                         ['new_wafer', 'lot_W01', 'lot_W02'])
+
+    def test_directories_watcher_handles_changed_files_again(self):
+        with tempfile.TemporaryDirectory() as temporary_directory:
+            watched_directory = Path(temporary_directory)
+            output_directory = watched_directory / 'out'
+            output_directory.mkdir()
+            (output_directory / 'result_of_wafer.txt').write_text('111')
+            wafer_path = watched_directory / 'wafer.txt'
+            wafer_path.write_text('111')
+            watcher = watch_mode.DirectoriesWatcher([watched_directory], settle_seconds=0,
+                                                    excluded_directories=[output_directory])
+            self.assertEqual(watcher.poll() + watcher.poll(), [])
+            wafer_path.write_text('1X11')
+            self.assertEqual(watcher.poll() + watcher.poll(), [wafer_path])
+            self.assertEqual(watcher.poll(), [])
+            wafer_path.unlink()
+            watcher.poll()
+            self.assertEqual(watcher.handled_files, dict())
+            future = futures.Future()
+            future.set_exception(BrokenProcessPool())
+            self.assertFalse(watch_mode.collect_result(wafer_path, future, output_directory / 'summary.csv',
+                                                       lot_summary.fieldnames))
+
+    def test_result_cache_reuses_results_of_same_content(self):
+        with tempfile.TemporaryDirectory() as temporary_directory:
+            cache_directory, output_directory = Path(temporary_directory) / 'cache', Path(temporary_directory) / 'out'
+            output_directory.mkdir()
+            summary_rows = list()
+            for wafer_name in ['first_wafer', 'same_wafer_again']:
+                input_path = Path(temporary_directory) / f'{wafer_name}.txt'
+                shutil.copy(self.unit_tests_directory / 'unit_test_1_input.txt', input_path)
+                args = main.parse_arguments(main.HeadlessArgumentParser(), [
+                    '--input_file_path', f'{input_path}', f'{output_directory}',
+                    f'{self.unit_tests_directory / self.neighbors_filename}', '--renderer', 'raster',
+                    '--cache_dir', f'{cache_directory}', '--stages_in_summary'])
+                main.create_relevant_directories(args)
+                summary_rows.append(main.handle_file(args))
+            self.assertIn('parse_seconds', summary_rows[0])
+            self.assertNotIn('parse_seconds', summary_rows[1])
+            self.assertEqual(summary_rows[1]['File_name'], 'same_wafer_again')
+            self.assertEqual(summary_rows[0]['Difference_coordinates'], summary_rows[1]['Difference_coordinates'])
+            result_text = (args.output_dir_path / 'result_of_same_wafer_again.txt').read_text()
+            with open(self.unit_tests_directory / 'unit_test_1_expected_output.txt') as expected_output_file:
+                self.assertEqual(result_text, expected_output_file.read())
+            (args.output_dir_path / 'result_of_same_wafer_again.txt').write_text('rewritten')
+            cache = result_cache.ResultCache(cache_directory, max_size_bytes=0)
+            other_output_directory = Path(temporary_directory) / 'other_out'
+            other_output_directory.mkdir()
+            cache_key = result_cache.make_key(input_path, args.neighbors_file_path, main.get_version(),
+                                              main.get_results_options(args))
+            self.assertIsNotNone(cache.load(cache_key, other_output_directory, 'wafer'))
+            self.assertEqual((other_output_directory / 'result_of_wafer.txt').read_text(), result_text)
+            self.assertEqual(len(cache.list_entries()), 1)
+            cache.evict()
+            self.assertEqual(len(cache.list_entries()), 0)
+
+    def test_sweep_matches_algorithm_per_table(self):
+        tables = {'strict': {n: 9 for n in range(9)}, 'default': main.make_dict_of_neighbors_threshold(
+            self.unit_tests_directory / self.neighbors_filename), 'loose': {n: 1 for n in range(9)},
+                  'everything': {n: 0 for n in range(9)}, 'fractional': {n: 2.5 for n in range(9)}}
+        with tempfile.TemporaryDirectory() as temporary_directory:
+            tables_directory = Path(temporary_directory) / 'tables'
+            tables_directory.mkdir()
+            for table_name, table in tables.items():
+                (tables_directory / f'{table_name}.json').write_text(json.dumps(table))
+            shutil.copy(Path(__file__).parent / 'neighbors_kernel_radius_2.json', tables_directory)
+            (tables_directory / 'list.json').write_text('[1, 2]')
+            input_directory = Path(temporary_directory) / 'lot'
+            input_directory.mkdir()
+            shutil.copy(self.unit_tests_directory / 'unit_test_1_input.txt', input_directory)
+            (input_directory / 'bad.stdf').write_bytes(b'not stdf')
+            (input_directory / 'result_of_unit_test_1_input.txt').write_text('111\n111')
+            output_directory = input_directory / 'results'
+            output_directory.mkdir()
+            (output_directory / 'old_wafer.txt').write_text('111\n111')
+            args = main.parse_arguments(main.HeadlessArgumentParser(), [
+                '-i_dir', '--input_dir_path', f'{input_directory}', f'{output_directory}',
+                f'{self.unit_tests_directory / self.neighbors_filename}', '--summary_format', 'csv',
+                '--sweep_tables', f'{tables_directory}'])
+            sweep_matrix_path = main.handle_sweep(args)
+            with open(sweep_matrix_path, newline='') as sweep_matrix_file:
+                sweep_rows = {row['File_name']: row for row in csv.DictReader(sweep_matrix_file)}
+            self.assertEqual(sorted(sweep_rows), ['bad', 'unit_test_1_input'])
+            self.assertNotEqual(sweep_rows['bad']['Error'], '')
+            self.assertEqual(sweep_rows['unit_test_1_input']['Error'], '')
+            self.assertNotIn('neighbors_kernel_radius_2', sweep_rows['bad'])
+            input_grid, _ = main.parse_file(self.unit_tests_directory / 'unit_test_1_input.txt')
+            for table_name in tables:
+                output_grid = main.apply_algorithm_on_grid(input_grid, tables_directory / f'{table_name}.json')
+                expected_new_fails = str(output_grid).count('Y')
+                self.assertEqual(int(sweep_rows['unit_test_1_input'][table_name]), expected_new_fails)
+
+    def test_chips_are_views_on_grid(self):
+        wafer_grid = main.ChipsGrid(".1X\n"
+                                    "Y1.")
+        self.assertEqual(''.join(str(chip) for chip in wafer_grid), '.1XY1.')
+        for chip in wafer_grid:
+            if chip.state == main.ChipState.PASS:
+                chip.state = main.ChipState.FAIL_BY_PREDICTION
+        self.assertEqual(str(wafer_grid), ".YX\nYY.")
+        copied_grid = copy.deepcopy(wafer_grid)
+        copied_grid.chip_at(0, 0).state = main.ChipState.FAIL
+        self.assertEqual(wafer_grid.chip_at(0, 0).state, main.ChipState.NOT_EXISTS)
+        self.assertFalse(hasattr(wafer_grid.chip_at(0, 0), '__dict__'))
+        standalone_chip = main.Chip(3, 4, 'X')
+        self.assertEqual((standalone_chip.row, standalone_chip.column, standalone_chip.state),
+                         (3, 4, main.ChipState.FAIL))
+        self.assertNotEqual(hash(main.Chip(0, 1024, '1')), hash(main.Chip(1, 0, '1')))
+        self.assertEqual(len({main.Chip(row, column, '1') for row in range(64) for column in range(2048)}), 64 * 2048)
+
+    def test_wafer_map_file(self):
+        random_generator = numpy.random.default_rng(0)
+        with tempfile.TemporaryDirectory() as temporary_directory:
+            for rows, columns in [(1, 1), (3, 5), (17, 20), (0, 0)]:
+                states = random_generator.integers(0, 4, size=(rows, columns), dtype=numpy.uint8)
+                map_path = Path(temporary_directory) / f'wafer_{rows}_{columns}.wmap'
+                wafer_map_file.write_wafer_map(map_path, states, bytes(32), 'lot', 'wafer', 'a\n$wafer\n$$')
+                wafer_map = wafer_map_file.read_wafer_map(map_path)
+                numpy.testing.assert_array_equal(wafer_map.states, states)
+                self.assertEqual(wafer_map[1:], ('lot', 'wafer', 'a\n$wafer\n$$', bytes(32)))
+                self.assertEqual(map_path.stat().st_size,
+                                 wafer_map_file.header_struct.size + 19 + math.ceil(rows * columns / 4))
+            wafer_path = Path(temporary_directory) / 'wafer.txt'
+            wafer_path.write_text('header $1\n.1X\nX1.\nfooter')
+            maps_directory = Path(temporary_directory) / 'maps'
+            maps_directory.mkdir()
+            for _ in range(2):
+                wafer_grid, rest_of_file = main.parse_file(wafer_path, maps_directory)
+                self.assertEqual(str(wafer_grid), '.1X\nX1.')
+                self.assertEqual(rest_of_file.substitute(wafer='W'), 'header $1\nW\nfooter')
+            self.assertEqual(len(list(maps_directory.glob('*.wmap'))), 1)
+
+    def test_apply_algorithm_on_grids(self):
+        neighbors_path = self.unit_tests_directory / self.neighbors_filename
+        random_wafers = list(self.get_random_sample_points((17, 13), 5))
+        random_wafers += list(self.get_random_sample_points((9, 21), 3))
+        wafer_grids = [main.ChipsGrid(random_wafer) for random_wafer in random_wafers]
+        wafers_names = [f'wafer_{wafer_index}' for wafer_index in range(len(wafer_grids))]
+        result_grids, summary_rows, fail_frequency = main.apply_algorithm_on_grids(wafer_grids, neighbors_path,
+                                                                                   wafers_names)
+        self.assertEqual(fail_frequency.shape, (21, 17))
+        for wafer_grid, wafer_name, result_grid, summary_row in zip(wafer_grids, wafers_names, result_grids,
+                                                                    summary_rows):
+            expected_grid = main.apply_algorithm_on_grid(wafer_grid, neighbors_path)
+            self.assertEqual(str(result_grid), str(expected_grid))
+            self.assertEqual(summary_row, HtmlViewer.make_summary(wafer_grid.states, expected_grid.states,
+                                                                  wafer_name)[1])
+        is_failed = [numpy.isin(result_grid.states, [main.ChipState.FAIL.value,
+                                                     main.ChipState.FAIL_BY_PREDICTION.value])
+                     for result_grid in result_grids]
+        existing_number = sum(result_grid.states[0, 0] != main.ChipState.NOT_EXISTS.value
+                              for result_grid in result_grids)
+        self.assertAlmostEqual(fail_frequency[0, 0],
+                               sum(failed[0, 0] for failed in is_failed) / max(existing_number, 1))
+
+    def test_handle_directory_with_lot_map(self):
+        with tempfile.TemporaryDirectory() as temporary_directory:
+            input_directory = Path(temporary_directory) / 'lot'
+            (input_directory / 'inner').mkdir(parents=True)
+            (input_directory / 'wafer_1.txt').write_text('.XX1\n1X11\n1111')
+            (input_directory / 'inner/wafer_2.txt').write_text('.1X1\n1111\n1111\n11X1')
+            output_directory = Path(temporary_directory) / 'results'
+            output_directory.mkdir()
+            args = main.parse_arguments(main.HeadlessArgumentParser(), [
+                '-i_dir', '--input_dir_path', f'{input_directory}', f'{output_directory}',
+                f'{self.unit_tests_directory / self.neighbors_filename}', '--renderer', 'raster',
+                '--summary_format', 'csv', '--lot_map'])
+            args.run_date = '2020_01_01_00_00_00'
+            main.handle_directory(args)
+            lot_output_directory = output_directory / 'results_of_lot_Date_2020_01_01_00_00_00'
+            self.assertTrue((lot_output_directory / 'lot_map.png').exists())
+            lot_arrays = numpy.load(lot_output_directory / 'lot_map.npz')
+            self.assertEqual(int(lot_arrays['wafers_number']), 2)
+            numpy.testing.assert_array_equal(lot_arrays['existing_counts'], [[0, 2, 2, 2], [2, 2, 2, 2],
+                                                                             [2, 2, 2, 2], [1, 1, 1, 1]])
+            numpy.testing.assert_array_equal(lot_arrays['fail_counts'], [[0, 1, 2, 0], [0, 1, 0, 0],
+                                                                         [0, 0, 0, 0], [0, 0, 1, 0]])
+            expected_predicted_fails = list()
+            for wafer_text in ['.XX1\n1X11\n1111', '.1X1\n1111\n1111\n11X1']:
+                result_grid = main.apply_algorithm_on_grid(main.ChipsGrid(wafer_text), args.neighbors_file_path)
+                expected_predicted_fails.append(result_grid.states == main.ChipState.FAIL_BY_PREDICTION.value)
+            numpy.testing.assert_array_equal(lot_arrays['predicted_fail_counts'],
+                                             grid_algorithm.stack_states(expected_predicted_fails).sum(axis=0))
+            inner_arrays = numpy.load(next(lot_output_directory.glob('results_of_inner_*')) / 'lot_map.npz')
+            self.assertEqual(int(inner_arrays['wafers_number']), 1)
+
+    def test_report_modes(self):
+        with tempfile.TemporaryDirectory() as temporary_directory:
+            input_directory = Path(temporary_directory) / 'lot'
+            input_directory.mkdir()
+            shutil.copy(self.unit_tests_directory / 'unit_test_1_input.txt', input_directory / 'wafer_1.txt')
+            (input_directory / 'wafer_2.txt').write_text('1111\n1111\n1111')
+            output_directory = Path(temporary_directory) / 'results'
+            output_directory.mkdir()
+            reports_numbers = dict()
+            for workers in ['2', '1']:
+                for report_options in [['background'], ['threshold', '--report_threshold', '0'], ['deferred']]:
+                    args = main.parse_arguments(main.HeadlessArgumentParser(), [
+                        '-i_dir', '--input_dir_path', f'{input_directory}', f'{output_directory}',
+                        f'{self.unit_tests_directory / self.neighbors_filename}', '--renderer', 'raster',
+                        '--summary_format', 'csv', '--workers', workers, '--report_mode'] + report_options)
+                    args.run_date = f'{report_options[0]}_{workers}' if workers == '1' else report_options[0]
+                    main.handle_directory(args)
+                    lot_output_directory = output_directory / f'results_of_lot_Date_{args.run_date}'
+                    self.assertEqual(len(list(lot_output_directory.rglob('result_of_*.txt'))), 2)
+                    reports_numbers[args.run_date] = len(list(lot_output_directory.rglob('result_of_*.html')))
+            self.assertDictEqual(reports_numbers, {'background': 2, 'threshold': 1, 'deferred': 0,
+                                                   'background_1': 2, 'threshold_1': 1, 'deferred_1': 0})
+            deferred_directory = output_directory / 'results_of_lot_Date_deferred'
+            args = main.parse_arguments(main.HeadlessArgumentParser(), [
+                f'{output_directory}', f'{self.unit_tests_directory / self.neighbors_filename}', '--renderer',
+                'raster', '--report_dir', f'{deferred_directory}'])
+            reports_paths = main.handle_reports(args)
+            self.assertEqual(sorted(path.name for path in reports_paths),
+                             ['result_of_wafer_1.html', 'result_of_wafer_2.html'])
+            deferred_report = next(deferred_directory.rglob('result_of_wafer_1.html')).read_text()
+            background_report = next((output_directory / 'results_of_lot_Date_background')
+                                     .rglob('result_of_wafer_1.html')).read_text()
+            self.assertEqual(deferred_report, background_report)
+            self.assertEqual(main.handle_reports(args), [])
+
+    def test_background_io_gives_same_results(self):
+        with tempfile.TemporaryDirectory() as temporary_directory:
+            input_directory = Path(temporary_directory) / 'lot'
+            input_directory.mkdir()
+            for wafer_index in range(3):
+                shutil.copy(self.unit_tests_directory / 'unit_test_1_input.txt',
+                            input_directory / f'wafer_{wafer_index}.txt')
+            output_directory = Path(temporary_directory) / 'results'
+            output_directory.mkdir()
+            results_texts = dict()
+            for io_threads in ['0', '2']:
+                args = main.parse_arguments(main.HeadlessArgumentParser(), [
+                    '-i_dir', '--input_dir_path', f'{input_directory}', f'{output_directory}',
+                    f'{self.unit_tests_directory / self.neighbors_filename}', '--summary_format', 'csv',
+                    '--io_threads', io_threads, '--read_ahead', '2'])
+                args.run_date = f'io_threads_{io_threads}'
+                main.handle_directory(args)
+                results_paths = sorted(output_directory.glob(f'*_{args.run_date}/*/result_of_*'))
+                results_texts[io_threads] = [(path.name, path.read_bytes() if path.suffix == '.txt' else None)
+                                             for path in results_paths]
+            self.assertEqual(len(results_texts['0']), 9)
+            self.assertEqual(results_texts['0'], results_texts['2'])
+            prefetcher = io_pipeline.FilesPrefetcher(sorted(input_directory.iterdir()), 2, 1)
+            prefetcher.advance(0)
+            self.assertEqual(prefetcher.take(0), (input_directory / 'wafer_0.txt').read_bytes())
+            self.assertIsNone(prefetcher.take(2))
+            prefetcher.close()
+            save_result_as_text = main.save_result_as_text
+
+            def fail_saving_wafer_1(result_text, output_directory_path, input_path):
+                if input_path.stem == 'wafer_1':
+                    raise OSError('No space left on device')
+                save_result_as_text(result_text, output_directory_path, input_path)
+
+            args.run_date = 'failed_write'
+            with unittest.mock.patch.object(main, 'save_result_as_text', fail_saving_wafer_1):
+                main.handle_directory(args)
+            lot_summary_path = next(output_directory.rglob('*_failed_write/summary_1_sheet_merged_*.csv'))
+            with open(lot_summary_path, newline='') as lot_summary_file:
+                summary_rows = list(csv.DictReader(lot_summary_file))
+            self.assertEqual(sorted(summary_row['File_name'] for summary_row in summary_rows), ['wafer_0', 'wafer_2'])
+        writer = io_pipeline.BackgroundWriter(2, max_pending_writes=1)
+        written_numbers = list()
+        for number in range(5):
+            writer.submit(written_numbers.append, number)
+        writer.submit(int, 'not a number')
+        self.assertEqual(writer.close(), 1)
+        self.assertEqual(sorted(written_numbers), list(range(5)))
+
+    def test_weigh_neighbors_by_rings(self):
+        random_generator = numpy.random.default_rng(4)
+        with open(Path(__file__).parent / 'neighbors_kernel_radius_2.json') as kernel_file:
+            shipped_kernel = neighborhood_kernels.make_kernel(json.load(kernel_file)['kernel'])
+        rings_kernel = numpy.zeros((7, 7))
+        for radius, weight in [(3, 0.5), (2, 0), (1, 1.5)]:
+            rings_kernel[3 - radius: 4 + radius, 3 - radius: 4 + radius] = weight
+        kernels = [shipped_kernel, neighborhood_kernels.make_kernel({'radius': 3}),
+                   neighborhood_kernels.make_kernel(rings_kernel)]
+        self.assertEqual(neighborhood_kernels.find_rings_weights(shipped_kernel), [2, 1])
+        self.assertIsNone(neighborhood_kernels.find_rings_weights(numpy.array([[1, 0, 1], [1, 0, 1], [1, 1, 1]])))
+        for mask in [random_generator.random((13, 9)) < 0.6, random_generator.random((3, 8, 11)) < 0.6]:
+            for kernel in kernels:
+                numpy.testing.assert_allclose(neighborhood_kernels.weigh_neighbors(mask, kernel),
+                                              neighborhood_kernels.weigh_neighbors_by_shifts(mask, kernel))
+
+    def test_neighborhood_kernels(self):
+        neighbors_table = main.make_dict_of_neighbors_threshold(self.unit_tests_directory / self.neighbors_filename)
+        kernel = [[1, 0, 2, 0, 1], [0, 3, 3, 3, 0], [2, 3, 0, 3, 2], [0, 3, 3, 3, 0], [1, 0, 2, 0, 1]]
+        configs = {'same_as_table': {'kernel': {'radius': 1}, 'threshold': {'table': neighbors_table}},
+                   'weighted': {'kernel': kernel, 'threshold': {'fraction': 0.4, 'minimum': 3},
+                                'edge_ring': {'width': 1, 'threshold': {'fraction': 0.6, 'minimum': 2}}}}
+        with tempfile.TemporaryDirectory() as temporary_directory:
+            for config_name, config in configs.items():
+                with open(Path(temporary_directory) / f'{config_name}.json', 'w') as config_file:
+                    json.dump(config, config_file)
+            for random_wafer in self.get_random_sample_points((15, 11), 10):
+                wafer_grid = main.ChipsGrid(random_wafer)
+                expected_grid = main.apply_algorithm_on_grid(wafer_grid, self.unit_tests_directory /
+                                                             self.neighbors_filename)
+                same_grid = main.apply_algorithm_on_grid(wafer_grid, Path(temporary_directory) / 'same_as_table.json')
+                self.assertEqual(str(same_grid), str(expected_grid))
+                weighted_grid = main.apply_algorithm_on_grid(wafer_grid, Path(temporary_directory) / 'weighted.json')
+                states = wafer_grid.states
+                for (row, column), state in numpy.ndenumerate(states):
+                    neighbors_weight, fail_weight, is_edge = 0, 0, False
+                    for (kernel_row, kernel_column), weight in numpy.ndenumerate(numpy.array(kernel)):
+                        neighbor_row, neighbor_column = row + kernel_row - 2, column + kernel_column - 2
+                        is_inside = 0 <= neighbor_row < 11 and 0 <= neighbor_column < 15
+                        neighbor_state = states[neighbor_row, neighbor_column] if is_inside else 0
+                        if max(abs(kernel_row - 2), abs(kernel_column - 2)) <= 1:
+                            is_edge |= neighbor_state == main.ChipState.NOT_EXISTS.value
+                        neighbors_weight += weight * (neighbor_state != main.ChipState.NOT_EXISTS.value)
+                        fail_weight += weight * (neighbor_state == main.ChipState.FAIL.value)
+                    threshold = max(2, 0.6 * neighbors_weight) if is_edge else max(3, 0.4 * neighbors_weight)
+                    is_predicted = state == main.ChipState.PASS.value and fail_weight >= threshold
+                    expected_state = main.ChipState.FAIL_BY_PREDICTION.value if is_predicted else state
+                    self.assertEqual(weighted_grid.states[row, column], expected_state)
+
+    def test_classification_service(self):
+        neighbors_path = self.unit_tests_directory / self.neighbors_filename
+        server = classification_service.make_server('127.0.0.1', 0, main.classify_wafers_contents, neighbors_path,
+                                                    main.get_version())
+        server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+        server_thread.start()
+        service_url = f'http://127.0.0.1:{server.server_address[1]}'
+
+        def post(path, body):
+            request = urllib.request.Request(service_url + path, data=body, method='POST')
+            try:
+                with urllib.request.urlopen(request, timeout=10) as response:
+                    return response.status, json.loads(response.read())
+            except urllib.error.HTTPError as error:
+                return error.code, json.loads(error.read())
+
+        try:
+            with urllib.request.urlopen(service_url + '/health', timeout=10) as response:
+                self.assertEqual(json.loads(response.read())['status'], 'ok')
+            input_text = (self.unit_tests_directory / 'unit_test_1_input.txt').read_text()
+            expected_grid = main.apply_algorithm_on_grid(main.parse_text_content(input_text)[0], neighbors_path)
+            status, result = post('/classify?name=wafer_1', input_text.encode())
+            self.assertEqual(status, 200)
+            self.assertEqual(result['wafer'], str(expected_grid))
+            self.assertEqual(result['summary']['File_name'], 'wafer_1')
+            stdf_content = handle_stdf_files.make_stdf_content([(0, 0, True), (0, 1, False), (1, 0, True)])
+            multi_wafer_content = handle_stdf_files.make_multi_wafer_stdf_content(
+                [('W01', [(0, 0, True)]), ('W02', [(0, 0, False)])])
+            status, multi_wafer_result = post('/classify?type=stdf', multi_wafer_content)
+            self.assertEqual(status, 422)
+            self.assertIn('2 wafers', multi_wafer_result['error'])
+            batch = {'wafers': [{'name': 'text', 'content': input_text},
+                                {'name': 'stdf', 'type': 'stdf', 'content': base64.b64encode(stdf_content).decode()},
+                                {'name': 'broken', 'content': 'no wafer here'}]}
+            status, batch_result = post('/batch', json.dumps(batch).encode())
+            self.assertEqual(status, 200)
+            text_result, stdf_result, broken_result = batch_result['results']
+            self.assertEqual(text_result['result_text'], result['result_text'])
+            self.assertEqual(stdf_result['wafer'], 'XY\nX.')
+            self.assertIn('error', broken_result)
+            self.assertEqual(post('/classify?type=pdf', b'')[0], 400)
+            self.assertEqual(post('/batch', b'not json')[0], 400)
+            server.max_body_bytes = 10
+            self.assertEqual(post('/classify', input_text.encode())[0], 413)
+            for content_length in [None, 'many']:
+                connection = http.client.HTTPConnection('127.0.0.1', server.server_address[1], timeout=10)
+                connection.putrequest('POST', '/classify', skip_accept_encoding=True)
+                if content_length is not None:
+                    connection.putheader('Content-Length', content_length)
+                connection.endheaders()
+                self.assertEqual(connection.getresponse().status, 400)
+                connection.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_propagate_fails(self):
+        neighbors_path = self.unit_tests_directory / self.neighbors_filename
+        thresholds_lookup = grid_algorithm.make_thresholds_lookup(main.make_dict_of_neighbors_threshold(neighbors_path))
+        random_generator = numpy.random.default_rng(0)
+        for _ in range(20):
+            states = random_generator.choice([0, 1, 1, 1, 2], size=(random_generator.integers(1, 30), 25))
+            states = states.astype(numpy.uint8)
+            expected_states, expected_flips = states.copy(), list()
+            while True:
+                fails_states = numpy.where(expected_states == main.ChipState.FAIL_BY_PREDICTION.value,
+                                           main.ChipState.FAIL.value, expected_states).astype(numpy.uint8)
+                round_states = grid_algorithm.classify_states(fails_states, thresholds_lookup)
+                new_fails = (round_states == main.ChipState.FAIL_BY_PREDICTION.value) & \
+                            (expected_states == main.ChipState.PASS.value)
+                if not new_fails.any():
+                    break
+                expected_states[new_fails] = main.ChipState.FAIL_BY_PREDICTION.value
+                expected_flips.append(int(new_fails.sum()))
+            result_states, flips_per_round = grid_algorithm.propagate_fails(states, thresholds_lookup)
+            numpy.testing.assert_array_equal(result_states, expected_states)
+            self.assertEqual(flips_per_round, expected_flips)
+            first_round_states, _ = grid_algorithm.propagate_fails(states, thresholds_lookup, max_rounds=1)
+            numpy.testing.assert_array_equal(first_round_states,
+                                             grid_algorithm.classify_states(states, thresholds_lookup))
+        result_grid, flips_per_round = main.apply_propagation_on_grid(main.ChipsGrid('XX1111\n1X1111\n111111'),
+                                                                      neighbors_path)
+        self.assertEqual(main.make_propagation_columns(flips_per_round),
+                         {'Propagation_rounds': len(flips_per_round),
+                          'Fails_per_round': ':'.join(map(str, flips_per_round))})
+        self.assertEqual(sum(flips_per_round), numpy.count_nonzero(result_grid.states == 3))
+        args = main.parse_arguments(main.HeadlessArgumentParser(), [
+            '--input_file_path', f'{self.unit_tests_directory / "unit_test_1_input.txt"}', '.', f'{neighbors_path}',
+            '--propagate', '--max_rounds', '-1'])
+        with self.assertRaises(main.WrongArgumentsException):
+            main.arguments_validation(args)
+
+    def test_reclassify_changed_chips(self):
+        neighbors_path = self.unit_tests_directory / self.neighbors_filename
+        thresholds_lookup = main.get_thresholds_lookup(neighbors_path)
+        random_generator = numpy.random.default_rng(1)
+        for _ in range(20):
+            input_states = random_generator.choice([0, 1, 1, 2], size=(random_generator.integers(1, 20), 15))
+            input_states = input_states.astype(numpy.uint8)
+            result_grid = main.ChipsGrid.make_chips_grid_from_states(
+                grid_algorithm.classify_states(input_states, thresholds_lookup))
+            _, summary_row = HtmlViewer.make_summary(input_states, result_grid.states, 'wafer')
+            new_input_states = input_states.copy()
+            changes_number = random_generator.integers(0, 6)
+            rows = random_generator.integers(0, input_states.shape[0], changes_number)
+            columns = random_generator.integers(0, input_states.shape[1], changes_number)
+            new_input_states[rows, columns] = random_generator.choice([0, 1, 2], changes_number)
+            changes = grid_algorithm.find_input_changes(result_grid.states, new_input_states)
+            main.apply_changes_on_result(result_grid, changes, neighbors_path, summary_row)
+            # chips missing from the new input keep their state
+            new_input_states = numpy.where(new_input_states == grid_algorithm.NOT_EXISTS, input_states,
+                                           new_input_states)
+            expected_states = grid_algorithm.classify_states(new_input_states, thresholds_lookup)
+            numpy.testing.assert_array_equal(result_grid.states, expected_states)
+            self.assertDictEqual(summary_row, HtmlViewer.make_summary(new_input_states, expected_states, 'wafer')[1])
+        with tempfile.TemporaryDirectory() as temporary_directory:
+            input_path = Path(temporary_directory) / 'wafer.txt'
+            input_path.write_text('111\n111')
+            args = main.parse_arguments(main.HeadlessArgumentParser(), [
+                '--input_file_path', f'{input_path}', temporary_directory, f'{neighbors_path}',
+                '--report_mode', 'deferred'])
+            main.create_relevant_directories(args)
+            main.handle_file(args)
+            output_directory = args.output_dir_path
+            result_path = output_directory / 'result_of_wafer.txt'
+            changes_path = Path(temporary_directory) / 'changes.txt'
+            changes_path.write_text('# row,column,state\n0,0,X\n0,1,X\n')
+            update_arguments = [f'{output_directory}', f'{neighbors_path}', '--summary_format', 'csv',
+                                '--report_mode', 'deferred', '--update_result', f'{result_path}']
+            args = main.parse_arguments(main.HeadlessArgumentParser(),
+                                        update_arguments + ['--die_changes', f'{changes_path}'])
+            summary_row = main.handle_result_update(args)
+            self.assertEqual(result_path.read_text(), 'XX1\nY11')
+            self.assertEqual((summary_row['Difference_coordinates'], summary_row['Initially_failed']), ('(1,0)', 2))
+            result_record = json.loads(result_path.with_suffix('.json').read_text())
+            self.assertEqual(result_record['summary_row'], summary_row)
+            for wrong_line in ['0,0,Z', '1,1,', '0,0,1X', '0,0,Y']:
+                changes_path.write_text(f'{wrong_line}\n')
+                with self.assertRaises(main.WrongArgumentsException):
+                    main.handle_result_update(args)
+            retest_path = Path(temporary_directory) / 'retest.stdf'
+            retest_path.write_bytes(handle_stdf_files.make_stdf_content([(0, 0, True), (0, 0, False), (1, 2, True)]))
+            args = main.parse_arguments(main.HeadlessArgumentParser(),
+                                        update_arguments + ['--retest', f'{retest_path}'])
+            summary_row = main.handle_result_update(args)
+            expected_states = grid_algorithm.classify_states(main.ChipsGrid('1X1\n11X').states, thresholds_lookup)
+            self.assertEqual(result_path.read_text(), str(main.ChipsGrid.make_chips_grid_from_states(expected_states)))
+            self.assertDictEqual(summary_row, HtmlViewer.make_summary(main.ChipsGrid('1X1\n11X').states,
+                                                                      expected_states, 'wafer')[1])
+            retest_path.write_bytes(handle_stdf_files.make_stdf_content([(2, 0, True)]))
+            with self.assertRaises(main.WrongArgumentsException):
+                main.handle_result_update(args)
+            result_record['classification']['classification'] = 'propagate:3'
+            result_path.with_suffix('.json').write_text(json.dumps(result_record))
+            with self.assertRaises(main.WrongArgumentsException):
+                main.handle_result_update(args)
+            result_path.with_suffix('.json').unlink()
+            with self.assertRaises(main.WrongArgumentsException):
+                main.handle_result_update(args)
+
+    def test_geometry_cache(self):
+        thresholds_lookup = main.get_thresholds_lookup(self.unit_tests_directory / self.neighbors_filename)
+        cache = geometry_cache.GeometryCache(thresholds_lookup, max_geometries=2)
+        random_generator = numpy.random.default_rng(2)
+        is_existing = random_generator.random((12, 10)) < 0.8
+        for _ in range(5):
+            states = numpy.where(is_existing, random_generator.choice([1, 1, 2], is_existing.shape), 0)
+            states = states.astype(numpy.uint8)
+            numpy.testing.assert_array_equal(cache.classify(states, key='product'),
+                                             grid_algorithm.classify_states(states, thresholds_lookup))
+            numpy.testing.assert_array_equal(cache.classify(states),
+                                             grid_algorithm.classify_states(states, thresholds_lookup))
+        self.assertEqual((cache.hits, cache.misses), (8, 2))
+        other_states = numpy.ones((12, 10), dtype=numpy.uint8)
+        numpy.testing.assert_array_equal(cache.classify(other_states, key='product'),
+                                         grid_algorithm.classify_states(other_states, thresholds_lookup))
+        self.assertEqual(len(cache.geometries), 2)
+        stacked_states = grid_algorithm.stack_states([states, other_states[:5], numpy.full((3, 3), 2, numpy.uint8)])
+        numpy.testing.assert_array_equal(cache.classify(stacked_states),
+                                         grid_algorithm.classify_states(stacked_states, thresholds_lookup))
+
+    def test_multi_wafer_stdf(self):
+        random_generator = numpy.random.default_rng(3)
+        wafers = [(wafer_id, [(row, column, bool(random_generator.random() < 0.3))
+                              for row in range(6) for column in range(7)]) for wafer_id in ['W01', 'W02', 'W03']]
+        with tempfile.TemporaryDirectory() as temporary_directory:
+            stdf_path = Path(temporary_directory) / 'lot.stdf'
+            stdf_path.write_bytes(handle_stdf_files.make_multi_wafer_stdf_content(wafers))
+            sections = handle_stdf_files.read_wafer_sections(stdf_path)
+            self.assertEqual([section.wafer_id for section in sections], ['W01', 'W02', 'W03'])
+            self.assertTrue(handle_stdf_files.get_index_path(stdf_path).exists())
+            self.assertEqual(handle_stdf_files.read_wafer_sections(stdf_path), sections)
+            output_directory = Path(temporary_directory) / 'results'
+            output_directory.mkdir()
+            args = main.parse_arguments(main.HeadlessArgumentParser(), [
+                '--input_file_path', f'{stdf_path}', f'{output_directory}',
+                f'{self.unit_tests_directory / self.neighbors_filename}', '--renderer', 'raster',
+                '--summary_format', 'csv', '--workers', '2', '--line_summary'])
+            summary_rows = main.handle_input_file(args)
+            self.assertEqual([summary_row['File_name'] for summary_row in summary_rows],
+                             ['lot_W01', 'lot_W02', 'lot_W03'])
+            for wafer_id, parts in wafers:
+                wafer_output_directory = output_directory / f'results_of_lot_{wafer_id}_Date_{args.run_date}'
+                result_states = main.parse_text_file(wafer_output_directory / f'result_of_lot_{wafer_id}.txt')[0]
+                expected_states = main.apply_algorithm_on_grid(main.ChipsGrid.make_chips_grid_from_states(
+                    handle_stdf_files.read_stdf_states_from_content(handle_stdf_files.make_stdf_content(parts))),
+                    args.neighbors_file_path)
+                numpy.testing.assert_array_equal(result_states.states, expected_states.states)
+            args.wafer_id, args.run_date = 'W02', 'one_wafer'
+            self.assertEqual(len(main.handle_input_file(args)), 1)
+            self.assertEqual(len(list(output_directory.glob('results_of_lot_W02_Date_*'))), 2)
+            with self.assertRaises(main.BadWaferFileException):
+                main.parse_file(stdf_path, wafer_id='W04')
+            single_wafer_path = Path(temporary_directory) / 'single.stdf'
+            single_wafer_path.write_bytes(handle_stdf_files.make_stdf_content(wafers[0][1]))
+            args.wafer_id = None
+            files_arguments = list()
+            for input_path in [single_wafer_path, stdf_path]:
+                files_arguments.append(copy.deepcopy(args))
+                files_arguments[-1].input_wafer_path = input_path
+            wafers_arguments = main.plan_wafers_of_files(files_arguments, workers_number=2)
+            self.assertEqual([main.get_wafer_path(wafer_arguments).stem for wafer_arguments in wafers_arguments],
+                             ['single', 'lot_W01', 'lot_W02', 'lot_W03'])
+            self.assertFalse(handle_stdf_files.get_index_path(single_wafer_path).exists())
+            parts_before_wafers_content = handle_stdf_files.make_stdf_content(wafers[0][1]) + \
+                stdf_path.read_bytes()[len(handle_stdf_files.make_far_record()):]
+            with self.assertLogs('ChipProductionLogger', level='WARNING'):
+                self.assertEqual(len(handle_stdf_files.index_wafer_sections(parts_before_wafers_content)), 3)
+
     def test_make_dict_of_neighbors_threshold(self):
         neighbors_filename = 'neighbors_table.json'
         neighbors_path = self.unit_tests_directory / neighbors_filename
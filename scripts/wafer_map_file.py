@@ -0,0 +1,90 @@
+"""
+Binary wafer map files, a compact cache of parsed wafer files.
+The file is a header (see header_struct), the lot id, the wafer id and the text template of the source
+file (utf-8), and then the states packed in 2 bits per die, 4 dies per byte, ordered by rows.
+The source hash is the sha256 of the source file bytes, a map is valid only for the same source content.
+"""
+import hashlib
+import mmap
+import os
+import struct
+import uuid
+from collections import namedtuple
+
+import numpy
+
+import result_cache
+
+MAGIC = b'WMAP'
+FORMAT_VERSION = 1
+SUFFIX = '.wmap'
+DIES_PER_BYTE = 4
+# magic, format version, rows, columns, lot id length, wafer id length, template length, source sha256
+header_struct = struct.Struct('<4sHIIHHI32s')
+shifts = numpy.arange(DIES_PER_BYTE, dtype=numpy.uint8) * 2
+
+WaferMap = namedtuple('WaferMap', ['states', 'lot_id', 'wafer_id', 'template_text', 'source_hash'])
+
+
+def hash_source(path, content=None):
+    """
+    :param content: the bytes of the file when it was already read.
+    :return: sha256 digest (bytes) of the file content.
+    """
+    if content is not None:
+        return hashlib.sha256(content).digest()
+    hash_object = hashlib.sha256()
+    result_cache.hash_file(path, hash_object)
+    return hash_object.digest()
+
+
+def pack_states(states):
+    flat_states = numpy.zeros(-(-states.size // DIES_PER_BYTE) * DIES_PER_BYTE, dtype=numpy.uint8)
+    flat_states[:states.size] = states.reshape(-1)
+    return numpy.bitwise_or.reduce(flat_states.reshape(-1, DIES_PER_BYTE) << shifts, axis=1).astype(numpy.uint8)
+
+
+def unpack_states(packed_states, rows, columns):
+    flat_states = (packed_states[:, numpy.newaxis] >> shifts) & 3
+    return flat_states.reshape(-1)[:rows * columns].reshape(rows, columns)
+
+
+def write_wafer_map(path, states, source_hash, lot_id='', wafer_id='', template_text=''):
+    """
+    Write the wafer map into a temporary file and rename it, so readers never see a half written map.
+    """
+    rows, columns = states.shape
+    lot_id_bytes, wafer_id_bytes, template_bytes = (text.encode() for text in (lot_id, wafer_id, template_text))
+    header = header_struct.pack(MAGIC, FORMAT_VERSION, rows, columns, len(lot_id_bytes), len(wafer_id_bytes),
+                                len(template_bytes), source_hash)
+    temporary_path = path.with_name(f'{path.name}.{uuid.uuid4().hex}.tmp')
+    with open(temporary_path, 'wb') as map_file:
+        map_file.write(b''.join([header, lot_id_bytes, wafer_id_bytes, template_bytes, pack_states(states).tobytes()]))
+    os.replace(temporary_path, path)
+
+
+def read_wafer_map(path):
+    """
+    Read wafer map file through mmap, the packed states are unpacked straight from the mapped pages.
+    :return: WaferMap.
+    """
+    with open(path, 'rb') as map_file, mmap.mmap(map_file.fileno(), 0, access=mmap.ACCESS_READ) as content:
+        if len(content) < header_struct.size:
+            raise ValueError(f'The wafer map {path} is too short.')
+        magic, format_version, rows, columns, lot_id_length, wafer_id_length, template_length, source_hash = \
+            header_struct.unpack_from(content)
+        if magic != MAGIC or format_version != FORMAT_VERSION:
+            raise ValueError(f'The file {path} is not a wafer map of version {FORMAT_VERSION}.')
+        texts = list()
+        offset = header_struct.size
+        for length in [lot_id_length, wafer_id_length, template_length]:
+            texts.append(content[offset: offset + length].decode())
+            offset += length
+        packed_length = -(-rows * columns // DIES_PER_BYTE)
+        if len(content) != offset + packed_length:
+            raise ValueError(f'The wafer map {path} has {len(content) - offset} bytes of states '
+                             f'while {packed_length} were expected.')
+        packed_states = numpy.frombuffer(content, dtype=numpy.uint8, count=packed_length, offset=offset)
+        states = unpack_states(packed_states, rows, columns)
+        del packed_states  # release the mmap buffer before it is closed
+    return WaferMap(states, *texts, source_hash)
@@ -0,0 +1,116 @@
+import numpy
+from PIL import Image
+from PIL import ImageDraw
+
+import grid_algorithm
+
+# same colors as the table renderer: '.' white, '1' green, 'X' red, 'Y' yellow (indexed by state code)
+palette = numpy.zeros((256, 3), dtype=numpy.uint8)
+palette[:] = (255, 192, 203)  # pink for unknown states
+palette[grid_algorithm.NOT_EXISTS] = (255, 255, 255)
+palette[grid_algorithm.PASS] = (0, 128, 0)
+palette[grid_algorithm.FAIL] = (255, 0, 0)
+palette[grid_algorithm.FAIL_BY_PREDICTION] = (191, 191, 0)
+heatmap_stops = [0, 0.5, 1]
+heatmap_colors = numpy.array([(0, 128, 0), (255, 255, 0), (255, 0, 0)])
+grid_lines_color = (160, 160, 160)
+axis_color = (0, 0, 0)
+
+MAX_IMAGE_SIZE = 2000
+MIN_CELL_SIZE, MAX_CELL_SIZE = 3, 16
+CHARACTER_WIDTH, CHARACTER_HEIGHT = 6, 11
+
+
+def choose_cell_size(rows_number, columns_number):
+    cell_size = MAX_IMAGE_SIZE // max(rows_number, columns_number, 1)
+    return min(max(cell_size, MIN_CELL_SIZE), MAX_CELL_SIZE)
+
+
+def choose_tick_step(cell_size, max_label_length):
+    """
+    Choose distance between axis labels such that labels are not overlapping.
+    :return: step from 1, 2, 5, 10, 20, 50...
+    """
+    minimal_step = (max_label_length * CHARACTER_WIDTH + 4) / cell_size
+    step = 1
+    while step < minimal_step:
+        for multiplier in (2, 5, 10):
+            if step * multiplier >= minimal_step:
+                return step * multiplier
+        step *= 10
+    return step
+
+
+def make_wafer_pixels(states, cell_size):
+    """
+    Scale the states array into RGB pixels, every chip is cell_size x cell_size square
+    with grid line at its top and left edges.
+    :return: uint8 array of shape (rows * cell_size, columns * cell_size, 3).
+    """
+    return scale_cells_colors(palette[states], cell_size)
+
+
+def scale_cells_colors(cells_colors, cell_size):
+    pixels = numpy.repeat(numpy.repeat(cells_colors, cell_size, axis=0), cell_size, axis=1)
+    if cell_size > MIN_CELL_SIZE:
+        pixels[::cell_size, :] = grid_lines_color
+        pixels[:, ::cell_size] = grid_lines_color
+    return pixels
+
+
+def draw_axis(draw, rows_number, columns_number, cell_size, margin):
+    tick_step = choose_tick_step(cell_size, len(str(max(rows_number, columns_number))))
+    for column in range(0, columns_number, tick_step):
+        x_position = margin + column * cell_size + cell_size // 2
+        draw.line([(x_position, margin - 3), (x_position, margin - 1)], fill=axis_color)
+        draw.text((x_position - len(str(column)) * CHARACTER_WIDTH // 2, 1), str(column), fill=axis_color)
+    for row in range(0, rows_number, tick_step):
+        y_position = margin + row * cell_size + cell_size // 2
+        draw.line([(margin - 3, y_position), (margin - 1, y_position)], fill=axis_color)
+        draw.text((1, y_position - CHARACTER_HEIGHT // 2), str(row), fill=axis_color)
+
+
+def make_heatmap_colors(values, is_existing):
+    """
+    :param values: array of numbers between 0 and 1.
+    :param is_existing: boolean array, not existing cells are white.
+    :return: uint8 array of RGB colors from green (0) through yellow to red (1).
+    """
+    cells_colors = numpy.stack([numpy.interp(values, heatmap_stops, heatmap_colors[:, channel])
+                                for channel in range(3)], axis=-1).astype(numpy.uint8)
+    cells_colors[~is_existing] = palette[grid_algorithm.NOT_EXISTS]
+    return cells_colors
+
+
+def make_wafer_image(states):
+    """
+    Make image of wafer map with columns axis at the top and rows axis at the left.
+    :param states: 2D states array.
+    :return: PIL image.
+    """
+    return make_map_image(palette[states])
+
+
+def make_map_image(cells_colors):
+    """
+    :param cells_colors: uint8 array of shape (rows, columns, 3) with the RGB color of every chip.
+    :return: PIL image of the map with grid lines and axis.
+    """
+    rows_number, columns_number = cells_colors.shape[:2]
+    cell_size = choose_cell_size(rows_number, columns_number)
+    margin = len(str(max(rows_number, columns_number))) * CHARACTER_WIDTH + 6
+    margin = max(margin, CHARACTER_HEIGHT + 6)
+    pixels = numpy.full((rows_number * cell_size + margin + 1, columns_number * cell_size + margin + 1, 3), 255,
+                        dtype=numpy.uint8)
+    wafer_height, wafer_width = rows_number * cell_size, columns_number * cell_size
+    pixels[margin: margin + wafer_height, margin: margin + wafer_width] = scale_cells_colors(cells_colors, cell_size)
+    if cell_size > MIN_CELL_SIZE:
+        pixels[margin + wafer_height, margin: margin + wafer_width + 1] = grid_lines_color
+        pixels[margin: margin + wafer_height + 1, margin + wafer_width] = grid_lines_color
+    image = Image.fromarray(pixels, 'RGB')
+    draw_axis(ImageDraw.Draw(image), rows_number, columns_number, cell_size, margin)
+    return image
+
+
+def save_wafer_image(image_path, states):
+    make_wafer_image(states).save(image_path, quality=95)
@@ -0,0 +1,175 @@
+"""
+Long running mode that watches input directories and handles every new wafer file
+once it finished landing, with the same (warm) process and workers pool.
+"""
+import copy
+import csv
+import logging
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+from itertools import count
+
+logger = logging.getLogger('ChipProductionLogger')
+
+supported_suffixes = {'.txt', '.stdf'}
+
+
+class DirectoriesWatcher:
+    """
+    Poll directories (recursively) for wafer files.
+    A file is ready when its size and modification time did not change for settle_seconds,
+    so files that are still being written are skipped until they are complete.
+    A handled file is ready again when it is overwritten (its size or modification time changed).
+    """
+
+    def __init__(self, directories, settle_seconds=5.0, is_including_existing_files=False, excluded_directories=()):
+        """
+        :param excluded_directories: directories inside the watched directories whose files are never handled,
+         like the output directory.
+        """
+        self.directories = list(directories)
+        self.settle_seconds = settle_seconds
+        self.excluded_directories = [directory.resolve() for directory in excluded_directories]
+        self.pending_files = dict()  # path -> (size, modification time, time of the last change)
+        self.handled_files = dict()  # path -> (size, modification time) when it was handled
+        if not is_including_existing_files:
+            for path in self.list_wafer_files():
+                try:
+                    self.handled_files[path] = self.get_signature(path)
+                except FileNotFoundError:
+                    pass
+
+    @staticmethod
+    def get_signature(path):
+        file_status = path.stat()
+        return file_status.st_size, file_status.st_mtime_ns
+
+    def is_excluded(self, path):
+        resolved_path = path.resolve()
+        return any(directory in resolved_path.parents for directory in self.excluded_directories)
+
+    def list_wafer_files(self):
+        for directory in self.directories:
+            for path in directory.rglob('*'):
+                if path.suffix in supported_suffixes and path.is_file() and not self.is_excluded(path):
+                    yield path
+
+    def poll(self):
+        """
+        :return: list of the files that became ready since the last poll, sorted.
+        """
+        now = time.monotonic()
+        ready_files, existing_files = list(), set()
+        for path in self.list_wafer_files():
+            try:
+                file_signature = self.get_signature(path)
+            except FileNotFoundError:
+                continue
+            existing_files.add(path)
+            if self.handled_files.get(path) == file_signature:
+                continue
+            previous_signature = self.pending_files.get(path)
+            if previous_signature is None or previous_signature[:2] != file_signature:
+                self.pending_files[path] = file_signature + (now,)
+            elif file_signature[0] > 0 and now - previous_signature[2] >= self.settle_seconds:
+                del self.pending_files[path]
+                self.handled_files[path] = file_signature
+                ready_files.append(path)
+        for files in [self.pending_files, self.handled_files]:  # forget the deleted files
+            for path in [path for path in files if path not in existing_files]:
+                del files[path]
+        return sorted(ready_files)
+
+
+def append_summary_row(summary_path, summary_row, fieldnames):
+    is_new_file = not summary_path.exists()
+    with open(summary_path, 'a', newline='') as summary_file:
+        writer = csv.DictWriter(summary_file, fieldnames=fieldnames, extrasaction='ignore')
+        if is_new_file:
+            writer.writeheader()
+        writer.writerow(summary_row)
+
+
+def watch_directories(args, handle_file_function, fieldnames, stop_event=None, plan_wafers_function=None):
+    """
+    Handle new wafer files from args.watch_dirs until stop_event is set (or KeyboardInterrupt).
+    Each wafer gets its own results directory inside args.output_dir_path and its summary row
+    is appended to watch_summary.csv there.
+    :param args: the program arguments.
+    :param handle_file_function: function that handles arguments of one wafer and returns its summary row or None.
+    :param fieldnames: the columns of the summary file.
+    :param stop_event: threading.Event for stopping the watch.
+    :param plan_wafers_function: function that splits arguments of file into arguments per wafer (for STDF files
+     with many wafers), every file is one wafer when not given.
+    """
+    stop_event = stop_event if stop_event is not None else threading.Event()
+    watcher = DirectoriesWatcher(args.watch_dirs, args.settle_seconds, args.process_existing,
+                                 excluded_directories=[args.output_dir_path])
+    summary_path = args.output_dir_path / 'watch_summary.csv'
+    executor = ProcessPoolExecutor(max_workers=args.workers) if args.workers > 1 else None
+    pending_futures = list()  # (path, future)
+    files_numbers = count()
+    logger.info(f'Watching {", ".join(str(directory) for directory in args.watch_dirs)}.')
+    try:
+        while not stop_event.is_set():
+            for path in watcher.poll():
+                logger.info(f'New wafer file {path}.')
+                file_arguments = copy.deepcopy(args)
+                file_arguments.input_wafer_path = path
+                # files with the same name may land in the same second, the number keeps their outputs apart
+                file_arguments.run_date = f'{datetime.today().strftime("%Y_%m_%d_%H_%M_%S")}_{next(files_numbers)}'
+                wafers_arguments = plan_wafers_function(file_arguments) if plan_wafers_function else [file_arguments]
+                for wafer_arguments in wafers_arguments:
+                    if executor is None:
+                        summary_row = handle_file_function(wafer_arguments)
+                        if summary_row is not None:
+                            append_summary_row(summary_path, summary_row, fieldnames)
+                        continue
+                    try:
+                        future = executor.submit(handle_file_function, wafer_arguments)
+                    except BrokenProcessPool:
+                        executor = recreate_executor(executor, args.workers)
+                        future = executor.submit(handle_file_function, wafer_arguments)
+                    pending_futures.append((path, future))
+            done_futures = [(path, future) for path, future in pending_futures if future.done()]
+            is_pool_broken = False
+            for path, future in done_futures:
+                pending_futures.remove((path, future))
+                is_pool_broken |= not collect_result(path, future, summary_path, fieldnames)
+            if is_pool_broken:
+                executor = recreate_executor(executor, args.workers)
+            stop_event.wait(args.poll_seconds)
+    except KeyboardInterrupt:
+        logger.info('Watch was stopped.')
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=True)
+            for path, future in pending_futures:
+                collect_result(path, future, summary_path, fieldnames)
+
+
+def collect_result(path, future, summary_path, fieldnames):
+    """
+    Append the summary row of file that was handled in the pool, its failure does not stop the watch.
+    :return: False when the pool is broken (a worker died), True otherwise.
+    """
+    try:
+        summary_row = future.result()
+    except BrokenProcessPool:
+        logger.exception(f'The workers pool broke while handling {path}.')
+        return False
+    except Exception:
+        logger.exception(f'Failed handling {path} in the workers pool.')
+        return True
+    if summary_row is not None:
+        append_summary_row(summary_path, summary_row, fieldnames)
+    return True
+
+
+def recreate_executor(executor, workers_number):
+    logger.warning('Starting new workers pool.')
+    executor.shutdown(wait=False)
+    return ProcessPoolExecutor(max_workers=workers_number)